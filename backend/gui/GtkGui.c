@@ -975,7 +975,7 @@ void OnFile_Exit() {
 	exit(0);
 }
 
-void state_load(gchar *state_filename) {
+int state_load(gchar *state_filename) {
 	int ret;
 	char Text[MAXPATHLEN + 20];
 	FILE *fp;
@@ -984,7 +984,7 @@ void state_load(gchar *state_filename) {
 	fp = fopen(state_filename, "rb");
 	if (fp == NULL) {
 		// file does not exist
-		return;
+		return -1;
 	}
 
 	fclose(fp);
@@ -996,7 +996,7 @@ void state_load(gchar *state_filename) {
 
 		if (OpenPlugins("none", NULLSwitch, NULL, 1) == -1) {
 			SysRunGui();
-			return;
+			return -1;
 		}
 	}
 
@@ -1007,7 +1007,7 @@ void state_load(gchar *state_filename) {
 		if (CheckCdrom() == -1) {
 			ClosePlugins();
 			SysRunGui();
-			return;
+			return -1;
 		}
 
 		// Auto-detect: region first, then rcnt reset
@@ -1021,9 +1021,15 @@ void state_load(gchar *state_filename) {
 		sprintf(Text, _("Error loading state %s!"), state_filename);
 		GPU_displayText(Text);
 	}
+	return ret;
 }
 
-void state_save(gchar *state_filename) {
+int state_save(gchar *state_filename) {
+	return state_save_as(state_filename, STATE_CODEC_BEST, NULL);
+}
+
+int state_save_as(gchar *state_filename, int codec, const char *base) {
+	int ret;
 	char Text[MAXPATHLEN + 20];
 
 	// If the window exists, then we are saving the state from within
@@ -1033,19 +1039,21 @@ void state_save(gchar *state_filename) {
 
 		if (OpenPlugins("none", NULLSwitch, NULL, 1) == -1) {
 			SysRunGui();
-			return;
+			return -1;
 		}
 	}
 
 	GPU_updateLace();
 
-	if (SaveState(state_filename) == 0){
+	ret = SaveStateAs(state_filename, codec, base);
+	if (ret == 0){
 		sprintf(Text, _("Saved state %s."), state_filename);
 		writeStatusNotification(3);
 	}else{
 		sprintf(Text, _("Error saving state %s!"), state_filename);
 	}
 	GPU_displayText(Text);
+	return ret;
 }
 
 void on_states_load (GtkWidget *widget, gpointer user_data) {
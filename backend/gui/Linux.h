@@ -61,8 +61,9 @@ gchar* get_state_filename(int i);
 gchar* get_cdrom_label_id(const gchar* suffix); // get cdrom label and id and append suffix to string
 gchar* get_cdrom_label_trim(); // trim cdrom label out of whitespaces
 
-void state_save(gchar *state_filename);
-void state_load(gchar *state_filename);
+int state_save(gchar *state_filename);
+int state_save_as(gchar *state_filename, int codec, const char *base);
+int state_load(gchar *state_filename);
 
 int match(const char* string, char* pattern);
 int plugins_configured();
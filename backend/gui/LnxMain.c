@@ -34,6 +34,8 @@
 #include <sys/stat.h>
 #include "../libpcsxcore/psxmem.h"
 #include "../libpcsxcore/sio.h"
+#include "../libpcsxcore/framering.h"
+#include "../libpcsxcore/rewind.h"
 
 #include "Linux.h"
 #include <fcntl.h>
@@ -75,34 +77,233 @@ int stateActionRequest = 0;
 char* stateToLoad;
 
 boolean emulationIsPaused = FALSE;
+pthread_mutex_t pauseLock = PTHREAD_MUTEX_INITIALIZER;
+pthread_cond_t pauseChanged = PTHREAD_COND_INITIALIZER;
+
+
+// Deferred replies, answered from SysUpdate once the emulation thread
+// has actually stopped, resumed or finished with a state file.
+boolean pauseReplyPending = FALSE;
+u32 pauseRequestId = 0;
+boolean resumeReplyPending = FALSE;
+u32 resumeRequestId = 0;
+u32 stateRequestId = 0;
+u32 stateSlot = 0;
+int stateSlotCompress = 0;
+int stateCodec = STATE_CODEC_BEST;
+char* stateBase = NULL;
+u32 rewindSteps = 0;
+boolean rewindCapturePending = FALSE;
+
+// Lockstep stepping (opcode 29): run exactly stepFramesLeft vsyncs, then
+// freeze again and reply. Guarded by pauseLock.
+u32 stepFramesLeft = 0;
+u32 stepRequestId = 0;
+boolean stepStarting = FALSE;
+int stepSnapshotKey = 0;
+boolean stepObserve = FALSE;
+boolean stepInputsPending = FALSE;
+unsigned short stepButtons[2];
+
+// Turbo (opcode 44): no frame limiter, and only frames somebody looks at
+// are rasterized, plus one in turboRenderEvery if that is set.
+boolean turboEnabled = FALSE;
+u32 turboRenderEvery = 0;
+
+// Emulated frames per second, measured over half second windows
+double emulatedFps = 0;
+u64 fpsWindowFrames = 0;
+struct timespec fpsWindowStart;
+
+// Block writes (opcode 28) are checked on arrival but only applied by
+// SysUpdate, so the game never runs with half of a batch in place. Listener
+// changes (opcodes 54, 55) share the queue, so they keep their order.
+typedef struct QueuedWrite {
+	u32 id;
+	int opcode; // 28 write regions, 54 add listener, 55 remove listener
+	char *payload;
+	struct QueuedWrite *next;
+} QueuedWrite;
+
+pthread_mutex_t writeQueueLock = PTHREAD_MUTEX_INITIALIZER;
+QueuedWrite *writeQueueHead = NULL;
+QueuedWrite *writeQueueTail = NULL;
+
+
+// Commands are pulled off the -proc pipe in bulk: every read() takes as
+// much as the pipe holds and whole frames are then parsed from the buffer,
+// so a burst of pipelined requests costs a handful of syscalls.
+#define PROC_BUFFER_SIZE 65536
+
+// Upper bounds for a single read_regions / write_regions request (opcodes 23, 28)
+#define MAX_READ_REGIONS 4096
+#define MAX_READ_REGIONS_BYTES 0x200000
 
+typedef struct {
+	int fd;
+	char *data;
+	size_t size;
+	size_t start;
+	size_t end;
+} ProcReader;
+
+// Make sure at least count unparsed bytes are buffered
+static int procBuffer(ProcReader *r, size_t count) {
+	if (r->end - r->start >= count) return 0;
+	if (r->start > 0) {
+		memmove(r->data, r->data + r->start, r->end - r->start);
+		r->end -= r->start;
+		r->start = 0;
+	}
+	if (count > r->size) {
+		r->size = count;
+		r->data = realloc(r->data, r->size);
+	}
+	while (r->end < count) {
+		ssize_t b = read(r->fd, r->data + r->end, r->size - r->end);
+		if (b < 0 && errno == EINTR) continue;
+		if (b <= 0) return -1;
+		r->end += b;
+	}
+	return 0;
+}
 
-int integerStackValue(int value, int bottom){
-	return (value<<8)|(bottom&0xff);
+// A frozen console is parked between frames, so it can handle queued
+// writes and state actions without being resumed
+static void runStateActions();
+
+static void wakeFrozenEmulation() {
+	pthread_mutex_lock(&pauseLock);
+	pthread_cond_signal(&pauseChanged);
+	pthread_mutex_unlock(&pauseLock);
+}
+
+// The payload sits at an arbitrary offset in the buffer
+static u32 payloadU32(const char *payload, int i) {
+	u32 v;
+	memcpy(&v, payload + 4*i, sizeof(u32));
+	return v;
+}
+
+// Opcode 28 payload: region count, (start, length) per region, then the
+// data of every region back to back
+static int validWriteRegions(const char *payload, u32 length) {
+	u32 regions = (length >= 4) ? payloadU32(payload, 0) : 0;
+	u32 total = 0;
+	u8 *p;
+
+	if (regions == 0 || regions > MAX_READ_REGIONS || length < 4 + 8*regions) return 0;
+	for (u32 i = 0; i < regions; i++){
+		u32 count = payloadU32(payload, 2 + 2*i);
+		if (count == 0) continue;
+		p = psxMemReadPointer(payloadU32(payload, 1 + 2*i), count);
+		if (p == NULL || p < (u8 *)psxM || p + count > (u8 *)psxM + 0x00220000) return 0;
+		total += count;
+		if (total > MAX_READ_REGIONS_BYTES) return 0;
+	}
+	return length == 4 + 8*regions + total;
+}
+
+static void applyWriteRegions(const char *payload) {
+	u32 regions = payloadU32(payload, 0);
+	const char *data = payload + 4 + 8*regions;
+
+	for (u32 i = 0; i < regions; i++){
+		u32 count = payloadU32(payload, 2 + 2*i);
+		if (count == 0) continue;
+		psxMemWriteBlock(payloadU32(payload, 1 + 2*i), data, count);
+		data += count;
+	}
+}
+
+static void queueWrite(u32 id, int opcode, const char *payload, u32 length) {
+	QueuedWrite *w = malloc(sizeof(QueuedWrite));
+	w->id = id;
+	w->opcode = opcode;
+	w->payload = malloc(length);
+	memcpy(w->payload, payload, length);
+	w->next = NULL;
+	pthread_mutex_lock(&writeQueueLock);
+	if (writeQueueTail != NULL) writeQueueTail->next = w;
+	else writeQueueHead = w;
+	writeQueueTail = w;
+	pthread_mutex_unlock(&writeQueueLock);
+	wakeFrozenEmulation();
+}
+
+// Runs on the emulation thread, between frames
+static void applyQueuedWrites() {
+	QueuedWrite *w;
+
+	pthread_mutex_lock(&writeQueueLock);
+	w = writeQueueHead;
+	writeQueueHead = writeQueueTail = NULL;
+	pthread_mutex_unlock(&writeQueueLock);
+
+	while (w != NULL){
+		QueuedWrite *next = w->next;
+		int ret = 0;
+		switch (w->opcode){
+		case 28:
+			applyWriteRegions(w->payload);
+			break;
+		case 54:
+			ret = addMemoryHook((int *)w->payload);
+			break;
+		case 55:
+			ret = removeMemoryHook((u8) w->payload[0]);
+			break;
+		}
+		writeReply(w->id, w->opcode, (ret == 0) ? REPLY_OK : REPLY_FAILED, NULL, 0);
+		free(w->payload);
+		free(w);
+		w = next;
+	}
+}
+
+static char *payloadString(char *payload, u32 length) {
+	char *s = malloc(length + 1);
+	memcpy(s, payload, length);
+	s[length] = '\0';
+	return s;
 }
 
 void* ProceedurePipeThreadF(void* pname) {
-		FILE * fp = fopen ("/home/carlos/procPipeDebug.txt","w");
 		if (strcmp(pname, "none") == 0) pthread_exit(NULL);
     if (debug_global) printf("Running Proceedure Thread...\n");
-		char pipename[64];
-		sprintf(pipename, "%s-proc", pname);
-		char insbuf[1];
-		int shmid;
-		int shared_memory_setup = 0;
-	  char *shared_memory;
+		char pipename[MAXPATHLEN];
+		snprintf(pipename, sizeof(pipename), "%s-proc", (char*)pname);
+		RequestHeader header;
+		char *payload;
 		int ins_source;
 		ins_source = open((char*)pipename, O_RDONLY);
+		ProcReader reader = {ins_source, malloc(PROC_BUFFER_SIZE), PROC_BUFFER_SIZE, 0, 0};
+		// Grown to the largest read_regions reply seen so far
+		char *gather = NULL;
+		u32 gatherSize = 0;
 		while(1){
-			int b = read(ins_source, insbuf, 1);
-			if (debug_global) printf ("Have: %i\n",b);
-			if (b==0) break;
-			if (debug_global) printf("[PROC]	%i\n", insbuf[0]);
-			int node = insbuf[0];
-			//printf ("Enter %i\n",node);
-			if (insbuf[0]==(char)1){
+			if (procBuffer(&reader, sizeof(RequestHeader)) != 0) break;
+			memcpy(&header, reader.data + reader.start, sizeof(RequestHeader));
+			reader.start += sizeof(RequestHeader);
+			// Valid until the next procBuffer call
+			if (procBuffer(&reader, header.length) != 0) break;
+			payload = reader.data + reader.start;
+			reader.start += header.length;
+			if (debug_global) printf("[PROC]	%i (id %u, %u bytes)\n", header.opcode, header.id, header.length);
+
+			u32 id = header.id;
+			u32 length = header.length;
+			int opcode = header.opcode;
+			if (header.version != PROTOCOL_VERSION){
+				writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+				continue;
+			}
+
+			if (opcode == 1){
 				// Exit emulator
 				close(ins_source);
+				FrameRingShutdown();
+				RewindShutdown();
 				EmuShutdown();
 				ReleasePlugins();
 				freeMLAdditions();
@@ -110,218 +311,435 @@ void* ProceedurePipeThreadF(void* pname) {
 				if (debug_global) printf("Freeing emulator...\n");
 				if (emuLog != NULL) fclose(emuLog);
 				break;
-			}else if (insbuf[0]==(char) 2){
-				// Pause Emulation
+			}
+
+			switch (opcode){
+			case 2:
+				// Pause Emulation, answered once SysUpdate is parked
 				if (debug_global) printf("[M]		Request Pause\n");
+				pthread_mutex_lock(&pauseLock);
 				if (emulationIsPaused){
 					// We are already paused!
-					writeStatusNotification(7);
+					pthread_mutex_unlock(&pauseLock);
+					writeReply(id, opcode, REPLY_OK, NULL, 0);
+					break;
 				}
 				emulationIsPaused = TRUE;
-			}else if (insbuf[0]==(char) 3){
-				// Resume Emulation
+				pauseReplyPending = TRUE;
+				pauseRequestId = id;
+				pthread_mutex_unlock(&pauseLock);
+				break;
+			case 3:
+				// Resume Emulation, answered once SysUpdate is running again
 				if (debug_global) printf("[M]		Request Resume\n");
+				pthread_mutex_lock(&pauseLock);
 				if (!emulationIsPaused){
 					// We are already resumed!
-					writeStatusNotification(8);
+					pthread_mutex_unlock(&pauseLock);
+					writeReply(id, opcode, REPLY_OK, NULL, 0);
+					break;
 				}
 				emulationIsPaused = FALSE;
-			}else if (insbuf[0]==(char)11){
-				// Get render
-				if (debug_global) printf("Snapshot requested.\n");
-				read(ins_source, insbuf, 1);
-				if (debug_global) printf("Unique number is %i\n", insbuf[0]);
-				TakeGPUSnapshot(insbuf[0]);
-			}else if (insbuf[0]==(char)12){
+				if (pauseReplyPending){
+					// The pause never took effect, settle both now
+					pauseReplyPending = FALSE;
+					writeReply(pauseRequestId, 2, REPLY_OK, NULL, 0);
+					writeReply(id, opcode, REPLY_OK, NULL, 0);
+				}else{
+					resumeReplyPending = TRUE;
+					resumeRequestId = id;
+				}
+				pthread_cond_signal(&pauseChanged);
+				pthread_mutex_unlock(&pauseLock);
+				break;
+			case 11: {
+				// Get render: the reply goes out once the next frame is in key
+				if (length < 4){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
+				}
+				int key = (s32) payloadU32(payload, 0);
+				if (debug_global) printf("Snapshot requested (%i).\n", key);
+				int status = FrameSnapshotRequest(id, key);
+				if (status != REPLY_OK) writeReply(id, opcode, status, NULL, 0);
+				break;
+			}
+			case 56:
+				// Observation spec: key, width, height, channels, crop
+				// x/y/width/height, max pool
+				if (length < 36){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
+				}
+				writeReply(id, opcode, FrameObservationConfigure((s32) payloadU32(payload, 0),
+					payloadU32(payload, 1), payloadU32(payload, 2), payloadU32(payload, 3),
+					payloadU32(payload, 4), payloadU32(payload, 5), payloadU32(payload, 6),
+					payloadU32(payload, 7), payloadU32(payload, 8) ? TRUE : FALSE), NULL, 0);
+				break;
+			case 57: {
+				// Get observation: the reply goes out once it is in place,
+				// two frames from now when pooling
+				int status = FrameObservationRequest(id, FrameObservationFrames());
+				if (status != REPLY_OK) writeReply(id, opcode, status, NULL, 0);
+				break;
+			}
+			case 12:
 				// Clear shared memory for render
 				if (debug_global) printf("You want to clear shared memory\n");
-				TakeGPUSnapshot(0);
-			}else if (insbuf[0]==(char)13){
-				// Headless way of pulling framebuffer
-				// Unused
-			}else if (insbuf[0]==(char)21){
-				// PSX memory query
-				int startindex = 0;
-				for (int i=0;i<4;i++){
-					read(ins_source, insbuf, 1);
-					startindex = integerStackValue(startindex, (int) insbuf[0]);
-				}
-
-				int length = 0;
-				for (int i=0;i<4;i++){
-					read(ins_source, insbuf, 1);
-					//printf ("B%i\n",i);
-					length = integerStackValue(length, (int) insbuf[0]);
-				}
-
-
-				read(ins_source, insbuf, 1);
-				key_t key = insbuf[0];
-
-				// Setup shared memory
-				if (shared_memory_setup == 0){
-				  if ((shmid = shmget(key, 128, IPC_CREAT | 0666)) < 0)
-				  {
-						perror("shmget");
-				    if (debug_global) printf("Error getting shared memory id");
-						printf ("Error getting shared memory id\n",node);
-						break;
-				  }
-					shared_memory_setup = 1;
-				  // Attached shared memory
-				  if ((shared_memory = shmat(shmid, NULL, 0)) == (char *) -1)
-				  {
-						perror("shmat");
-				    if (debug_global) printf("Error attaching shared memory id");
-						printf ("Error getting shared memory id\n",node);
-						break;
-				  }
-				}
-
-				memcpy(shared_memory, psxMemPointer(startindex), length);
-				if (debug_global) printf("(Notified)\n");
-				writeStatusNotification(11);
-
-			}else if (insbuf[0]==(char)22){
+				writeReply(id, opcode, FrameSnapshotRelease(), NULL, 0);
+				break;
+			case 21: {
+				// PSX memory query, the bytes come back inline with the reply
+				if (length < 8){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
+				}
+				u32 count = payloadU32(payload, 1);
+				char *source = psxMemReadPointer(payloadU32(payload, 0), count);
+				if (source == NULL){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
+				}
+				writeReply(id, opcode, REPLY_OK, source, count);
+				break;
+			}
+			case 23: {
+				// Gather several PSX memory ranges into a single reply
+				u32 regions = (length >= 4) ? payloadU32(payload, 0) : 0;
+				if (regions == 0 || regions > MAX_READ_REGIONS || length < 4 + 8*regions){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
+				}
+				u32 total = 0;
+				int valid = 1;
+				for (u32 i = 0; i < regions && valid; i++){
+					u32 count = payloadU32(payload, 2 + 2*i);
+					valid = count == 0 || psxMemReadPointer(payloadU32(payload, 1 + 2*i), count) != NULL;
+					total += count;
+					valid = valid && total <= MAX_READ_REGIONS_BYTES;
+				}
+				if (!valid){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
+				}
+				if (total > gatherSize){
+					gatherSize = total;
+					gather = realloc(gather, gatherSize);
+				}
+				char *out = gather;
+				for (u32 i = 0; i < regions; i++){
+					u32 count = payloadU32(payload, 2 + 2*i);
+					if (count == 0) continue;
+					memcpy(out, psxMemReadPointer(payloadU32(payload, 1 + 2*i), count), count);
+					out += count;
+				}
+				writeReply(id, opcode, REPLY_OK, gather, total);
+				break;
+			}
+			case 22: {
 				// Dump memory to file
-
-				int startindex = 0;
-				for (int i=0;i<4;i++){
-					read(ins_source, insbuf, 1);
-					startindex = integerStackValue(startindex, (int) insbuf[0]);
+				if (length < 8){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
 				}
-
-				int length = 0;
-				for (int i=0;i<4;i++){
-					read(ins_source, insbuf, 1);
-					length = integerStackValue(length, (int) insbuf[0]);
+				u32 startindex = payloadU32(payload, 0);
+				u32 count = payloadU32(payload, 1);
+				if (psxMemReadPointer(startindex, count) == NULL || length == 8){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
 				}
+				char *outputPath = payloadString(payload + 8, length - 8);
 
-				read(ins_source, insbuf, 1);
-				char sizeofstring = insbuf[0];
-				char* outputPath = malloc(sizeof(char) * (((int)sizeofstring)+1));
-				read(ins_source, outputPath, sizeofstring);
-				outputPath[sizeofstring] = '\0';
-
-				if (debug_global) printf("Dumping %i bytes to %s\n", length, outputPath);
+				if (debug_global) printf("Dumping %i bytes to %s\n", count, outputPath);
+				int status = REPLY_OK;
 				FILE* fd = fopen(outputPath, "w");
+				free(outputPath);
 				if (fd == NULL) {
 					if (debug_global) printf("Failed to write to file.\n");
-					continue;
+					writeReply(id, opcode, REPLY_FAILED, NULL, 0);
+					break;
 				}
-				int wrote = fwrite(psxMemPointer(startindex), sizeof(char), length, fd);
-				if (wrote != length){
+				if (fwrite(psxMemPointer(startindex), sizeof(char), count, fd) != count){
 					if (debug_global) printf("Error writing... \n");
+					status = REPLY_FAILED;
 				}
 				fclose(fd);
-				free(outputPath);
-				writeStatusNotification(4);
-
-			}else if (insbuf[0]==(char)23){
-				// Remove shared memory used for PSX memory query
-				if (shared_memory_setup == 1){
-					if (debug_global) printf("[M]		Removing shared memory...\n");
-					shmdt(shmid);
-					shmctl(shmid, IPC_RMID, NULL);
-					shared_memory_setup = 0;
-				}
-			}else if (insbuf[0]==(char)24){
-				// Silence Memory Listener
-				read(ins_source, insbuf, 1);
-				int tarkey = (int) insbuf[0];
-				silenceMemoryNotification(tarkey);
-			}else if (insbuf[0]==(char)25){
-				// Unsilence Memory Listener
-				read(ins_source, insbuf, 1);
-				int tarkey = (int) insbuf[0];
-				unsilenceMemoryNotification(tarkey);
-			}else if (insbuf[0]==(char)26){
+				writeReply(id, opcode, status, NULL, 0);
+				break;
+			}
+			case 24:
+			case 25:
+				// Silence / unsilence memory listener
+				if (length < 1){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
+				}
+				if (opcode == 24) silenceMemoryNotification((u8) payload[0]);
+				else unsilenceMemoryNotification((u8) payload[0]);
+				writeReply(id, opcode, REPLY_OK, NULL, 0);
+				break;
+			case 26:
 				// Write byte to memory
-
-				int startindex = 0;
-				for (int i=0;i<4;i++){
-					read(ins_source, insbuf, 1);
-					startindex = integerStackValue(startindex, (int) insbuf[0]);
+				if (length < 5){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
 				}
-
-				read(ins_source, insbuf, 1);
-				char value = insbuf[0];
-
-				psxMemWrite8(startindex, value);
-				writeStatusNotification(5);
-			}else if (insbuf[0]==(char)27){
+				// Hooks can only change while the table is unlocked
+				lockMemoryHooks();
+				psxMemWrite8(payloadU32(payload, 0), payload[4]);
+				unlockMemoryHooks();
+				writeReply(id, opcode, REPLY_OK, NULL, 0);
+				break;
+			case 27: {
 				// Drill byte to memory
-
-				int startindex = 0;
-				for (int i=0;i<4;i++){
-					read(ins_source, insbuf, 1);
-					startindex = integerStackValue(startindex, (int) insbuf[0]);
+				if (length < 6){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
 				}
-
-				read(ins_source, insbuf, 1);
-				char value = insbuf[0];
-				read(ins_source, insbuf, 1);
-				int times = (int) insbuf[0];
-
+				u32 startindex = payloadU32(payload, 0);
+				char value = payload[4];
+				int times = (u8) payload[5];
 				for (int i=0; i<times; i++){
+					lockMemoryHooks();
 					psxMemWrite8(startindex, value);
+					unlockMemoryHooks();
 					usleep(5000);
 				}
 				if (debug_global) printf("Finished drilling.\n");
-				writeStatusNotification(6);
-			}else if (insbuf[0]==(char)31){
-				// Start recording audio
-				read(ins_source, insbuf, 1);
-				char sizeofstring = insbuf[0];
-				read(ins_source, audioRecordPath, sizeofstring);
-				audioRecordPath[sizeofstring] = '\0';
+				writeReply(id, opcode, REPLY_OK, NULL, 0);
+				break;
+			}
+			case 28: {
+				// Write regions, applied at the next frame boundary
+				if (!validWriteRegions(payload, length)){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
+				}
+				queueWrite(id, opcode, payload, length);
+				break;
+			}
+			case 54:
+				// Add a memory listener: start, length, key, newonly, buffer,
+				// window (the record -nMemoryListeners reads), between frames
+				if (length < 12){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
+				}
+				queueWrite(id, opcode, payload, 12);
+				break;
+			case 55:
+				// Remove a memory listener by key, between frames
+				if (length < 1){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
+				}
+				queueWrite(id, opcode, payload, 1);
+				break;
+			case 29: {
+				// Step: frames, snapshot key (0 = none), buttons held on
+				// each pad, flags (1 = apply the buttons, 2 = observe)
+				if (length < 13 || payloadU32(payload, 0) == 0){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
+				}
+				pthread_mutex_lock(&pauseLock);
+				if (stepFramesLeft > 0){
+					pthread_mutex_unlock(&pauseLock);
+					writeReply(id, opcode, REPLY_BUSY, NULL, 0);
+					break;
+				}
+				if (pauseReplyPending){
+					pauseReplyPending = FALSE;
+					writeReply(pauseRequestId, 2, REPLY_OK, NULL, 0);
+				}
+				stepFramesLeft = payloadU32(payload, 0);
+				stepRequestId = id;
+				stepSnapshotKey = (s32) payloadU32(payload, 1);
+				memcpy(stepButtons, payload + 8, sizeof(stepButtons));
+				stepInputsPending = (payload[12] & 1) ? TRUE : FALSE;
+				stepObserve = (payload[12] & 2) ? TRUE : FALSE;
+				stepStarting = TRUE;
+				emulationIsPaused = FALSE;
+				pthread_cond_signal(&pauseChanged);
+				pthread_mutex_unlock(&pauseLock);
+				break;
+			}
+			case 31:
+				// Start recording audio, audioRecordPath holds 128 bytes
+				if (length == 0 || length > 127){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
+				}
+				memcpy(audioRecordPath, payload, length);
+				audioRecordPath[length] = '\0';
 				if (debug_global) printf("Audio will record. (%s)\n", audioRecordPath);
 				*audioRecordSwitch = 1;
-			}else if (insbuf[0]==(char)32){
-				// Stop recording audio
+				writeReply(id, opcode, REPLY_OK, NULL, 0);
+				break;
+			case 33:
+				// Start streaming audio into the shm ring named by the payload
+				if (length == 0 || length > 127 || *audioRecordSwitch != 0){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
+				}
+				memcpy(audioRecordPath, payload, length);
+				audioRecordPath[length] = '\0';
+				if (debug_global) printf("Audio will stream. (%s)\n", audioRecordPath);
+				*audioRecordSwitch = 2;
+				writeReply(id, opcode, REPLY_OK, NULL, 0);
+				break;
+			case 32:
+				// Stop recording or streaming audio
 				if (debug_global) printf("Audio has stopped recording.\n");
 				*audioRecordSwitch = 0;
-			}else if (insbuf[0]==(char)41){
-				// Save state
+				writeReply(id, opcode, REPLY_OK, NULL, 0);
+				break;
+			case 41:
+			case 42:
+				// Save / load state, carried out by SysUpdate between frames
 				if (stateActionRequest != 0){
-					if (debug_global) printf("Unable to save state, state being loaded. \n");
-					continue;
-				}
-				read(ins_source, insbuf, 1);
-				char sizeofstring = insbuf[0];
-				stateToLoad = malloc(sizeof(char) * (((int)sizeofstring)+1));
-				read(ins_source, stateToLoad, sizeofstring);
-				stateToLoad[sizeofstring] = '\0';
-				stateActionRequest = 2;
-			}else if (insbuf[0]==(char)42){
-				// Load state
+					if (debug_global) printf("Unable to handle state, another state action is pending. \n");
+					writeReply(id, opcode, REPLY_BUSY, NULL, 0);
+					break;
+				}
+				if (length == 0){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
+				}
+				stateToLoad = payloadString(payload, length);
+				stateRequestId = id;
+				__sync_synchronize();
+				stateActionRequest = (opcode == 42) ? 1 : 2;
+				wakeFrozenEmulation();
+				break;
+			case 46:
+			case 47:
+				// Save to / restore from an in-RAM slot, between frames as well
+				if (stateActionRequest != 0){
+					writeReply(id, opcode, REPLY_BUSY, NULL, 0);
+					break;
+				}
+				if (length < 5 || payloadU32(payload, 0) >= MAX_STATE_SLOTS){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
+				}
+				stateSlot = payloadU32(payload, 0);
+				stateSlotCompress = payload[4];
+				stateRequestId = id;
+				__sync_synchronize();
+				stateActionRequest = (opcode == 46) ? 3 : 4;
+				wakeFrozenEmulation();
+				break;
+			case 49:
+				// Save a state file with a chosen codec, or as a delta against a
+				// base state. Payload: codec, base length, base path, path
 				if (stateActionRequest != 0){
-					if (debug_global) printf("Unable to load state, state being saved. \n");
-					continue;
-				}
-				read(ins_source, insbuf, 1);
-				char sizeofstring = insbuf[0];
-				stateToLoad = malloc(sizeof(char) * (((int)sizeofstring)+1));
-				read(ins_source, stateToLoad, sizeofstring);
-				stateToLoad[sizeofstring] = '\0';
-				stateActionRequest = 1;
-			}else if (insbuf[0]==(char)43){
+					writeReply(id, opcode, REPLY_BUSY, NULL, 0);
+					break;
+				}
+				if (length < 8 || payloadU32(payload, 0) > STATE_CODEC_BEST || payloadU32(payload, 1) >= length - 8){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
+				}
+				stateCodec = payloadU32(payload, 0);
+				stateBase = payloadString(payload + 8, payloadU32(payload, 1));
+				stateToLoad = payloadString(payload + 8 + payloadU32(payload, 1), length - 8 - payloadU32(payload, 1));
+				stateRequestId = id;
+				__sync_synchronize();
+				stateActionRequest = 5;
+				wakeFrozenEmulation();
+				break;
+			case 48:
+				// Drop an in-RAM slot. A pending save or restore may be the
+				// very slot, so it has to be carried out first.
+				if (stateActionRequest != 0){
+					writeReply(id, opcode, REPLY_BUSY, NULL, 0);
+					break;
+				}
+				if (length < 4){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
+				}
+				writeReply(id, opcode, (DeleteStateSlot(payloadU32(payload, 0)) == 0) ? REPLY_OK : REPLY_FAILED, NULL, 0);
+				break;
+			case 43:
 				// Set GPU speed
-				int speedset = 0;
-				for (int i=0;i<4;i++){
-					read(ins_source, insbuf, 1);
-					speedset = integerStackValue(speedset, (int) insbuf[0]);
-				}
-				GPU_setSpeed(speedset/100.0);
-				writeStatusNotification(10);
-			}else if (insbuf[0]==(char)50){
-				// Debugging
-				writeStatusNotification(12);
+				if (length < 4){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
+				}
+				GPU_setSpeed(((s32) payloadU32(payload, 0))/100.0);
+				writeReply(id, opcode, REPLY_OK, NULL, 0);
+				break;
+			case 44:
+				// Turbo on/off, render one frame in N (0 = observed frames only)
+				if (length < 8){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
+				}
+				turboRenderEvery = payloadU32(payload, 1);
+				turboEnabled = payloadU32(payload, 0) ? TRUE : FALSE;
+				GPU_setTurbo(turboEnabled);
+				writeReply(id, opcode, REPLY_OK, NULL, 0);
+				break;
+			case 45: {
+				// Frame counter and emulated frame rate
+				char stats[16];
+				u64 frames = frame_counter;
+				double fps = emulatedFps;
+				memcpy(stats, &frames, 8);
+				memcpy(stats + 8, &fps, 8);
+				writeReply(id, opcode, REPLY_OK, stats, sizeof(stats));
+				break;
+			}
+			case 51:
+				// Rewind ring: capture every N frames, keep up to M captures (0 = off)
+				if (length < 8){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
+				}
+				writeReply(id, opcode, (RewindConfigure(payloadU32(payload, 0), payloadU32(payload, 1)) == 0) ? REPLY_OK : REPLY_FAILED, NULL, 0);
+				break;
+			case 52:
+				// Go back K captures, between frames
+				if (stateActionRequest != 0){
+					writeReply(id, opcode, REPLY_BUSY, NULL, 0);
+					break;
+				}
+				if (length < 4 || payloadU32(payload, 0) == 0){
+					writeReply(id, opcode, REPLY_BAD_REQUEST, NULL, 0);
+					break;
+				}
+				rewindSteps = payloadU32(payload, 0);
+				stateRequestId = id;
+				__sync_synchronize();
+				stateActionRequest = 6;
+				wakeFrozenEmulation();
+				break;
+			case 53: {
+				// Captures held, capacity and bytes used by the rewind ring
+				char stats[16];
+				u32 entries, capacity;
+				u64 bytes;
+				RewindStats(&entries, &capacity, &bytes);
+				memcpy(stats, &entries, 4);
+				memcpy(stats + 4, &capacity, 4);
+				memcpy(stats + 8, &bytes, 8);
+				writeReply(id, opcode, REPLY_OK, stats, sizeof(stats));
+				break;
+			}
+			case 50:
+				// Ping
+				writeReply(id, opcode, REPLY_OK, NULL, 0);
+				break;
+			default:
+				writeReply(id, opcode, REPLY_UNKNOWN_OPCODE, NULL, 0);
+				break;
 			}
-
 		}
-		fprintf (fp, "End of service.\n");
-   	fclose (fp);
+		free(reader.data);
+		free(gather);
+		if (debug_global) printf("End of service.\n");
     pthread_exit(NULL);
 }
 
@@ -517,10 +935,14 @@ int main(int argc, char *argv[]) {
 	int i;
 
 	// Here we allocate the memory that will be used to instruct plugins
-	uniquePipeValue = (char*) malloc(sizeof(char)*32);
+	// Pipe names are paths inside a per-console directory, see psxle_py
+	uniquePipeValue = (char*) malloc(sizeof(char)*MAXPATHLEN);
 	int* memoryListenersCount = (char*) malloc(sizeof(int));
 	int* inputHooks = NULL;
 	int dispMode = 1;
+	int frameRingKey = 0;
+	int frameRingSlots = 0;
+	char *gpuPlugin = NULL;
 
 #ifdef ENABLE_NLS
 	setlocale (LC_ALL, "");
@@ -549,12 +971,28 @@ int main(int argc, char *argv[]) {
 			stateToLoad = argv[++i];
 		}else if (!strcmp(argv[i], "-controlPipe")){
 			char* value = argv[++i];
+			// Leave room for the -joy/-proc/-mem suffixes
+			if (strlen(value) + 8 > MAXPATHLEN) {
+				fprintf(stderr, "Pipe name too long: %s\n", value);
+				return 1;
+			}
 			strcpy(uniquePipeValue, value);
 			validPipes = 1;
 		}else if (!strcmp(argv[i], "-nMemoryListeners")){
 			char* value = argv[++i];
 			strcpy(memoryListenersCount, value);
 			nHooks = (int) strtol(memoryListenersCount, (char **)NULL, 10);
+		}else if (!strcmp(argv[i], "-ramShm")){
+			if (i+1 >= argc) break;
+			ramSharedMemoryName = argv[++i];
+		}else if (!strcmp(argv[i], "-frameRing")){
+			if (i+2 >= argc) break;
+			frameRingKey = (int) strtol(argv[++i], (char **)NULL, 10);
+			frameRingSlots = (int) strtol(argv[++i], (char **)NULL, 10);
+		}else if (!strcmp(argv[i], "-gpu")){
+			// Overrides the GPU plugin of the config file
+			if (i+1 >= argc) break;
+			gpuPlugin = argv[++i];
 		}else if (!strcmp(argv[i], "-cfg")) {
 			if (i+1 >= argc) break;
 			strncpy(cfgfile_basename, argv[++i], MAXPATHLEN-100);	/* TODO buffer overruns */
@@ -593,9 +1031,12 @@ int main(int argc, char *argv[]) {
 							"\t-psxout\t\tEnable PSX output\n"
 							"\t-slowboot\tEnable BIOS Logo\n"
 							"\t-load STATENUM\tLoads savestate STATENUM (1-9)\n"
+							"\t-gpu FILE\tUses GPU plugin FILE instead of the configured one\n"
 							"\t-h -help\tDisplay this message\n"
 							"\t-controlPipe NAME\tSet the name of the control pipes\n"
 							"\t-display NUM\tSet the display mode, default 1\n"
+							"\t-frameRing KEY N\tShare the last N frames in SysV segment KEY\n"
+							"\t-ramShm NAME\tKeep main RAM in POSIX shared memory object NAME\n"
 							"\tfile\t\tLoads file\n"));
 			 return 0;
 		} else {
@@ -613,7 +1054,7 @@ int main(int argc, char *argv[]) {
 	}
 
 	if(validPipes != 1) {
-		uniquePipeValue = "none";
+		strcpy(uniquePipeValue, "none");
 	}
 	audioRecordSwitch = malloc(sizeof(int));
 	audioRecordPath = malloc(128*sizeof(char));
@@ -673,6 +1114,11 @@ int main(int argc, char *argv[]) {
 		SaveConfig();
 	}
 
+	if (gpuPlugin != NULL) {
+		strncpy(Config.Gpu, gpuPlugin, MAXPATHLEN - 1);
+		Config.Gpu[MAXPATHLEN - 1] = '\0';
+	}
+
 	gchar *str_patches_dir = g_strconcat(getenv("HOME"), PATCHES_DIR, NULL);
 	strcpy(Config.PatchesDir,  str_patches_dir);
 	g_free(str_patches_dir);
@@ -709,6 +1155,11 @@ int main(int argc, char *argv[]) {
 
 		if (debug_global) printf("Loaded plugins.\n");
 
+		if (frameRingSlots > 0 && FrameRingInit(frameRingKey, frameRingSlots) != 0) {
+			printf("Failed to set up the frame ring.\n");
+		}
+		GPU_registerFrameSink(FrameAcquire, FramePublish);
+
 		CheckCdrom();
 
 		// Auto-detect: get region first, then rcnt-bios reset
@@ -746,6 +1197,10 @@ int main(int argc, char *argv[]) {
 		pthread_create(&ProceedurePipeThread, NULL, ProceedurePipeThreadF, (void*)uniquePipeValue);
 
 		autoloadCheats();
+		// State actions unwind Execute back to here rather than loading over
+		// the running CPU core, see SysUpdate
+		setjmp(psxExitPoint);
+		runStateActions();
 		psxCpu->Execute();
 	}
 
@@ -861,6 +1316,8 @@ static void SysDisableScreenSaver() {
 	extern unsigned long gpuDisp;
 
 	display = (Display *)gpuDisp;
+	// Headless GPU plugin, there is no display to keep awake
+	if (display == NULL) return;
 
 	if (first_time) {
 		// check if xtest is available
@@ -876,34 +1333,172 @@ static void SysDisableScreenSaver() {
 	}
 }
 
+// Called with pauseLock held, on the frame boundary a step starts from
+static void startStep() {
+	if (stepInputsPending){
+		PAD1_setButtons(0, stepButtons[0]);
+		PAD1_setButtons(1, stepButtons[1]);
+		stepInputsPending = FALSE;
+	}
+	// The next frame is the last one, have it copied for the caller
+	if (stepFramesLeft == 1 && stepSnapshotKey != 0) FrameSnapshotRequest(0, stepSnapshotKey);
+	// Pooling needs the frame before the last one as well, when the step has it
+	if (stepObserve && stepFramesLeft <= (u32) FrameObservationFrames()) FrameObservationRequest(0, stepFramesLeft);
+	stepStarting = FALSE;
+}
+
+static void restartFrameRateWindow() {
+	fpsWindowFrames = frame_counter;
+	clock_gettime(CLOCK_MONOTONIC, &fpsWindowStart);
+}
+
+static void updateFrameRate() {
+	struct timespec now;
+	double elapsed;
+
+	clock_gettime(CLOCK_MONOTONIC, &now);
+	elapsed = (now.tv_sec - fpsWindowStart.tv_sec) + (now.tv_nsec - fpsWindowStart.tv_nsec) / 1e9;
+	if (elapsed < 0.5) return;
+	emulatedFps = (frame_counter - fpsWindowFrames) / elapsed;
+	restartFrameRateWindow();
+}
+
+// Runs on the emulation thread, from runStateActions
+static void applyStateAction() {
+	int req = stateActionRequest;
+	int ret = -1;
+	int opcode = 0;
+	char name[48] = "";
+
+	switch (req){
+	case 1:
+		opcode = 42;
+		ret = state_load(stateToLoad);
+		free(stateToLoad);
+		break;
+	case 2:
+		opcode = 41;
+		ret = state_save(stateToLoad);
+		free(stateToLoad);
+		break;
+	case 3:
+		opcode = 46;
+		ret = SaveStateSlot(stateSlot, stateSlotCompress);
+		// The reply carries the object's name so that clones can boot from it
+		if (ret == 0) StateSlotName(stateSlot, name, sizeof(name));
+		break;
+	case 4:
+		opcode = 47;
+		ret = LoadStateSlot(stateSlot);
+		break;
+	case 5:
+		opcode = 49;
+		ret = state_save_as(stateToLoad, stateCodec, stateBase);
+		free(stateToLoad);
+		free(stateBase);
+		stateBase = NULL;
+		break;
+	case 6:
+		opcode = 52;
+		ret = RewindTo(rewindSteps);
+		break;
+	}
+	stateActionRequest = 0;
+	writeReply(stateRequestId, opcode, (ret == 0) ? REPLY_OK : REPLY_FAILED, name, strlen(name));
+}
+
+// Called with pauseLock held. Returns once the console is resumed, or with
+// emulationIsPaused still set when a state action has to be applied first.
+static void waitWhilePaused() {
+	if (pauseReplyPending){
+		pauseReplyPending = FALSE;
+		writeReply(pauseRequestId, 2, REPLY_OK, NULL, 0);
+	}
+	// Sleep until the procedure thread wakes us up
+	while (emulationIsPaused && stateActionRequest == 0){
+		pthread_cond_wait(&pauseChanged, &pauseLock);
+		if (writeQueueHead != NULL){
+			pthread_mutex_unlock(&pauseLock);
+			applyQueuedWrites();
+			pthread_mutex_lock(&pauseLock);
+		}
+	}
+	if (emulationIsPaused) return;
+	if (resumeReplyPending){
+		resumeReplyPending = FALSE;
+		writeReply(resumeRequestId, 3, REPLY_OK, NULL, 0);
+	}
+	if (stepStarting) startStep();
+}
+
+// Runs from main with Execute unwound, so states are always saved and loaded
+// at the same point of a frame and a frozen console stays frozen across them
+static void runStateActions() {
+	// Captures are taken at the same point rewinds load them back at
+	if (rewindCapturePending){
+		rewindCapturePending = FALSE;
+		RewindCapture();
+	}
+	pthread_mutex_lock(&pauseLock);
+	while (stateActionRequest != 0){
+		pthread_mutex_unlock(&pauseLock);
+		applyStateAction();
+		pthread_mutex_lock(&pauseLock);
+		if (emulationIsPaused) waitWhilePaused();
+	}
+	pthread_mutex_unlock(&pauseLock);
+	restartFrameRateWindow();
+}
+
 void SysUpdate() {
 
-	if (emulationIsPaused){
-		writeStatusNotification(7);
-		// Need the sleep to allow value time to change
-		while(1){
-			usleep(100000);
-			if(!emulationIsPaused) break;
+	updateFrameRate();
+
+	if (writeQueueHead != NULL) applyQueuedWrites();
+
+	flushMemoryNotifications();
+
+	if (stepFramesLeft > 0){
+		pthread_mutex_lock(&pauseLock);
+		if (stepStarting){
+			startStep();
+		}else if (--stepFramesLeft == 0){
+			emulationIsPaused = TRUE;
+			writeReply(stepRequestId, 29, REPLY_OK, NULL, 0);
+		}else{
+			if (stepFramesLeft == 1 && stepSnapshotKey != 0) FrameSnapshotRequest(0, stepSnapshotKey);
+			if (stepObserve && stepFramesLeft == (u32) FrameObservationFrames()) FrameObservationRequest(0, stepFramesLeft);
 		}
-		writeStatusNotification(8);
+		pthread_mutex_unlock(&pauseLock);
+	}
+
+	if (emulationIsPaused){
+		pthread_mutex_lock(&pauseLock);
+		waitWhilePaused();
+		pthread_mutex_unlock(&pauseLock);
+		// Time spent frozen is not emulation time
+		restartFrameRateWindow();
+	}
+
+	if (turboEnabled){
+		boolean observed = FrameSnapshotPending() ||
+			(turboRenderEvery > 0 && (frame_counter + 1) % turboRenderEvery == 0);
+		GPU_skipNextFrame(!observed);
 	}
 
 	PADhandleKey(PAD1_keypressed() );
 	PADhandleKey(PAD2_keypressed() );
 	SysDisableScreenSaver();
 
-	if (stateActionRequest == 0) return;
-	int req = stateActionRequest;
-	stateActionRequest = 0;
-	if (req == 1){
-		state_load(stateToLoad);
-		free(stateToLoad);
-		if (Config.Cpu == CPU_DYNAREC) psxCpu->Execute();
-	}else if (req == 2){
-		state_save(stateToLoad);
-		free(stateToLoad);
+	if (RewindFrame()){
+		rewindCapturePending = TRUE;
+		psxExitPending = TRUE;
 	}
 
+	// Loading a state in here would leave the CPU core running stale code
+	// with a nested Execute, so leave it at the end of this branch test and
+	// let runStateActions apply the state
+	if (stateActionRequest != 0) psxExitPending = TRUE;
 }
 
 /* ADB TODO Replace RunGui() with StartGui ()*/
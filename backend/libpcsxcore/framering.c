@@ -0,0 +1,458 @@
+/***************************************************************************
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ *   This program is distributed in the hope that it will be useful,       *
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+ *   GNU General Public License for more details.                          *
+ *                                                                         *
+ *   You should have received a copy of the GNU General Public License     *
+ *   along with this program; if not, write to the                         *
+ *   Free Software Foundation, Inc.,                                       *
+ *   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.           *
+ ***************************************************************************/
+
+/*
+* Persistent frame ring shared with the Python bridge.
+*
+* The segment is allocated once at startup and the GPU plugin renders each
+* frame straight into the next slot, so reading the newest frame from Python
+* needs neither a pipe round trip nor a fresh shmget/shmat.
+*
+* Snapshot requests go through the same frame sink and land in their own
+* segment, which stays attached until the bridge clears it.
+*
+* Observation requests also go through the frame sink, but the frame is
+* cropped, area-averaged down to the configured size and optionally turned
+* to grayscale before it reaches shared memory, so an 84x84 grayscale
+* observation moves 7 KB instead of the full 900 KB frame.
+*
+* psxle_py reserves every segment (owner-only) under a kernel-picked key
+* before handing the key over, so shmget only ever attaches here and never
+* creates a segment with looser permissions.
+*/
+
+#include "framering.h"
+#include "psxmem.h"
+#include <sys/ipc.h>
+#include <sys/shm.h>
+#include <pthread.h>
+
+#define ALIGN_UP(x) (((x) + FRAME_RING_ALIGN - 1) & ~(FRAME_RING_ALIGN - 1))
+
+static int ringShmid = -1;
+static char *ringMemory = NULL;
+static FrameRingHeader *ring = NULL;
+
+static u64 writingSequence = 0;
+static FrameSlotHeader *writingSlot = NULL;
+
+// Snapshot requests (opcode 11) are answered with the next frame the GPU
+// plugin hands over, so the reply is only sent once the pixels are in place.
+#define MAX_PENDING_SNAPSHOTS 64
+
+static pthread_mutex_t snapshotLock = PTHREAD_MUTEX_INITIALIZER;
+static u32 pendingSnapshots[MAX_PENDING_SNAPSHOTS];
+static int numPendingSnapshots = 0;
+static int snapshotKey = 0;
+static int snapshotShmid = -1;
+static unsigned char *snapshotMemory = NULL;
+static unsigned char *snapshotTarget = NULL;
+static int snapshotsServed = 0;
+
+// Observation spec (opcode 56) and the requests waiting on it (opcode 57)
+typedef struct {
+	u32 id;
+	u32 frames;
+} ObservationRequest;
+
+static ObservationRequest pendingObservations[MAX_PENDING_SNAPSHOTS];
+static int numPendingObservations = 0;
+static int observationsServed = 0;
+static int observationShmid = -1;
+static unsigned char *observationMemory = NULL;
+static u32 observationWidth, observationHeight, observationChannels;
+static boolean observationMaxPool = FALSE;
+// Source pixel boundaries of every output column and row, top-down
+static u32 *observationColumns = NULL;
+static u32 *observationRows = NULL;
+// The two newest reduced frames, for max pooling
+static unsigned char *observationCurrent = NULL;
+static unsigned char *observationPrevious = NULL;
+static u64 observationPreviousFrame = 0;
+static boolean observationPreviousValid = FALSE;
+// Rendered into when neither the ring nor a snapshot wants the frame
+static unsigned char *observationScratch = NULL;
+static unsigned char *acquiredPixels = NULL;
+
+int FrameRingInit(int key, int slots) {
+	u32 headerSize = ALIGN_UP(sizeof(FrameRingHeader));
+	u32 slotStride = ALIGN_UP(sizeof(FrameSlotHeader)) + ALIGN_UP(FRAME_WIDTH * FRAME_HEIGHT * FRAME_CHANNELS);
+	size_t size;
+
+	if (slots <= 0) return -1;
+	size = headerSize + (size_t)slotStride * slots;
+
+	if ((ringShmid = shmget((key_t)key, size, 0)) < 0) {
+		perror("shmget");
+		return -1;
+	}
+	if ((ringMemory = shmat(ringShmid, NULL, 0)) == (char *) -1) {
+		perror("shmat");
+		ringMemory = NULL;
+		return -1;
+	}
+
+	memset(ringMemory, 0, size);
+	ring = (FrameRingHeader *)ringMemory;
+	ring->version = FRAME_RING_VERSION;
+	ring->slots = slots;
+	ring->width = FRAME_WIDTH;
+	ring->height = FRAME_HEIGHT;
+	ring->channels = FRAME_CHANNELS;
+	ring->headerSize = headerSize;
+	ring->slotStride = slotStride;
+	ring->latest = 0;
+	// Readers check the magic last, so only publish it once the rest is set
+	__sync_synchronize();
+	ring->magic = FRAME_RING_MAGIC;
+
+	printf("[C] Frame ring ready (%i slots, %i bytes)\n", slots, (int)size);
+	return 0;
+}
+
+void FrameRingShutdown() {
+	FrameSnapshotRelease();
+	FrameObservationConfigure(0, 0, 0, 0, 0, 0, 0, 0, FALSE);
+
+	if (ringMemory == NULL) return;
+	shmdt(ringMemory);
+	shmctl(ringShmid, IPC_RMID, NULL);
+	ringMemory = NULL;
+	ring = NULL;
+	writingSlot = NULL;
+}
+
+int FrameRingActive() {
+	return ring != NULL;
+}
+
+static void DetachSnapshotMemory() {
+	if (snapshotMemory == NULL) return;
+	shmdt(snapshotMemory);
+	shmctl(snapshotShmid, IPC_RMID, NULL);
+	snapshotMemory = NULL;
+	snapshotShmid = -1;
+}
+
+static int AttachSnapshotMemory(int key) {
+	if (snapshotMemory != NULL && key == snapshotKey) return 0;
+	// Never pull the segment from under a frame that is being copied
+	if (numPendingSnapshots > 0) return -1;
+	DetachSnapshotMemory();
+
+	if ((snapshotShmid = shmget((key_t)key, FRAME_WIDTH * FRAME_HEIGHT * FRAME_CHANNELS, 0)) < 0) {
+		perror("shmget");
+		return -1;
+	}
+	if ((snapshotMemory = shmat(snapshotShmid, NULL, 0)) == (unsigned char *) -1) {
+		perror("shmat");
+		snapshotMemory = NULL;
+		return -1;
+	}
+	snapshotKey = key;
+	return 0;
+}
+
+int FrameSnapshotRequest(u32 id, int key) {
+	int ret = 0;
+
+	pthread_mutex_lock(&snapshotLock);
+	if (numPendingSnapshots == MAX_PENDING_SNAPSHOTS) {
+		ret = REPLY_BUSY;
+	} else if (AttachSnapshotMemory(key) != 0) {
+		ret = REPLY_FAILED;
+	} else {
+		pendingSnapshots[numPendingSnapshots++] = id;
+	}
+	pthread_mutex_unlock(&snapshotLock);
+
+	return ret;
+}
+
+int FrameSnapshotRelease() {
+	int ret = 0;
+
+	pthread_mutex_lock(&snapshotLock);
+	if (numPendingSnapshots > 0) ret = REPLY_BUSY;
+	else DetachSnapshotMemory();
+	pthread_mutex_unlock(&snapshotLock);
+
+	return ret;
+}
+
+// Observations count too, the frame has to be drawn to be reduced
+int FrameSnapshotPending() {
+	return numPendingSnapshots > 0 || numPendingObservations > 0;
+}
+
+static void FreeObservation() {
+	if (observationMemory != NULL) {
+		shmdt(observationMemory);
+		shmctl(observationShmid, IPC_RMID, NULL);
+		observationMemory = NULL;
+		observationShmid = -1;
+	}
+	free(observationColumns);
+	free(observationRows);
+	free(observationCurrent);
+	free(observationPrevious);
+	free(observationScratch);
+	observationColumns = observationRows = NULL;
+	observationCurrent = observationPrevious = observationScratch = NULL;
+	observationPreviousValid = FALSE;
+}
+
+// Splits [start, start + length) into count boxes, ReduceFrame widens empty
+// ones to a single pixel so that upscaling repeats pixels
+static u32 *ObservationBoxes(u32 start, u32 length, u32 count) {
+	u32 *bounds = malloc((count + 1) * sizeof(u32));
+	u32 i;
+
+	if (bounds == NULL) return NULL;
+	for (i = 0; i <= count; i++) bounds[i] = start + (u32)((u64)i * length / count);
+	return bounds;
+}
+
+int FrameObservationConfigure(int key, u32 width, u32 height, u32 channels,
+		u32 cropX, u32 cropY, u32 cropWidth, u32 cropHeight, boolean maxPool) {
+	int ret = 0;
+	size_t size = (size_t)width * height * channels;
+
+	pthread_mutex_lock(&snapshotLock);
+	if (numPendingObservations > 0) {
+		ret = REPLY_BUSY;
+		goto out;
+	}
+	FreeObservation();
+	// Key 0 just drops the spec
+	if (key == 0) goto out;
+
+	if (cropWidth == 0) cropWidth = FRAME_WIDTH - cropX;
+	if (cropHeight == 0) cropHeight = FRAME_HEIGHT - cropY;
+	if (width == 0 || height == 0 || (channels != 1 && channels != 3) ||
+			cropX >= FRAME_WIDTH || cropY >= FRAME_HEIGHT ||
+			cropWidth > FRAME_WIDTH - cropX || cropHeight > FRAME_HEIGHT - cropY ||
+			width > FRAME_WIDTH || height > FRAME_HEIGHT) {
+		ret = REPLY_BAD_REQUEST;
+		goto out;
+	}
+
+	if ((observationShmid = shmget((key_t)key, size, 0)) < 0) {
+		perror("shmget");
+		ret = REPLY_FAILED;
+		goto out;
+	}
+	if ((observationMemory = shmat(observationShmid, NULL, 0)) == (unsigned char *) -1) {
+		perror("shmat");
+		observationMemory = NULL;
+		observationShmid = -1;
+		ret = REPLY_FAILED;
+		goto out;
+	}
+
+	observationColumns = ObservationBoxes(cropX, cropWidth, width);
+	observationRows = ObservationBoxes(cropY, cropHeight, height);
+	observationCurrent = malloc(size);
+	observationPrevious = malloc(size);
+	observationScratch = malloc(FRAME_WIDTH * FRAME_HEIGHT * FRAME_CHANNELS);
+	if (observationColumns == NULL || observationRows == NULL || observationCurrent == NULL ||
+			observationPrevious == NULL || observationScratch == NULL) {
+		FreeObservation();
+		ret = REPLY_FAILED;
+		goto out;
+	}
+	observationWidth = width;
+	observationHeight = height;
+	observationChannels = channels;
+	observationMaxPool = maxPool;
+
+out:
+	pthread_mutex_unlock(&snapshotLock);
+	return ret;
+}
+
+int FrameObservationFrames() {
+	return observationMaxPool ? 2 : 1;
+}
+
+// Queue a reply to request id once the observation of the frame frames
+// from now is in shared memory, earlier frames are only kept for pooling
+int FrameObservationRequest(u32 id, u32 frames) {
+	int ret = 0;
+
+	pthread_mutex_lock(&snapshotLock);
+	if (observationMemory == NULL) {
+		ret = REPLY_FAILED;
+	} else if (numPendingObservations == MAX_PENDING_SNAPSHOTS) {
+		ret = REPLY_BUSY;
+	} else {
+		pendingObservations[numPendingObservations].id = id;
+		pendingObservations[numPendingObservations].frames = (frames > 0) ? frames : 1;
+		numPendingObservations++;
+	}
+	pthread_mutex_unlock(&snapshotLock);
+
+	return ret;
+}
+
+// Crops and area-averages a bottom-up RGB frame into a top-down observation.
+// Grayscale uses the BT.601 weights and is taken before averaging.
+static void ReduceFrame(const unsigned char *frame, unsigned char *out) {
+	u32 x, y, sx, sy, count;
+	u32 sum[3];
+	const unsigned char *p;
+
+	for (y = 0; y < observationHeight; y++) {
+		u32 rowStart = observationRows[y];
+		u32 rowEnd = observationRows[y + 1] > rowStart ? observationRows[y + 1] : rowStart + 1;
+
+		for (x = 0; x < observationWidth; x++) {
+			u32 columnStart = observationColumns[x];
+			u32 columnEnd = observationColumns[x + 1] > columnStart ? observationColumns[x + 1] : columnStart + 1;
+
+			sum[0] = sum[1] = sum[2] = 0;
+			for (sy = rowStart; sy < rowEnd; sy++) {
+				p = frame + ((FRAME_HEIGHT - 1 - sy) * FRAME_WIDTH + columnStart) * FRAME_CHANNELS;
+				for (sx = columnStart; sx < columnEnd; sx++, p += FRAME_CHANNELS) {
+					if (observationChannels == 1) {
+						sum[0] += 77 * p[0] + 150 * p[1] + 29 * p[2];
+					} else {
+						sum[0] += p[0];
+						sum[1] += p[1];
+						sum[2] += p[2];
+					}
+				}
+			}
+			count = (rowEnd - rowStart) * (columnEnd - columnStart);
+			if (observationChannels == 1) {
+				*out++ = (unsigned char)((sum[0] + count * 128) / (count * 256));
+			} else {
+				*out++ = (unsigned char)((sum[0] + count / 2) / count);
+				*out++ = (unsigned char)((sum[1] + count / 2) / count);
+				*out++ = (unsigned char)((sum[2] + count / 2) / count);
+			}
+		}
+	}
+}
+
+// Called with snapshotLock held once the frame at pixels is complete
+static void ServeObservations(const unsigned char *pixels) {
+	size_t size = (size_t)observationWidth * observationHeight * observationChannels;
+	boolean complete = FALSE;
+	unsigned char *swap;
+	size_t j;
+	int i, kept;
+
+	ReduceFrame(pixels, observationCurrent);
+
+	for (i = 0; i < observationsServed; i++)
+		if (--pendingObservations[i].frames == 0) complete = TRUE;
+
+	if (complete) {
+		// Pool with the frame right before this one, if we reduced it
+		if (observationMaxPool && observationPreviousValid && observationPreviousFrame + 1 == frame_counter) {
+			for (j = 0; j < size; j++)
+				observationMemory[j] = observationCurrent[j] > observationPrevious[j] ?
+					observationCurrent[j] : observationPrevious[j];
+		} else {
+			memcpy(observationMemory, observationCurrent, size);
+		}
+	}
+
+	for (i = 0, kept = 0; i < numPendingObservations; i++) {
+		if (i < observationsServed && pendingObservations[i].frames == 0) {
+			// Id 0 was requested on behalf of a step, it has no request to answer
+			if (pendingObservations[i].id != 0) writeReply(pendingObservations[i].id, 57, REPLY_OK, NULL, 0);
+			continue;
+		}
+		pendingObservations[kept++] = pendingObservations[i];
+	}
+	numPendingObservations = kept;
+
+	swap = observationPrevious;
+	observationPrevious = observationCurrent;
+	observationCurrent = swap;
+	observationPreviousFrame = frame_counter;
+	observationPreviousValid = TRUE;
+}
+
+unsigned char *FrameAcquire(int width, int height) {
+	u64 sequence;
+
+	if (width != FRAME_WIDTH || height != FRAME_HEIGHT) return NULL;
+
+	pthread_mutex_lock(&snapshotLock);
+	snapshotsServed = numPendingSnapshots;
+	snapshotTarget = (snapshotsServed > 0) ? snapshotMemory : NULL;
+	observationsServed = numPendingObservations;
+	pthread_mutex_unlock(&snapshotLock);
+
+	if (ring == NULL) {
+		acquiredPixels = snapshotTarget;
+		if (acquiredPixels == NULL && observationsServed > 0) acquiredPixels = observationScratch;
+		return acquiredPixels;
+	}
+
+	sequence = ring->latest + 1;
+	writingSlot = (FrameSlotHeader *)(ringMemory + ring->headerSize + (sequence % ring->slots) * ring->slotStride);
+	writingSequence = sequence;
+
+	// Invalidate the slot before the pixels start changing underneath readers
+	writingSlot->sequence = 0;
+	__sync_synchronize();
+
+	acquiredPixels = (unsigned char *)writingSlot + ALIGN_UP(sizeof(FrameSlotHeader));
+	return acquiredPixels;
+}
+
+void FramePublish() {
+	int i;
+
+	if (ring != NULL && writingSlot != NULL) {
+		writingSlot->frame = frame_counter;
+		__sync_synchronize();
+		writingSlot->sequence = writingSequence;
+		__sync_synchronize();
+		ring->latest = writingSequence;
+
+		if (snapshotTarget != NULL)
+			memcpy(snapshotTarget, (unsigned char *)writingSlot + ALIGN_UP(sizeof(FrameSlotHeader)),
+				FRAME_WIDTH * FRAME_HEIGHT * FRAME_CHANNELS);
+		writingSlot = NULL;
+	}
+
+	if (observationsServed > 0 && acquiredPixels != NULL) {
+		pthread_mutex_lock(&snapshotLock);
+		ServeObservations(acquiredPixels);
+		observationsServed = 0;
+		pthread_mutex_unlock(&snapshotLock);
+	}
+	acquiredPixels = NULL;
+
+	if (snapshotTarget == NULL) return;
+	snapshotTarget = NULL;
+
+	// Requests that arrived after FrameAcquire wait for the next frame
+	pthread_mutex_lock(&snapshotLock);
+	// Id 0 marks a copy made on behalf of a step, it has no request to answer
+	for (i = 0; i < snapshotsServed; i++)
+		if (pendingSnapshots[i] != 0) writeReply(pendingSnapshots[i], 11, REPLY_OK, NULL, 0);
+	numPendingSnapshots -= snapshotsServed;
+	memmove(pendingSnapshots, pendingSnapshots + snapshotsServed, numPendingSnapshots * sizeof(u32));
+	snapshotsServed = 0;
+	pthread_mutex_unlock(&snapshotLock);
+}
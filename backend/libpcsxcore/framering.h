@@ -0,0 +1,77 @@
+/***************************************************************************
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ *   This program is distributed in the hope that it will be useful,       *
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+ *   GNU General Public License for more details.                          *
+ *                                                                         *
+ *   You should have received a copy of the GNU General Public License     *
+ *   along with this program; if not, write to the                         *
+ *   Free Software Foundation, Inc.,                                       *
+ *   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.           *
+ ***************************************************************************/
+
+#ifndef __FRAMERING_H__
+#define __FRAMERING_H__
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+#include "psxcommon.h"
+
+#define FRAME_RING_MAGIC   0x46585350 // "PSXF"
+#define FRAME_RING_VERSION 1
+#define FRAME_RING_ALIGN   64
+
+#define FRAME_WIDTH    640
+#define FRAME_HEIGHT   480
+#define FRAME_CHANNELS 3
+
+// The layout below is shared with psxle_py, keep the two in step.
+typedef struct {
+	u32 magic;
+	u32 version;
+	u32 slots;
+	u32 width;
+	u32 height;
+	u32 channels;
+	u32 headerSize;  // offset of the first slot
+	u32 slotStride;  // distance between two slots (slot header included)
+	volatile u64 latest; // sequence number of the newest complete slot, 0 = none
+} FrameRingHeader;
+
+typedef struct {
+	volatile u64 sequence; // 0 while being written, else the frame's sequence number
+	u64 frame;             // value of frame_counter when the frame was published
+} FrameSlotHeader;
+
+int FrameRingInit(int key, int slots);
+void FrameRingShutdown();
+int FrameRingActive();
+
+// Queue a reply to request id once the next frame has been copied to key,
+// id 0 copies the frame without replying
+int FrameSnapshotRequest(u32 id, int key);
+int FrameSnapshotRelease();
+int FrameSnapshotPending();
+
+// Observation spec: the crop box (top-down, 0 = up to the edge) is reduced
+// to width x height with 1 (grayscale) or 3 channels into key, key 0 drops it
+int FrameObservationConfigure(int key, u32 width, u32 height, u32 channels,
+		u32 cropX, u32 cropY, u32 cropWidth, u32 cropHeight, boolean maxPool);
+int FrameObservationRequest(u32 id, u32 frames);
+int FrameObservationFrames();
+
+// Handed to the GPU plugin through GPUregisterFrameSink()
+unsigned char *FrameAcquire(int width, int height);
+void FramePublish();
+
+#ifdef __cplusplus
+}
+#endif
+#endif
@@ -26,6 +26,7 @@
 #include "mdec.h"
 #include "ppf.h"
 #include <stddef.h>
+#include <sys/stat.h>
 
 char CdromId[10] = "";
 char CdromLabel[33] = "";
@@ -614,20 +615,48 @@ int LoadLdrFile(const char *LdrPath ) {
 #define PCSXR_HEADER_SZ (10)
 #define SZ_GPUPIC (128 * 96 * 3)
 static const char PcsxrHeader[32] = "STv4 PCSXR v" PACKAGE_VERSION;
+// Delta states hold the RAM and BIOS pages that differ from a full base state
+static const char PcsxrDeltaHeader[32] = "STd2 PCSXR v" PACKAGE_VERSION;
+#define STATE_PAGE_SIZE (4096)
+#define STATE_RAM_PAGES (0x00200000 / STATE_PAGE_SIZE)
+#define STATE_ROM_PAGES (0x00080000 / STATE_PAGE_SIZE)
+#define STATE_DELTA_PAGES (STATE_RAM_PAGES + STATE_ROM_PAGES)
 
 // Savestate Versioning!
 // If you make changes to the savestate version, please increment the value below.
 static const u32 SaveVersion = 0x8b410008;
 
+static const char *StateCodecMode(int codec) {
+	switch (codec) {
+		case STATE_CODEC_NONE: return "wb0T"; // transparent, still readable by gzread
+		case STATE_CODEC_FAST: return "wb1";
+		default: return "wb9"; // Best ratio but slow
+	}
+}
+
 int SaveState(const char *file) {
 	gzFile f;
 	long size;
 
-	f = gzopen(file, "wb9"); // Best ratio but slow
+	f = gzopen(file, StateCodecMode(STATE_CODEC_BEST));
 	if (f == NULL) return -1;
 	return SaveStateGz(f, &size);
 }
 
+// Only the best codec stores the screenshot the GUI shows for a slot, the
+// others write a blank one. With a base, only the changed RAM pages are kept.
+int SaveStateAs(const char *file, int codec, const char *base) {
+	gzFile f;
+	long size;
+
+	// Opening the file truncates it, so it cannot be its own base
+	if (base != NULL && strcmp(file, base) == 0) return -1;
+	f = gzopen(file, StateCodecMode(codec));
+	if (f == NULL) return -1;
+	if (base != NULL && base[0] != '\0') return SaveStateDeltaGz(f, base);
+	return SaveStateGz(f, (codec == STATE_CODEC_BEST) ? &size : NULL);
+}
+
 int LoadState(const char *file) {
 	gzFile f;
 
@@ -684,6 +713,7 @@ Cons of using SHM
 #include <sys/stat.h> /* For mode constants */
 #include <fcntl.h> /* For O_* constants */
 #include <errno.h>
+#include <unistd.h>
 
 #define SHM_SS_NAME_TEMPLATE "/pcsxrmemsavestate%.4u"
 
@@ -732,6 +762,61 @@ int LoadStateMem(const u32 id) {
 	return ret;
 }
 
+// Named slots for the Python bridge. Unlike the rewind states above they
+// are not removed by loading them, and the pid keeps concurrent consoles apart.
+#define SHM_SLOT_NAME_TEMPLATE "/psxle-slot-%d-%u"
+
+// The object can also be read by LoadState as /dev/shm/<name>
+void StateSlotName(const u32 slot, char *name, size_t size) {
+	snprintf(name, size, SHM_SLOT_NAME_TEMPLATE, (int)getpid(), slot);
+}
+
+int SaveStateSlot(const u32 slot, int compress) {
+	char name[48];
+	int ret = -1;
+
+	if (slot >= MAX_STATE_SLOTS) return -1;
+	StateSlotName(slot, name, sizeof(name));
+	int fd = shm_open(name, O_CREAT | O_RDWR | O_TRUNC, 0600);
+
+	if (fd >= 0) {
+		gzFile f = gzdopen(fd, compress ? "wb1" : "wb0T"); // Fastest level or none at all
+		if (f != NULL) {
+			ret = SaveStateGz(f, NULL);
+		} else {
+			close(fd);
+		}
+	}
+	return ret;
+}
+
+int LoadStateSlot(const u32 slot) {
+	char name[48];
+	int ret = -1;
+
+	if (slot >= MAX_STATE_SLOTS) return -1;
+	StateSlotName(slot, name, sizeof(name));
+	int fd = shm_open(name, O_RDONLY, 0400);
+
+	if (fd >= 0) {
+		gzFile f = gzdopen(fd, "rb");
+		if (f != NULL) {
+			ret = LoadStateGz(f);
+		} else {
+			close(fd);
+		}
+	}
+	return ret;
+}
+
+int DeleteStateSlot(const u32 slot) {
+	char name[48];
+
+	if (slot >= MAX_STATE_SLOTS) return -1;
+	StateSlotName(slot, name, sizeof(name));
+	return shm_unlink(name);
+}
+
 void CleanupMemSaveStates() {
 	char name[32];
 	u32 i;
@@ -742,6 +827,7 @@ void CleanupMemSaveStates() {
 			//break;
 		}
 	}
+	for (i=0; i < MAX_STATE_SLOTS; i++) DeleteStateSlot(i);
 	free(gpufP);
 	gpufP = NULL;
 	free(spufP);
@@ -750,28 +836,17 @@ void CleanupMemSaveStates() {
 #else
 int SaveStateMem(const u32 id) {return 0;}
 int LoadStateMem(const u32 id) {return 0;}
+int SaveStateSlot(const u32 slot, int compress) {return -1;}
+int LoadStateSlot(const u32 slot) {return -1;}
+int DeleteStateSlot(const u32 slot) {return -1;}
+void StateSlotName(const u32 slot, char *name, size_t size) {name[0] = '\0';}
 void CleanupMemSaveStates() {}
 #endif
 
-int SaveStateGz(gzFile f, long* gzsize) {
+// Everything from the CPU registers on, shared by full and delta states
+static int SaveStateDevices(gzFile f) {
 	int Size;
-	unsigned char pMemGpuPic[SZ_GPUPIC];
-
-	//if (f == NULL) return -1;
 
-	gzwrite(f, (void *)PcsxrHeader, sizeof(PcsxrHeader));
-	gzwrite(f, (void *)&SaveVersion, sizeof(u32));
-	gzwrite(f, (void *)&Config.HLE, sizeof(boolean));
-
-	if (gzsize)GPU_getScreenPic(pMemGpuPic); // Not necessary with ephemeral saves
-	gzwrite(f, pMemGpuPic, SZ_GPUPIC);
-
-	if (Config.HLE)
-		psxBiosFreeze(1);
-
-	gzwrite(f, psxM, 0x00200000);
-	gzwrite(f, psxR, 0x00080000);
-	gzwrite(f, psxH, 0x00010000);
 	gzwrite(f, (void *)&psxRegs, sizeof(psxRegs));
 
 	// gpu
@@ -791,7 +866,6 @@ int SaveStateGz(gzFile f, long* gzsize) {
 		spufP->Size = Size;
 
 		if (spufP->Size <= 0) {
-			gzclose(f);
 			free(spufP);
 			spufP = NULL;
 			return 1; // error
@@ -808,37 +882,144 @@ int SaveStateGz(gzFile f, long* gzsize) {
 	psxRcntFreeze(f, 1);
 	mdecFreeze(f, 1);
 
+	return 0;
+}
+
+int SaveStateGz(gzFile f, long* gzsize) {
+	unsigned char pMemGpuPic[SZ_GPUPIC];
+
+	//if (f == NULL) return -1;
+
+	gzwrite(f, (void *)PcsxrHeader, sizeof(PcsxrHeader));
+	gzwrite(f, (void *)&SaveVersion, sizeof(u32));
+	gzwrite(f, (void *)&Config.HLE, sizeof(boolean));
+
+	if (gzsize)GPU_getScreenPic(pMemGpuPic); // Not necessary with ephemeral saves
+	else memset(pMemGpuPic, 0, SZ_GPUPIC);
+	gzwrite(f, pMemGpuPic, SZ_GPUPIC);
+
+	if (Config.HLE)
+		psxBiosFreeze(1);
+
+	gzwrite(f, psxM, 0x00200000);
+	gzwrite(f, psxR, 0x00080000);
+	gzwrite(f, psxH, 0x00010000);
+
+	if (SaveStateDevices(f) != 0) {
+		gzclose(f);
+		return 1; // error
+	}
+
 	if(gzsize)*gzsize = gztell(f);
 	gzclose(f);
 
 	return 0;
 }
 
-int LoadStateGz(gzFile f) {
-	SPUFreeze_t *_spufP;
-	int Size;
+// The base RAM is kept between saves, most deltas share a handful of bases.
+// A base re-saved under the same path has to miss the cache, so it is keyed
+// on the file's identity and its nanosecond mtime, not only on the path.
+static char *deltaBasePath = NULL;
+static struct stat deltaBaseStat;
+static unsigned char *deltaBaseRam = NULL;
+
+static int ReadStateRam(const char *file, unsigned char *ram) {
+	gzFile f;
 	char header[sizeof(PcsxrHeader)];
 	u32 version;
 	boolean hle;
+	int ret = -1;
 
+	f = gzopen(file, "rb");
 	if (f == NULL) return -1;
 
 	gzread(f, header, sizeof(header));
 	gzread(f, &version, sizeof(u32));
 	gzread(f, &hle, sizeof(boolean));
 
-	// Compare header only "STv4 PCSXR" part no version
-	if (strncmp(PcsxrHeader, header, PCSXR_HEADER_SZ) != 0 || version != SaveVersion || hle != Config.HLE) {
+	// Deltas are always taken against a full state
+	if (strncmp(PcsxrHeader, header, PCSXR_HEADER_SZ) == 0 && version == SaveVersion && hle == Config.HLE) {
+		gzseek(f, SZ_GPUPIC, SEEK_CUR);
+		// psxM and psxR are stored back to back, like the delta pages
+		if (gzread(f, ram, 0x00280000) == 0x00280000) ret = 0;
+	}
+	gzclose(f);
+
+	return ret;
+}
+
+static unsigned char *DeltaBaseRam(const char *base) {
+	struct stat st;
+
+	if (stat(base, &st) != 0) return NULL;
+	if (deltaBasePath != NULL && strcmp(deltaBasePath, base) == 0 &&
+			st.st_dev == deltaBaseStat.st_dev && st.st_ino == deltaBaseStat.st_ino &&
+			st.st_size == deltaBaseStat.st_size &&
+			st.st_mtim.tv_sec == deltaBaseStat.st_mtim.tv_sec &&
+			st.st_mtim.tv_nsec == deltaBaseStat.st_mtim.tv_nsec)
+		return deltaBaseRam;
+
+	free(deltaBasePath);
+	deltaBasePath = NULL;
+	if (deltaBaseRam == NULL) deltaBaseRam = (unsigned char *)malloc(0x00280000);
+	if (deltaBaseRam == NULL || ReadStateRam(base, deltaBaseRam) != 0) return NULL;
+
+	deltaBasePath = strdup(base);
+	deltaBaseStat = st;
+	return deltaBaseRam;
+}
+
+// Delta pages run over main RAM, then over the BIOS area, where
+// psxBiosFreeze keeps the HLE BIOS state
+static unsigned char *StatePage(u32 i) {
+	if (i < STATE_RAM_PAGES) return (unsigned char *)psxM + i * STATE_PAGE_SIZE;
+	return (unsigned char *)psxR + (i - STATE_RAM_PAGES) * STATE_PAGE_SIZE;
+}
+
+int SaveStateDeltaGz(gzFile f, const char *base) {
+	unsigned char *baseRam;
+	u32 length, pages, i;
+
+	baseRam = DeltaBaseRam(base);
+	if (baseRam == NULL) {
 		gzclose(f);
 		return -1;
 	}
 
-	psxCpu->Reset();
-	gzseek(f, SZ_GPUPIC, SEEK_CUR);
+	gzwrite(f, (void *)PcsxrDeltaHeader, sizeof(PcsxrDeltaHeader));
+	gzwrite(f, (void *)&SaveVersion, sizeof(u32));
+	gzwrite(f, (void *)&Config.HLE, sizeof(boolean));
+
+	length = strlen(base);
+	gzwrite(f, &length, sizeof(u32));
+	gzwrite(f, (void *)base, length);
+
+	if (Config.HLE)
+		psxBiosFreeze(1);
+
+	for (pages = 0, i = 0; i < STATE_DELTA_PAGES; i++)
+		if (memcmp(StatePage(i), baseRam + i * STATE_PAGE_SIZE, STATE_PAGE_SIZE) != 0) pages++;
+	gzwrite(f, &pages, sizeof(u32));
+	for (i = 0; i < STATE_DELTA_PAGES; i++) {
+		if (memcmp(StatePage(i), baseRam + i * STATE_PAGE_SIZE, STATE_PAGE_SIZE) == 0) continue;
+		gzwrite(f, &i, sizeof(u32));
+		gzwrite(f, StatePage(i), STATE_PAGE_SIZE);
+	}
+	gzwrite(f, psxH, 0x00010000);
+
+	if (SaveStateDevices(f) != 0) {
+		gzclose(f);
+		return 1; // error
+	}
+	gzclose(f);
+
+	return 0;
+}
+
+static void LoadStateDevices(gzFile f) {
+	SPUFreeze_t *_spufP;
+	int Size;
 
-	gzread(f, psxM, 0x00200000);
-	gzread(f, psxR, 0x00080000);
-	gzread(f, psxH, 0x00010000);
 	gzread(f, (void *)&psxRegs, sizeof(psxRegs));
 
 	if (Config.HLE)
@@ -861,6 +1042,78 @@ int LoadStateGz(gzFile f) {
 	psxHwFreeze(f, 0);
 	psxRcntFreeze(f, 0);
 	mdecFreeze(f, 0);
+}
+
+static int loadingDelta = 0;
+
+// Loads the base, then lays the delta's pages and devices over it
+static int LoadStateDeltaGz(gzFile f) {
+	char base[MAXPATHLEN];
+	u32 length, pages, page, i;
+
+	gzread(f, &length, sizeof(u32));
+	if (length == 0 || length >= sizeof(base) || gzread(f, base, length) != (int)length) {
+		gzclose(f);
+		return -1;
+	}
+	base[length] = '\0';
+
+	loadingDelta = 1;
+	if (LoadState(base) != 0) {
+		loadingDelta = 0;
+		gzclose(f);
+		return -1;
+	}
+	loadingDelta = 0;
+
+	gzread(f, &pages, sizeof(u32));
+	for (i = 0; i < pages; i++) {
+		if (gzread(f, &page, sizeof(u32)) != sizeof(u32) || page >= STATE_DELTA_PAGES) break;
+		gzread(f, StatePage(page), STATE_PAGE_SIZE);
+	}
+	if (i != pages) {
+		gzclose(f);
+		return -1;
+	}
+	gzread(f, psxH, 0x00010000);
+	LoadStateDevices(f);
+
+	gzclose(f);
+
+	return 0;
+}
+
+int LoadStateGz(gzFile f) {
+	char header[sizeof(PcsxrHeader)];
+	u32 version;
+	boolean hle;
+
+	if (f == NULL) return -1;
+
+	gzread(f, header, sizeof(header));
+	gzread(f, &version, sizeof(u32));
+	gzread(f, &hle, sizeof(boolean));
+
+	if (version != SaveVersion || hle != Config.HLE) {
+		gzclose(f);
+		return -1;
+	}
+	// A delta's base has to be a full state
+	if (!loadingDelta && strncmp(PcsxrDeltaHeader, header, PCSXR_HEADER_SZ) == 0)
+		return LoadStateDeltaGz(f);
+	// Compare header only "STv4 PCSXR" part no version
+	if (strncmp(PcsxrHeader, header, PCSXR_HEADER_SZ) != 0) {
+		gzclose(f);
+		return -1;
+	}
+
+	psxCpu->Reset();
+	gzseek(f, SZ_GPUPIC, SEEK_CUR);
+
+	gzread(f, psxM, 0x00200000);
+	gzread(f, psxR, 0x00080000);
+	gzread(f, psxH, 0x00010000);
+	LoadStateDevices(f);
 
 	gzclose(f);
 
@@ -883,7 +1136,8 @@ int CheckState(const char *file) {
 	gzclose(f);
 
 	// Compare header only "STv4 PCSXR" part no version
-	if (strncmp(PcsxrHeader, header, PCSXR_HEADER_SZ) != 0 || version != SaveVersion || hle != Config.HLE)
+	if ((strncmp(PcsxrHeader, header, PCSXR_HEADER_SZ) != 0 && strncmp(PcsxrDeltaHeader, header, PCSXR_HEADER_SZ) != 0)
+		|| version != SaveVersion || hle != Config.HLE)
 		return -1;
 
 	return 0;
@@ -62,12 +62,23 @@ int CheckCdrom();
 int Load(const char *ExePath);
 int LoadLdrFile(const char *LdrPath);
 
+#define STATE_CODEC_NONE 0
+#define STATE_CODEC_FAST 1
+#define STATE_CODEC_BEST 2
+
 int SaveState(const char *file);
+int SaveStateAs(const char *file, int codec, const char *base);
+int SaveStateDeltaGz(gzFile f, const char *base);
 int SaveStateMem(const u32 id);
 int SaveStateGz(gzFile f, long* gzsize);
 int LoadState(const char *file);
 int LoadStateMem(const u32 id);
 int LoadStateGz(gzFile f);
+#define MAX_STATE_SLOTS 256
+int SaveStateSlot(const u32 slot, int compress); // In-RAM named slots, see misc.c
+int LoadStateSlot(const u32 slot);
+int DeleteStateSlot(const u32 slot);
+void StateSlotName(const u32 slot, char *name, size_t size);
 int CheckState(const char *file);
 
 int SendPcsxInfo();
@@ -60,6 +60,9 @@ GPUvisualVibration    GPU_visualVibration;
 GPUcursor             GPU_cursor;
 GPUaddVertex          GPU_addVertex;
 GPUsetSpeed           GPU_setSpeed;
+GPUregisterFrameSink  GPU_registerFrameSink;
+GPUsetTurbo           GPU_setTurbo;
+GPUskipNextFrame      GPU_skipNextFrame;
 
 CDRinit               CDR_init;
 CDRshutdown           CDR_shutdown;
@@ -116,6 +119,7 @@ PADpoll               PAD1_poll;
 PADsetSensitive       PAD1_setSensitive;
 PADregisterVibration  PAD1_registerVibration;
 PADregisterCursor     PAD1_registerCursor;
+PADsetButtons         PAD1_setButtons;
 
 PADconfigure          PAD2_configure;
 PADabout              PAD2_about;
@@ -221,6 +225,9 @@ void CALLBACK GPU__visualVibration(unsigned long iSmall, unsigned long iBig) {}
 void CALLBACK GPU__cursor(int player, int x, int y) {}
 void CALLBACK GPU__addVertex(short sx,short sy,s64 fx,s64 fy,s64 fz) {}
 void CALLBACK GPU__setSpeed(float newSpeed) {}
+void CALLBACK GPU__registerFrameSink(unsigned char *(*acquire)(int, int), void (*publish)(void)) {}
+void CALLBACK GPU__setTurbo(long enable) {}
+void CALLBACK GPU__skipNextFrame(long skip) {}
 
 #define LoadGpuSym1(dest, name) \
 	LoadSym(GPU_##dest, GPU##dest, name, TRUE);
@@ -269,6 +276,9 @@ static int LoadGPUplugin(const char *GPUdll) {
     LoadGpuSym0(cursor, "GPUcursor");
 	LoadGpuSym0(addVertex, "GPUaddVertex");
 	LoadGpuSym0(setSpeed, "GPUsetSpeed");
+	LoadGpuSym0(registerFrameSink, "GPUregisterFrameSink");
+	LoadGpuSym0(setTurbo, "GPUsetTurbo");
+	LoadGpuSym0(skipNextFrame, "GPUskipNextFrame");
 	LoadGpuSym0(configure, "GPUconfigure");
 	LoadGpuSym0(test, "GPUtest");
 	LoadGpuSym0(about, "GPUabout");
@@ -489,6 +499,7 @@ long CALLBACK PAD1__query(void) { return 3; }
 long CALLBACK PAD1__keypressed() { return 0; }
 void CALLBACK PAD1__registerVibration(void (CALLBACK *callback)(unsigned long, unsigned long)) {}
 void CALLBACK PAD1__registerCursor(void (CALLBACK *callback)(int, int, int)) {}
+void CALLBACK PAD1__setButtons(int pad, unsigned short pressed) {}
 
 #define LoadPad1Sym1(dest, name) \
 	LoadSym(PAD1_##dest, PAD##dest, name, TRUE);
@@ -525,6 +536,7 @@ static int LoadPAD1plugin(const char *PAD1dll) {
 	LoadPad1SymN(setSensitive, "PADsetSensitive");
     LoadPad1Sym0(registerVibration, "PADregisterVibration");
     LoadPad1Sym0(registerCursor, "PADregisterCursor");
+    LoadPad1Sym0(setButtons, "PADsetButtons");
 
 	return 0;
 }
@@ -100,6 +100,9 @@ typedef void (CALLBACK* GPUvisualVibration)(uint32_t, uint32_t);
 typedef void (CALLBACK* GPUcursor)(int, int, int);
 typedef void (CALLBACK* GPUaddVertex)(short,short,s64,s64,s64);
 typedef void (CALLBACK* GPUsetSpeed)(float); // 1.0 = natural speed
+typedef void (CALLBACK* GPUregisterFrameSink)(unsigned char *(*)(int, int), void (*)(void));
+typedef void (CALLBACK* GPUsetTurbo)(long);
+typedef void (CALLBACK* GPUskipNextFrame)(long);
 
 // GPU function pointers
 extern GPUupdateLace    GPU_updateLace;
@@ -130,6 +133,9 @@ extern GPUvisualVibration GPU_visualVibration;
 extern GPUcursor        GPU_cursor;
 extern GPUaddVertex     GPU_addVertex;
 extern GPUsetSpeed     GPU_setSpeed;
+extern GPUregisterFrameSink GPU_registerFrameSink;
+extern GPUsetTurbo      GPU_setTurbo;
+extern GPUskipNextFrame GPU_skipNextFrame;
 
 // CD-ROM Functions
 typedef long (CALLBACK* CDRinit)(void);
@@ -255,6 +261,7 @@ typedef unsigned char (CALLBACK* PADpoll)(unsigned char);
 typedef void (CALLBACK* PADsetSensitive)(int);
 typedef void (CALLBACK* PADregisterVibration)(void (CALLBACK *callback)(uint32_t, uint32_t));
 typedef void (CALLBACK* PADregisterCursor)(void (CALLBACK *callback)(int, int, int));
+typedef void (CALLBACK* PADsetButtons)(int, unsigned short);
 
 // PAD function pointers
 extern PADconfigure        PAD1_configure;
@@ -272,6 +279,7 @@ extern PADpoll             PAD1_poll;
 extern PADsetSensitive     PAD1_setSensitive;
 extern PADregisterVibration PAD1_registerVibration;
 extern PADregisterCursor   PAD1_registerCursor;
+extern PADsetButtons       PAD1_setButtons;
 extern PADconfigure        PAD2_configure;
 extern PADabout            PAD2_about;
 extern PADinit             PAD2_init;
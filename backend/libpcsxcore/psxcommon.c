@@ -34,6 +34,8 @@ FILE *emuLog = NULL;
 u32 rewind_counter=0;
 u8 vblank_count_hideafter=0;
 
+u64 frame_counter=0;
+
 int EmuInit(int* inputHooks, int nHooks, char* uniquePipeName) {
 	return psxInit(inputHooks, nHooks, uniquePipeName);
 }
@@ -58,6 +60,8 @@ void EmuShutdown() {
 }
 
 void EmuUpdate() {
+	frame_counter++;
+
 	// Do not allow hotkeys inside a softcall from HLE BIOS
 	if (!Config.HLE || !hleSoftCall)
 		SysUpdate();
@@ -174,6 +174,9 @@ extern boolean NetOpened;
 extern u32 rewind_counter;
 extern u8 vblank_count_hideafter;
 
+// Number of emulated vsyncs since boot
+extern u64 frame_counter;
+
 #define gzfreeze(ptr, size) { \
 	if (Mode == 1) gzwrite(f, ptr, size); \
 	if (Mode == 0) gzread(f, ptr, size); \
@@ -43,6 +43,10 @@ s8 *psxH = NULL; // Scratch Pad (1K) & Hardware Registers (8K)
 u8 **psxMemWLUT = NULL;
 u8 **psxMemRLUT = NULL;
 
+// When set (-ramShm NAME), psxM lives in a named POSIX shared memory
+// object so that the Python bridge can map main RAM directly.
+char *ramSharedMemoryName = NULL;
+
 /*  Playstation Memory Map (from Playstation doc by Joshua Walker)
 0x0000_0000-0x0000_ffff		Kernel (64K)
 0x0001_0000-0x001f_ffff		User Memory (1.9 Meg)
@@ -75,93 +79,295 @@ typedef struct {
 	char* last;
 	char newonly;
 	char buffer;
+	int window;   // buffered hooks push at most once per window frames
+	u64 lastPush; // frame_counter at the last push
 } MemoryHook;
 
 
-MemoryHook* hooks;
+// Only the emulation thread changes the set of hooks, and it holds
+// hookTableLock while doing so. Other threads hold it to look hooks up.
+MemoryHook** hooks;
 int numHooks;
+pthread_mutex_t hookTableLock = PTHREAD_MUTEX_INITIALIZER;
 int hookMin;
 int hookMax;
-int flushMemory = 0;
+
+// Hooks indexed by the 256 byte page they cover, so that a write only visits
+// the hooks on its own page. Page p's hooks are
+// hookPageList[hookPageStart[p]] .. hookPageList[hookPageStart[p+1]-1].
+#define HOOK_PAGE_SHIFT 8
+int* hookPageStart;
+int* hookPageList;
+int numHookPages;
 
 pthread_mutex_t memPipeLock;
-char speakerPipeName[64];
+
+// Events of the current frame, behind room for their header. Guarded by
+// memPipeLock and sent early if they outgrow EVENT_BATCH_LIMIT.
+#define EVENT_BATCH_LIMIT 0x100000
+char* eventBatch;
+u32 eventBatchSize;
+u32 eventBatchLength;
+u32 eventBatchCount;
+u64 eventBatchFrame;
+char speakerPipeName[MAXPATHLEN];
 int memPipe;
 int isRecordingMemory;
 
-pthread_t SpeakerOfTheMemoryThread;
 
+static int findMemoryHook(int keyv);
 
 void silenceMemoryNotification(int keyv){
-	int k = -1;
-	for (int i=0; i<numHooks; i++){
-		if (hooks[i].key == keyv){
-			k = i;
-			break;
-		}
+	pthread_mutex_lock(&hookTableLock);
+	int k = findMemoryHook(keyv);
+	if (k != -1){
+		pthread_mutex_lock(&(hooks[k]->lock));
+		hooks[k]->state = MEM_SILENCED;
+		pthread_mutex_unlock(&(hooks[k]->lock));
 	}
-	if (k == -1) return;
-	pthread_mutex_lock(&(hooks[k].lock));
-	hooks[k].state = MEM_SILENCED;
-	pthread_mutex_unlock(&(hooks[k].lock));
+	pthread_mutex_unlock(&hookTableLock);
 }
 
 void unsilenceMemoryNotification(int keyv){
-	int k = -1;
-	for (int i=0; i<numHooks; i++){
-		if (hooks[i].key == keyv){
-			k = i;
-			break;
-		}
+	pthread_mutex_lock(&hookTableLock);
+	int k = findMemoryHook(keyv);
+	if (k != -1){
+		pthread_mutex_lock(&(hooks[k]->lock));
+		hooks[k]->state = MEM_NO_CHANGES;
+		pthread_mutex_unlock(&(hooks[k]->lock));
 	}
-	if (k == -1) return;
-	pthread_mutex_lock(&(hooks[k].lock));
-	hooks[k].state = MEM_NO_CHANGES;
-	pthread_mutex_unlock(&(hooks[k].lock));
+	pthread_mutex_unlock(&hookTableLock);
 }
 
 
+// memPipeLock must be held
+static void sendEventBatch(){
+	EventBatchHeader header;
+
+	if (eventBatchCount == 0) return;
+	memset(&header, 0, sizeof(EventBatchHeader));
+	header.marker = EVENT_MARKER;
+	header.count = eventBatchCount;
+	header.length = eventBatchLength - sizeof(EventBatchHeader);
+	header.cycle = psxRegs.cycle;
+	header.frame = eventBatchFrame;
+	memcpy(eventBatch, &header, sizeof(EventBatchHeader));
+
+	write(memPipe, eventBatch, eventBatchLength);
+	eventBatchLength = sizeof(EventBatchHeader);
+	eventBatchCount = 0;
+}
+
+void flushMemoryEvents(){
+	if (!isRecordingMemory) return;
+	pthread_mutex_lock(&memPipeLock);
+	sendEventBatch();
+	pthread_mutex_unlock(&memPipeLock);
+}
+
 void writeStatusNotification(int type){
 
 	char keyv[1];
 	keyv[0] = (char) type;
 	pthread_mutex_lock(&memPipeLock);
+	// Anything that happened before the notification is sent before it
+	sendEventBatch();
 	write(memPipe, keyv, sizeof(char));
 	pthread_mutex_unlock(&memPipeLock);
 }
 
-void writeMemoryNotification(int i){
+void writeReply(u32 id, int opcode, int status, const void *data, u32 length){
 
-	int length = hooks[i].length;
-	char* memory = hooks[i].value;
+	ReplyHeader header;
+	header.marker = REPLY_MARKER;
+	header.opcode = (u8) opcode;
+	header.status = (u8) status;
+	header.reserved = 0;
+	header.id = id;
+	header.length = length;
 
-	char keyv[2];
 	pthread_mutex_lock(&memPipeLock);
+	sendEventBatch();
+	write(memPipe, &header, sizeof(ReplyHeader));
+	if (length > 0) write(memPipe, data, length);
+	pthread_mutex_unlock(&memPipeLock);
+}
 
-	keyv[0] = (char) 0;
-	keyv[1] = (char) hooks[i].key;
+void writeMemoryNotification(int i){
 
-	write(memPipe, keyv, 2*sizeof(char));
-  write(memPipe, memory, length);
+	u32 length = hooks[i]->length;
+	u32 entry = 1 + sizeof(u32) + length;
+	char* memory = hooks[i]->value;
+
+	pthread_mutex_lock(&memPipeLock);
+	if (eventBatchLength + entry > eventBatchSize) sendEventBatch();
+	if (eventBatchLength + entry > eventBatchSize){
+		// Only a listener larger than the whole batch gets here
+		u32 size = eventBatchLength + entry;
+		char* grown = realloc(eventBatch, size);
+		if (grown == NULL){
+			pthread_mutex_unlock(&memPipeLock);
+			return;
+		}
+		eventBatch = grown;
+		eventBatchSize = size;
+	}
+	if (eventBatchCount == 0) eventBatchFrame = frame_counter;
+	eventBatch[eventBatchLength] = (char) hooks[i]->key;
+	memcpy(eventBatch + eventBatchLength + 1, &length, sizeof(u32));
+	memcpy(eventBatch + eventBatchLength + 1 + sizeof(u32), memory, length);
+	eventBatchLength += entry;
+	eventBatchCount++;
 	pthread_mutex_unlock(&memPipeLock);
 }
 
-void* SpeakerOfMemoryFunction(void){
+static void buildHookPages(){
+	int p, total = 0;
+	int* cursor;
+
+	free(hookPageStart);
+	free(hookPageList);
+	hookMin = 2097136;
+	hookMax = 0;
+	for (int i=0; i<numHooks; i++){
+		if (hooks[i]->startindex < hookMin) hookMin = hooks[i]->startindex;
+		if ((hooks[i]->startindex + hooks[i]->length) > hookMax) hookMax = hooks[i]->startindex + hooks[i]->length;
+	}
 
+	numHookPages = (hookMax > 0) ? ((hookMax - 1) >> HOOK_PAGE_SHIFT) + 1 : 0;
+	hookPageStart = calloc(numHookPages + 1, sizeof(int));
+	cursor = calloc(numHookPages + 1, sizeof(int));
 
-	while(flushMemory==1){
-		for (int i=0; i<numHooks; i++){
-			MemoryHook h = hooks[i];
-			if (h.state != MEM_UNPUSHED_CHANGES) continue;
-			pthread_mutex_lock(&(hooks[i].lock));
-			writeMemoryNotification(i);
-			hooks[i].state = MEM_NO_CHANGES;
-			pthread_mutex_unlock(&(hooks[i].lock));
+	// Count the hooks on each page, then place them
+	for (int i=0; i<numHooks; i++){
+		if (hooks[i]->length <= 0) continue;
+		for (p = hooks[i]->startindex >> HOOK_PAGE_SHIFT; p <= (hooks[i]->startindex + hooks[i]->length - 1) >> HOOK_PAGE_SHIFT; p++){
+			hookPageStart[p+1]++;
+		}
+	}
+	for (p = 0; p < numHookPages; p++){
+		hookPageStart[p+1] += hookPageStart[p];
+		cursor[p] = hookPageStart[p];
+	}
+	total = hookPageStart[numHookPages];
+	hookPageList = malloc((total > 0 ? total : 1) * sizeof(int));
+	for (int i=0; i<numHooks; i++){
+		if (hooks[i]->length <= 0) continue;
+		for (p = hooks[i]->startindex >> HOOK_PAGE_SHIFT; p <= (hooks[i]->startindex + hooks[i]->length - 1) >> HOOK_PAGE_SHIFT; p++){
+			hookPageList[cursor[p]++] = i;
 		}
-		usleep(1000*400);
+	}
+	free(cursor);
+}
+
+static int findMemoryHook(int keyv){
+	for (int i=0; i<numHooks; i++){
+		if (hooks[i]->key == keyv) return i;
+	}
+	return -1;
+}
+
+// Adds a hook described by a listener record (start, length, then key,
+// newonly, buffer and window bytes). The page index is left to the caller.
+static int insertMemoryHook(int* vHook){
+	int st = vHook[0], len = vHook[1];
+	unsigned char key = ((char*) (vHook+2))[0];
+	unsigned char newonly = ((char*) (vHook+2))[1];
+	unsigned char allowbuffer = ((char*) (vHook+2))[2];
+	unsigned char window = ((char*) (vHook+2))[3];
+	int state = ((key>>7)==(char)1)?MEM_SILENCED:MEM_NO_CHANGES;
+	MemoryHook** grown;
+	MemoryHook* h;
+
+	if (st < 0 || len <= 0 || findMemoryHook(key & 127) != -1) return -1;
+	grown = realloc(hooks, (numHooks + 1) * sizeof(MemoryHook*));
+	if (grown == NULL) return -1;
+	hooks = grown;
+	h = malloc(sizeof(MemoryHook));
+	if (h == NULL) return -1;
+
+	h->startindex = st;
+	h->length = len;
+	h->last = (newonly==1)?malloc(len*sizeof(char)):NULL;
+	h->key = (int) ((key)&((char) 127));
+	h->newonly = newonly;
+	h->buffer = allowbuffer;
+	h->window = (window > 0) ? window : 1;
+	h->lastPush = 0;
+	printf("Added memhook: (%i, %i, %i, %i) buffer:%i window:%i newonly:%i\n", st, len, h->key, state, allowbuffer, h->window, newonly);
+	h->state = MEM_NO_CHANGES;
+	pthread_mutex_init(&(h->lock), NULL);
+	h->value = NULL;
+
+	hooks[numHooks++] = h;
+	return 0;
+}
+
+// Adding and removing hooks at run time happens between frames, on the
+// emulation thread
+int addMemoryHook(int* record){
+	int ret;
+
+	if (!isRecordingMemory) return -1;
+	pthread_mutex_lock(&hookTableLock);
+	ret = insertMemoryHook(record);
+	if (ret == 0) buildHookPages();
+	pthread_mutex_unlock(&hookTableLock);
+	return ret;
+}
+
+int removeMemoryHook(int keyv){
+	int k;
+	MemoryHook* h;
 
+	if (!isRecordingMemory) return -1;
+	pthread_mutex_lock(&hookTableLock);
+	k = findMemoryHook(keyv);
+	if (k == -1){
+		pthread_mutex_unlock(&hookTableLock);
+		return -1;
 	}
-	pthread_exit(NULL);
+	h = hooks[k];
+	memmove(hooks + k, hooks + k + 1, (numHooks - k - 1) * sizeof(MemoryHook*));
+	numHooks--;
+	buildHookPages();
+	pthread_mutex_unlock(&hookTableLock);
+
+	pthread_mutex_destroy(&(h->lock));
+	free(h->last);
+	free(h);
+	return 0;
+}
+
+void lockMemoryHooks(){
+	pthread_mutex_lock(&hookTableLock);
+}
+
+void unlockMemoryHooks(){
+	pthread_mutex_unlock(&hookTableLock);
+}
+
+// Called at every vsync. Once a buffered hook's window has passed, changes
+// held back since its last push go out now, and a hook that saw none is
+// ready to push its next change straight away. Then the frame's events
+// are sent as one record.
+void flushMemoryNotifications(){
+	if (!isRecordingMemory) return;
+	for (int i=0; i<numHooks; i++){
+		MemoryHook* h = hooks[i];
+		if ((h->state != MEM_UNPUSHED_CHANGES) && (h->state != MEM_PUSHED_CHANGES)) continue;
+		if (frame_counter - h->lastPush < (u64) h->window) continue;
+		pthread_mutex_lock(&(h->lock));
+		if (h->state == MEM_UNPUSHED_CHANGES){
+			writeMemoryNotification(i);
+			h->state = MEM_PUSHED_CHANGES;
+			h->lastPush = frame_counter;
+		}else if (h->state == MEM_PUSHED_CHANGES){
+			h->state = MEM_NO_CHANGES;
+		}
+		pthread_mutex_unlock(&(h->lock));
+	}
+	flushMemoryEvents();
 }
 
 
@@ -179,52 +385,49 @@ int psxMemInit(int* inputHooks, int nHooks, char* uniquePipeName) {
 	if (strcmp(uniquePipeName, "none") == 0) isRecordingMemory = 0;
 
 	if (isRecordingMemory){
-		sprintf(speakerPipeName, "%s-mem", uniquePipeName);
+		snprintf(speakerPipeName, sizeof(speakerPipeName), "%s-mem", uniquePipeName);
 	  int k = mkfifo(speakerPipeName, 0666);
 	  memPipe = open(speakerPipeName, O_WRONLY);
 		printf("[C] Attatched Memory Callback Pipe\n");
 		pthread_mutex_init(&memPipeLock, NULL);
+		eventBatchSize = EVENT_BATCH_LIMIT;
+		eventBatch = malloc(eventBatchSize);
+		eventBatchLength = sizeof(EventBatchHeader);
+		eventBatchCount = 0;
 
-		char* p;
-		char* ptr;
-		u32 t;
-		hookMin = 2097136;
-		hookMax = 0;
-		hooks = malloc(nHooks * sizeof(MemoryHook));
-		numHooks = nHooks;
+		hooks = NULL;
+		numHooks = 0;
 		int* vHook = inputHooks;
 		for (int i=0; i<nHooks; i++){
-			int st = vHook[0], len = vHook[1];
-			unsigned char key = ((char*) (vHook+2))[0];
-			unsigned char newonly = ((char*) (vHook+2))[1];
-			unsigned char allowbuffer = ((char*) (vHook+2))[2];
-			int state = ((key>>7)==(char)1)?MEM_SILENCED:MEM_NO_CHANGES;
-			hooks[i].startindex = st;
-			hooks[i].length = len;
-			hooks[i].last = (newonly==1)?malloc(len*sizeof(char)):NULL;
-			hooks[i].key = (int) ((key)&((char) 127));
-			hooks[i].newonly = newonly;
-			hooks[i].buffer = allowbuffer;
-			printf("Added memhook: (%i, %i, %i, %i) buffer:%i newonly:%i\n", st, len, hooks[i].key, state, allowbuffer, newonly);
-			hooks[i].state = MEM_NO_CHANGES;
-			pthread_mutex_init(&(hooks[i].lock), NULL);
-			hooks[i].value = NULL;
-
-			if (st < hookMin) hookMin = st;
-			if ((st+len) > hookMax) hookMax = st+len;
+			insertMemoryHook(vHook);
 			vHook+=3;
 		}
-
-		flushMemory = 1;
-		pthread_create(&SpeakerOfTheMemoryThread, NULL, SpeakerOfMemoryFunction, NULL);
+		buildHookPages();
 	}
 
 
-	psxM = mmap(0, 0x00220000,
-		PROT_WRITE | PROT_READ, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+	if (ramSharedMemoryName != NULL) {
+		// Owner only, like every segment psxle_py creates. The name is unique
+		// per console, so an existing object is somebody else's and refused.
+		int fd = shm_open(ramSharedMemoryName, O_CREAT | O_EXCL | O_RDWR, 0600);
+		if (fd < 0 || ftruncate(fd, 0x00220000) != 0) {
+			perror("shm_open");
+			if (fd >= 0) close(fd);
+			psxM = MAP_FAILED;
+		} else {
+			psxM = mmap(0, 0x00220000,
+				PROT_WRITE | PROT_READ, MAP_SHARED, fd, 0);
+			close(fd);
+			printf("[C] Main RAM shared as %s\n", ramSharedMemoryName);
+		}
+	} else {
+		psxM = mmap(0, 0x00220000,
+			PROT_WRITE | PROT_READ, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+	}
+	if (psxM == MAP_FAILED) psxM = NULL;
 
-	psxP = &psxM[0x200000];
-	psxH = &psxM[0x210000];
+	psxP = (psxM != NULL) ? &psxM[0x200000] : NULL;
+	psxH = (psxM != NULL) ? &psxM[0x210000] : NULL;
 
 	psxR = (s8 *)malloc(0x00080000);
 
@@ -302,12 +505,10 @@ void psxMemReset() {
 
 void psxMemShutdown() {
 	munmap(psxM, 0x00220000);
-
-	flushMemory = 0;
+	if (ramSharedMemoryName != NULL) shm_unlink(ramSharedMemoryName);
 
 	if (isRecordingMemory){
 		printf("Closing memory pipe.\n");
-		pthread_join(SpeakerOfTheMemoryThread, NULL);
 	  close(memPipe);
 	  unlink(speakerPipeName);
 	}
@@ -418,29 +619,45 @@ void logValue(u32 v){
 	fprintf(logMem, "%i\n", v);
 }
 
+static void notifyHook(int i, u32 mem, int j){
+	MemoryHook* h = hooks[i];
+	if ((h->state == MEM_UNPUSHED_CHANGES) || (h->state == MEM_SILENCED)) return;
+	// Signed compare, block writes make j larger than startindex
+	if (((s64) mem <= (s64) h->startindex - j) || (mem >= (h->startindex+h->length))) return;
+	pthread_mutex_lock(&(h->lock));
+	// DEBUG: if (h->value != NULL) printf("Notification for %i state %i Comparison:%i Value=%i \n",i, h->state, memcmp(h->last, h->value, h->length), ((int*) h->value)[0]);
+	if ((h->newonly == 1)&&(h->value != NULL)&&(memcmp(h->last, h->value, h->length) == 0)){
+		pthread_mutex_unlock(&(h->lock));
+		return;
+	}
+	if (h->state == MEM_NO_CHANGES){
+		if (h->buffer == 1){
+			h->state = MEM_PUSHED_CHANGES;
+			h->lastPush = frame_counter;
+		}
+		if (h->value == NULL) h->value = (char*) psxMemPointer(h->startindex);
+		writeMemoryNotification(i);
+	}else if (h->state == MEM_PUSHED_CHANGES){
+		h->state = MEM_UNPUSHED_CHANGES;
+	}
+	if (h->newonly == 1) memcpy(h->last, h->value, h->length);
+	pthread_mutex_unlock(&(h->lock));
+}
+
 void writingTo(u32 mem, int j){
 	if (isRecordingMemory){
-		if ((mem <= (hookMin-j)) || (mem >= hookMax)) return;
-		for (int i=0; i<numHooks; i++){
-			MemoryHook h = hooks[i];
-			if ((h.state == MEM_UNPUSHED_CHANGES) || (h.state == MEM_SILENCED)) continue;
-			pthread_mutex_lock(&(hooks[i].lock));
-			if ((mem > h.startindex-j) && (mem < (h.startindex+h.length))){
-				// DEBUG: if (h.value != NULL) printf("Notification for %i state %i Comparison:%i Value=%i \n",i, h.state, memcmp(h.last, h.value, h.length), ((int*) h.value)[0]);
-				if ((h.newonly == 1)&&(h.value != NULL)&&(memcmp(h.last, h.value, h.length) == 0)){
-					pthread_mutex_unlock(&(hooks[i].lock));
-					continue;
-				}
-				if (h.state == MEM_NO_CHANGES){
-					if (h.buffer == 1) hooks[i].state = MEM_PUSHED_CHANGES;
-					if (h.value == NULL) hooks[i].value = (char*) psxMemPointer(h.startindex);
-					writeMemoryNotification(i);
-				}else if (h.state == MEM_PUSHED_CHANGES){
-					hooks[i].state = MEM_UNPUSHED_CHANGES;
-				}
-				if (h.newonly == 1) memcpy(h.last, hooks[i].value, h.length);
+		// Signed compare, block writes make j larger than hookMin
+		if (((s64) mem <= (s64) hookMin - j) || (mem >= hookMax)) return;
+		if (((mem + j - 1) >> HOOK_PAGE_SHIFT) == (mem >> HOOK_PAGE_SHIFT)){
+			int page = mem >> HOOK_PAGE_SHIFT;
+			for (int k = hookPageStart[page]; k < hookPageStart[page+1]; k++){
+				notifyHook(hookPageList[k], mem, j);
+			}
+		}else{
+			// Block writes spanning pages are rare, visit every hook once
+			for (int i=0; i<numHooks; i++){
+				notifyHook(i, mem, j);
 			}
-			pthread_mutex_unlock(&(hooks[i].lock));
 		}
 	}
 }
@@ -574,6 +791,43 @@ void psxMemWrite32(u32 mem, u32 value) {
 	}
 }
 
+// Host pointer to the length bytes at mem, or NULL when they are not one
+// contiguous block of host memory (unmapped page, mirror boundary, ...)
+void *psxMemReadPointer(u32 mem, u32 length) {
+	u8 *p;
+	u32 t, last, i;
+
+	if (length == 0 || mem + length - 1 < mem) return NULL;
+	t = mem >> 16;
+	last = (mem + length - 1) >> 16;
+	if (t == 0x1f80 || t == 0x9f80 || t == 0xbf80) {
+		// Scratchpad only, the hardware registers have side effects
+		if ((mem & 0xffff) + length <= 0x400)
+			return (void *)&psxH[mem & 0xffff];
+		return NULL;
+	}
+	p = psxMemRLUT[t];
+	if (p == NULL) return NULL;
+	for (i = t + 1; i <= last; i++) {
+		if (psxMemRLUT[i] != p + ((i - t) << 16)) return NULL;
+	}
+	return (void *)(p + (mem & 0xffff));
+}
+
+// Copy a whole buffer into PSX memory. Only RAM, the parallel port and the
+// scratchpad can be written, a range that touches anything else is refused.
+int psxMemWriteBlock(u32 mem, const void *data, u32 length) {
+	u8 *p = psxMemReadPointer(mem, length);
+
+	if (p == NULL || p < (u8 *)psxM || p + length > (u8 *)psxM + 0x00220000) return -1;
+	memcpy(p, data, length);
+	writingTo(mem & 0xffffff, length);
+#ifdef PSXREC
+	psxCpu->Clear(mem & ~3, ((mem & 3) + length + 3) / 4);
+#endif
+	return 0;
+}
+
 void *psxMemPointer(u32 mem) {
 	char *p;
 	u32 t;
@@ -112,6 +112,8 @@ extern s8 *psxH;
 extern u8 **psxMemWLUT;
 extern u8 **psxMemRLUT;
 
+extern char *ramSharedMemoryName;
+
 #define PSXM(mem)		(psxMemRLUT[(mem) >> 16] == 0 ? NULL : (u8*)(psxMemRLUT[(mem) >> 16] + ((mem) & 0xffff)))
 #define PSXMs8(mem)		(*(s8 *)PSXM(mem))
 #define PSXMs16(mem)	(SWAP16(*(s16 *)PSXM(mem)))
@@ -126,13 +128,68 @@ extern u8 **psxMemRLUT;
 #define PSXREC
 #endif
 
+// Every request on the -proc pipe starts with this header and is followed
+// by `length` bytes of payload. Integers are little endian.
+#define PROTOCOL_VERSION 2
+
+typedef struct {
+	u8 version;
+	u8 opcode;
+	u16 reserved;
+	u32 id;
+	u32 length;
+} RequestHeader;
+
+// Replies to -proc requests share the -mem pipe with status notifications
+// and listener updates, they are told apart by their first byte.
+#define REPLY_MARKER 0xff
+
+enum {
+	REPLY_OK = 0,
+	REPLY_FAILED,
+	REPLY_UNKNOWN_OPCODE,
+	REPLY_BUSY,
+	REPLY_BAD_REQUEST
+};
+
+typedef struct {
+	u8 marker;
+	u8 opcode;
+	u8 status;
+	u8 reserved;
+	u32 id;
+	u32 length;
+} ReplyHeader;
+
+// Listener updates are sent once per frame as one record: this header, then
+// `length` bytes holding `count` events, each a key byte, a u32 byte count
+// and the listener's memory as it was right after the write. The count lets
+// the reader skip events of a listener it no longer knows.
+#define EVENT_MARKER 0xfe
+
+typedef struct {
+	u8 marker;
+	u8 reserved[3];
+	u32 count;
+	u32 length;
+	u32 cycle; // psxRegs.cycle when the record was sent
+	u64 frame; // frame_counter when its first event happened
+} EventBatchHeader;
+
 int psxMemInit();
 void psxMemReset();
 void psxMemShutdown();
 
 void silenceMemoryNotification(int keyv);
 void unsilenceMemoryNotification(int keyv);
+void flushMemoryNotifications();
+int addMemoryHook(int* record);
+int removeMemoryHook(int keyv);
+void lockMemoryHooks();
+void unlockMemoryHooks();
+void flushMemoryEvents();
 void writeStatusNotification(int type);
+void writeReply(u32 id, int opcode, int status, const void *data, u32 length);
 
 u8 psxMemRead8 (u32 mem);
 u16 psxMemRead16(u32 mem);
@@ -141,6 +198,8 @@ void psxMemWrite8 (u32 mem, u8 value);
 void psxMemWrite16(u32 mem, u16 value);
 void psxMemWrite32(u32 mem, u32 value);
 void *psxMemPointer(u32 mem);
+void *psxMemReadPointer(u32 mem, u32 length);
+int psxMemWriteBlock(u32 mem, const void *data, u32 length);
 
 #ifdef __cplusplus
 }
@@ -29,6 +29,8 @@
 
 R3000Acpu *psxCpu = NULL;
 psxRegisters psxRegs;
+boolean psxExitPending = FALSE;
+jmp_buf psxExitPoint;
 
 int psxInit(int* inputHooks, int nHooks, char* uniquePipeName) {
 	SysPrintf(_("Running PCSXR Version %s (%s).\n"), PACKAGE_VERSION, __DATE__);
@@ -230,6 +232,12 @@ void psxBranchTest() {
 			}
 		}
 	}
+
+	// HLE softcalls run a nested loop of their own, only leave the outer one
+	if (psxExitPending && !hleSoftCall) {
+		psxExitPending = FALSE;
+		longjmp(psxExitPoint, 1);
+	}
 }
 
 void psxJumpTest() {
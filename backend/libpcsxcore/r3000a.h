@@ -28,6 +28,7 @@ extern "C" {
 #include "psxmem.h"
 #include "psxcounters.h"
 #include "psxbios.h"
+#include <setjmp.h>
 
 typedef struct {
 	int  (*Init)();
@@ -180,6 +181,11 @@ typedef struct {
 
 extern psxRegisters psxRegs;
 
+// Set to leave psxCpu->Execute() through psxExitPoint at the end of the next
+// branch test, where psxRegs is consistent and no compiled block is running
+extern boolean psxExitPending;
+extern jmp_buf psxExitPoint;
+
 /*
 Formula One 2001
 - Use old CPU cache code when the RAM location is
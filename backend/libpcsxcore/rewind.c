@@ -0,0 +1,334 @@
+/***************************************************************************
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ *   This program is distributed in the hope that it will be useful,       *
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+ *   GNU General Public License for more details.                          *
+ *                                                                         *
+ *   You should have received a copy of the GNU General Public License     *
+ *   along with this program; if not, write to the                         *
+ *   Free Software Foundation, Inc.,                                       *
+ *   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.           *
+ ***************************************************************************/
+
+/*
+* Rewind ring driven by the Python bridge.
+*
+* Only the newest capture is kept whole, as an uncompressed state image.
+* Every older capture is a reverse delta: the pages of the image that
+* changed by the time the next capture was taken. Rewinding lays those
+* pages back over the newest image one capture at a time, then loads it.
+*
+* States are written to and read from an unlinked shm object through the
+* usual SaveStateGz/LoadStateGz, with transparent (uncompressed) gzip.
+*/
+
+#include "rewind.h"
+#include "misc.h"
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <pthread.h>
+
+#define MAX_REWIND_CAPACITY 65536
+
+typedef struct {
+	u32 size;            // size of the image this entry rebuilds
+	u32 pages;
+	u32 *index;
+	unsigned char *data; // pages * REWIND_PAGE_SIZE bytes
+} RewindEntry;
+
+static pthread_mutex_t rewindLock = PTHREAD_MUTEX_INITIALIZER;
+static u32 rewindInterval = 0;
+static u32 rewindCapacity = 0;
+static u32 framesUntilCapture = 0;
+
+static int scratchFd = -1;
+
+static unsigned char *latest = NULL;
+static u32 latestSize = 0;
+
+// Circular, oldest at entriesHead, at most rewindCapacity - 1 entries
+static RewindEntry *entries = NULL;
+static u32 entriesHead = 0;
+static u32 numEntries = 0;
+static u64 entryBytes = 0;
+
+static u32 *changedPages = NULL;
+static u32 changedPagesSize = 0;
+
+static void FreeEntry(RewindEntry *e) {
+	entryBytes -= (u64)e->pages * (REWIND_PAGE_SIZE + sizeof(u32));
+	free(e->index);
+	free(e->data);
+	memset(e, 0, sizeof(RewindEntry));
+}
+
+static void ClearRing() {
+	u32 i;
+
+	for (i = 0; i < numEntries; i++)
+		FreeEntry(&entries[(entriesHead + i) % (rewindCapacity - 1)]);
+	free(entries);
+	entries = NULL;
+	entriesHead = 0;
+	numEntries = 0;
+	entryBytes = 0;
+
+	free(latest);
+	latest = NULL;
+	latestSize = 0;
+}
+
+static int OpenScratch() {
+	char name[48];
+
+	if (scratchFd >= 0) return 0;
+	snprintf(name, sizeof(name), "/psxle-rewind-%d", (int)getpid());
+	scratchFd = shm_open(name, O_CREAT | O_RDWR | O_TRUNC, 0600);
+	if (scratchFd < 0) {
+		perror("shm_open");
+		return -1;
+	}
+	// Nothing else needs to find it, and it goes away with the process
+	shm_unlink(name);
+	return 0;
+}
+
+int RewindConfigure(u32 interval, u32 capacity) {
+	int ret = 0;
+
+	if (capacity > MAX_REWIND_CAPACITY || (capacity > 0 && interval == 0)) return -1;
+
+	pthread_mutex_lock(&rewindLock);
+	ClearRing();
+	rewindInterval = 0;
+	rewindCapacity = 0;
+	if (capacity > 0) {
+		if (OpenScratch() != 0) {
+			ret = -1;
+		} else {
+			if (capacity > 1) entries = (RewindEntry *)calloc(capacity - 1, sizeof(RewindEntry));
+			if (capacity > 1 && entries == NULL) {
+				ret = -1;
+			} else {
+				rewindInterval = interval;
+				rewindCapacity = capacity;
+				framesUntilCapture = 0;
+			}
+		}
+	}
+	pthread_mutex_unlock(&rewindLock);
+
+	return ret;
+}
+
+void RewindShutdown() {
+	RewindConfigure(0, 0);
+	if (scratchFd >= 0) close(scratchFd);
+	scratchFd = -1;
+	free(changedPages);
+	changedPages = NULL;
+	changedPagesSize = 0;
+}
+
+static void PushEntry(RewindEntry *e) {
+	u32 slots = rewindCapacity - 1;
+
+	if (slots == 0) {
+		FreeEntry(e);
+		return;
+	}
+	if (numEntries == slots) {
+		FreeEntry(&entries[entriesHead]);
+		entriesHead = (entriesHead + 1) % slots;
+		numEntries--;
+	}
+	entries[(entriesHead + numEntries) % slots] = *e;
+	numEntries++;
+}
+
+static int Capture() {
+	gzFile f;
+	struct stat st;
+	unsigned char *image;
+	u32 size, pages, i, n = 0;
+	RewindEntry e;
+	int fd;
+
+	if (ftruncate(scratchFd, 0) != 0) return -1;
+	lseek(scratchFd, 0, SEEK_SET);
+	// gzclose closes the descriptor it was given
+	fd = dup(scratchFd);
+	if (fd < 0) return -1;
+	if ((f = gzdopen(fd, "wb0T")) == NULL) {
+		close(fd);
+		return -1;
+	}
+	if (SaveStateGz(f, NULL) != 0) return -1;
+	if (fstat(scratchFd, &st) != 0 || st.st_size == 0) return -1;
+	size = st.st_size;
+
+	image = (unsigned char *)mmap(NULL, size, PROT_READ, MAP_SHARED, scratchFd, 0);
+	if (image == MAP_FAILED) return -1;
+
+	if (latest == NULL) {
+		latest = (unsigned char *)malloc(size);
+		if (latest != NULL) {
+			memcpy(latest, image, size);
+			latestSize = size;
+		}
+		munmap(image, size);
+		return latest != NULL ? 0 : -1;
+	}
+
+	// Pages of the current newest image that the new capture replaces. The
+	// image size is fixed per session, if it ever changes every page differs.
+	pages = (latestSize + REWIND_PAGE_SIZE - 1) / REWIND_PAGE_SIZE;
+	if (changedPagesSize < pages) {
+		free(changedPages);
+		changedPages = (u32 *)malloc(pages * sizeof(u32));
+		changedPagesSize = (changedPages != NULL) ? pages : 0;
+		if (changedPages == NULL) {
+			munmap(image, size);
+			return -1;
+		}
+	}
+	for (i = 0; i < pages; i++) {
+		u32 offset = i * REWIND_PAGE_SIZE;
+		u32 length = (latestSize - offset < REWIND_PAGE_SIZE) ? latestSize - offset : REWIND_PAGE_SIZE;
+		if (size != latestSize || memcmp(latest + offset, image + offset, length) != 0)
+			changedPages[n++] = i;
+	}
+
+	e.size = latestSize;
+	e.pages = n;
+	e.index = (u32 *)malloc((n ? n : 1) * sizeof(u32));
+	e.data = (unsigned char *)malloc((n ? n : 1) * REWIND_PAGE_SIZE);
+	if (e.index == NULL || e.data == NULL) {
+		free(e.index);
+		free(e.data);
+		munmap(image, size);
+		return -1;
+	}
+	memcpy(e.index, changedPages, n * sizeof(u32));
+	for (i = 0; i < n; i++) {
+		u32 offset = changedPages[i] * REWIND_PAGE_SIZE;
+		u32 length = (latestSize - offset < REWIND_PAGE_SIZE) ? latestSize - offset : REWIND_PAGE_SIZE;
+		memcpy(e.data + i * REWIND_PAGE_SIZE, latest + offset, length);
+	}
+	entryBytes += (u64)n * (REWIND_PAGE_SIZE + sizeof(u32));
+
+	// The new capture becomes the newest image
+	if (size != latestSize) {
+		unsigned char *resized = (unsigned char *)realloc(latest, size);
+		if (resized == NULL) {
+			FreeEntry(&e);
+			munmap(image, size);
+			return -1;
+		}
+		latest = resized;
+		memcpy(latest, image, size);
+		latestSize = size;
+	} else {
+		for (i = 0; i < n; i++) {
+			u32 offset = changedPages[i] * REWIND_PAGE_SIZE;
+			u32 length = (size - offset < REWIND_PAGE_SIZE) ? size - offset : REWIND_PAGE_SIZE;
+			memcpy(latest + offset, image + offset, length);
+		}
+	}
+	munmap(image, size);
+
+	PushEntry(&e);
+	return 0;
+}
+
+int RewindFrame() {
+	int due = 0;
+
+	if (rewindCapacity == 0) return 0;
+
+	pthread_mutex_lock(&rewindLock);
+	if (rewindCapacity > 0 && framesUntilCapture-- == 0) {
+		framesUntilCapture = rewindInterval - 1;
+		due = 1;
+	}
+	pthread_mutex_unlock(&rewindLock);
+
+	return due;
+}
+
+void RewindCapture() {
+	pthread_mutex_lock(&rewindLock);
+	if (rewindCapacity > 0 && Capture() != 0) SysPrintf("Rewind capture failed\n");
+	pthread_mutex_unlock(&rewindLock);
+}
+
+// Lays the newest entry back over the newest image and drops it
+static int PopEntry() {
+	u32 slots = rewindCapacity - 1;
+	RewindEntry *e = &entries[(entriesHead + numEntries - 1) % slots];
+	u32 i;
+
+	if (e->size != latestSize) {
+		unsigned char *resized = (unsigned char *)realloc(latest, e->size);
+		if (resized == NULL) return -1;
+		latest = resized;
+		latestSize = e->size;
+	}
+	for (i = 0; i < e->pages; i++) {
+		u32 offset = e->index[i] * REWIND_PAGE_SIZE;
+		u32 length = (latestSize - offset < REWIND_PAGE_SIZE) ? latestSize - offset : REWIND_PAGE_SIZE;
+		memcpy(latest + offset, e->data + i * REWIND_PAGE_SIZE, length);
+	}
+	FreeEntry(e);
+	numEntries--;
+	return 0;
+}
+
+int RewindTo(u32 steps) {
+	int ret = -1, fd;
+	u32 written = 0;
+	ssize_t n;
+	gzFile f;
+
+	pthread_mutex_lock(&rewindLock);
+	if (latest == NULL || steps == 0 || steps > numEntries + 1) {
+		pthread_mutex_unlock(&rewindLock);
+		return -1;
+	}
+	while (--steps > 0)
+		if (PopEntry() != 0) break;
+
+	if (steps == 0 && ftruncate(scratchFd, latestSize) == 0) {
+		while (written < latestSize) {
+			n = pwrite(scratchFd, latest + written, latestSize - written, written);
+			if (n <= 0) break;
+			written += n;
+		}
+		lseek(scratchFd, 0, SEEK_SET);
+		if (written == latestSize && (fd = dup(scratchFd)) >= 0) {
+			if ((f = gzdopen(fd, "rb")) != NULL) ret = LoadStateGz(f);
+			else close(fd);
+		}
+	}
+	// The loaded state is the newest capture, so count the interval from it
+	framesUntilCapture = rewindInterval - 1;
+	pthread_mutex_unlock(&rewindLock);
+
+	return ret;
+}
+
+void RewindStats(u32 *entryCount, u32 *capacity, u64 *bytes) {
+	pthread_mutex_lock(&rewindLock);
+	*entryCount = numEntries + (latest != NULL ? 1 : 0);
+	*capacity = rewindCapacity;
+	*bytes = entryBytes + latestSize + (u64)numEntries * sizeof(RewindEntry);
+	pthread_mutex_unlock(&rewindLock);
+}
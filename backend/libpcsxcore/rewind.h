@@ -0,0 +1,45 @@
+/***************************************************************************
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ *   This program is distributed in the hope that it will be useful,       *
+ *   but WITHOUT ANY WARRANTY; without even the implied warranty of        *
+ *   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         *
+ *   GNU General Public License for more details.                          *
+ *                                                                         *
+ *   You should have received a copy of the GNU General Public License     *
+ *   along with this program; if not, write to the                         *
+ *   Free Software Foundation, Inc.,                                       *
+ *   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.           *
+ ***************************************************************************/
+
+#ifndef __REWIND_H__
+#define __REWIND_H__
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+#include "psxcommon.h"
+
+#define REWIND_PAGE_SIZE 4096
+
+// Every `interval` frames, keep up to `capacity` states, 0 turns rewinding off
+int RewindConfigure(u32 interval, u32 capacity);
+void RewindShutdown();
+
+// Called by SysUpdate once per frame, returns 1 when a capture is due
+int RewindFrame();
+// Takes the capture, from where Execute unwinds to. Emulation thread only.
+void RewindCapture();
+// Loads the state captured `steps` captures ago, 1 being the newest one.
+// Newer captures are dropped. Emulation thread only.
+int RewindTo(u32 steps);
+void RewindStats(u32 *entryCount, u32 *capacity, u64 *bytes);
+
+#ifdef __cplusplus
+}
+#endif
+#endif
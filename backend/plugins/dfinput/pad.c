@@ -686,6 +686,13 @@ void PADregisterVibration(void (*callback)(uint32_t, uint32_t)) {
 	gpuVisualVibration = callback;
 }
 
+// Hold exactly the buttons set in pressed (bit n = key n of the -joy
+// protocol) on the given port. Both ports share this plugin's state.
+void PADsetButtons(int pad, unsigned short pressed) {
+	if (pad < 0 || pad > 1) return;
+	g.PadState[pad].JoyKeyStatus = ~pressed;
+}
+
 #ifndef _MACOSX
 
 long PADconfigure(void) {
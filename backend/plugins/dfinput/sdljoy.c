@@ -22,6 +22,7 @@
 #include <sys/stat.h>
 #include <sys/types.h>
 #include <unistd.h>
+#include <limits.h>
 #define DEBUG 0
 
 int joy_source;
@@ -104,8 +105,8 @@ void InitSDLJoy(char* pname) {
 	if (strcmp(pname, "none") != 0){
 		if (DEBUG) printf("Starting FakeJoy ...\n");
 
-		char pipename[64];
-		sprintf(pipename, "%s-joy", pname);
+		char pipename[PATH_MAX];
+		snprintf(pipename, sizeof(pipename), "%s-joy", pname);
 
 		if (DEBUG) printf("Using pipe: %s ...\n", pipename);
 
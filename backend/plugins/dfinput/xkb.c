@@ -28,6 +28,12 @@ static uint8_t resumeScrSaver = 0;
 void InitKeyboard() {
     int revert_to;
 
+    g.PadState[0].KeyStatus = 0xFFFF;
+    g.PadState[1].KeyStatus = 0xFFFF;
+
+    // Headless GPU: no display, so no keyboard or mouse either
+    if (g.Disp == NULL) return;
+
     wmprotocols = XInternAtom(g.Disp, "WM_PROTOCOLS", 0);
     wmdelwindow = XInternAtom(g.Disp, "WM_DELETE_WINDOW", 0);
 
@@ -58,12 +64,11 @@ void InitKeyboard() {
 
     g_currentMouse_X = 0;
     g_currentMouse_Y = 0;
-
-    g.PadState[0].KeyStatus = 0xFFFF;
-    g.PadState[1].KeyStatus = 0xFFFF;
 }
 
 void DestroyKeyboard() {
+	if (g.Disp == NULL) return;
+
 	XkbSetDetectableAutoRepeat(g.Disp, 0, NULL);
 
     // Enable cursor and revert grab cursor if mouse
@@ -105,6 +110,8 @@ void CheckKeyboard() {
 	XClientMessageEvent		*xce;
 	uint16_t				Key;
 
+	if (g.Disp == NULL) return;
+
 	while (XPending(g.Disp)) {
 		XNextEvent(g.Disp, &evt);
 		switch (evt.type) {
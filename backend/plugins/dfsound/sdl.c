@@ -20,6 +20,9 @@
 
 #include "externals.h"
 #include <SDL.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <fcntl.h>
 
 
 #define BUFFER_SIZE		22050
@@ -44,6 +47,82 @@ int killSound = 0;
 
 int count_empty = 0;
 
+// Streaming (record switch 2): samples go to a ring in a shm object that
+// psxle_py creates and sizes, rec_dumpLocation holds its name. The layout
+// is shared with psxle_py, keep the two in step.
+#define AUDIO_RING_MAGIC 0x41585350 // "PSXA"
+#define AUDIO_RING_HEADER 64
+
+typedef struct {
+	uint32_t magic;
+	uint32_t capacity;          // samples (not frames) the ring holds
+	uint32_t channels;
+	uint32_t reserved;
+	volatile uint64_t written;  // samples written since the stream started
+} AudioRingHeader;
+
+AudioRingHeader* stream_ring = NULL;
+short* stream_samples = NULL;
+size_t stream_size = 0;
+
+static void OpenAudioStream(const char* name) {
+	struct stat st;
+	int fd = shm_open(name, O_RDWR, 0);
+	if (fd < 0) {
+		printf("Error streaming audio!\n");
+		return;
+	}
+	if (fstat(fd, &st) == 0 && st.st_size > AUDIO_RING_HEADER) {
+		stream_ring = mmap(NULL, st.st_size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+		if (stream_ring == MAP_FAILED) stream_ring = NULL;
+	}
+	close(fd);
+	if (stream_ring == NULL) return;
+
+	stream_size = st.st_size;
+	if (stream_ring->capacity == 0 || AUDIO_RING_HEADER + (size_t)stream_ring->capacity * sizeof(short) > stream_size) {
+		munmap(stream_ring, stream_size);
+		stream_ring = NULL;
+		return;
+	}
+	stream_samples = (short*)((char*)stream_ring + AUDIO_RING_HEADER);
+	stream_ring->channels = iDisStereo ? 1 : 2;
+	stream_ring->written = 0;
+	// Readers check the magic last
+	__sync_synchronize();
+	stream_ring->magic = AUDIO_RING_MAGIC;
+	printf("Begining streaming of audio (%s).\n", name);
+}
+
+static void CloseAudioStream() {
+	if (stream_ring == NULL) return;
+	munmap(stream_ring, stream_size);
+	stream_ring = NULL;
+	stream_samples = NULL;
+	printf("Ending streaming of audio.\n");
+}
+
+static void WriteAudioStream(const short* samples, int count) {
+	uint64_t written;
+	uint32_t capacity, start, first;
+
+	if (stream_ring == NULL || count <= 0) return;
+	capacity = stream_ring->capacity;
+	written = stream_ring->written;
+	// Only the newest `capacity` samples can be kept
+	if ((uint32_t)count > capacity) {
+		written += count - capacity;
+		samples += count - capacity;
+		count = capacity;
+	}
+	start = written % capacity;
+	first = (count < capacity - start) ? count : capacity - start;
+	memcpy(stream_samples + start, samples, first * sizeof(short));
+	memcpy(stream_samples, samples + first, (count - first) * sizeof(short));
+	__sync_synchronize();
+	stream_ring->written = written + count;
+}
+
 void (*wsNotificationPtr)(int);
 
 static void SOUND_FillAudio(void *unused, Uint8 *stream, int len) {
@@ -66,8 +145,11 @@ static void SOUND_FillAudio(void *unused, Uint8 *stream, int len) {
 		nonzeroST = nonzeros;
 	}
 	*/
-	if (curr_switch^rec_lastSwitchState == 1){
-		if ((curr_switch == 1) && (rec_lastSwitchState == 0)) {
+	if (curr_switch != rec_lastSwitchState){
+		if (rec_lastSwitchState == 2) CloseAudioStream();
+		if (curr_switch == 2) OpenAudioStream(rec_dumpLocation);
+
+		if ((curr_switch == 1) && (rec_lastSwitchState != 1)) {
 			seen_sound = 0;
 			count_empty = 0;
 			printf("Begining recording of audio (%s).\n", rec_dumpLocation);
@@ -77,7 +159,7 @@ static void SOUND_FillAudio(void *unused, Uint8 *stream, int len) {
 			}
 		}
 
-		if ((curr_switch == 0) && (rec_lastSwitchState == 1)) {
+		if ((curr_switch != 1) && (rec_lastSwitchState == 1)) {
 			printf("Ending recording of audio.\n");
 			seen_sound = 0;
 			fclose(rec_fd);
@@ -168,6 +250,10 @@ static void SOUND_FillAudio(void *unused, Uint8 *stream, int len) {
 			}
 		}else{
 			*p++ = pSndBuffer[iReadPos++];
+			if (curr_switch == 2){
+				*pcopy++ = p[-1];
+				lencopy += 1;
+			}
 		}
 
 		/*
@@ -217,8 +303,10 @@ static void SOUND_FillAudio(void *unused, Uint8 *stream, int len) {
 
 	if (curr_switch == 1){
 		fwrite(pcopystart, sizeof(short), lencopy, rec_fd);
-		free(pcopystart);
+	}else if (curr_switch == 2){
+		WriteAudioStream(pcopystart, lencopy);
 	}
+	free(pcopystart);
 
 
 
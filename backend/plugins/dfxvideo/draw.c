@@ -1462,6 +1462,59 @@ void BlitScreen32(unsigned char *surf, int32_t x, int32_t y)
 
 
 
+// Frame sink copy: the display area of VRAM, scaled (nearest neighbour) to
+// FRAME_SINK_WIDTH x FRAME_SINK_HEIGHT RGB and stored bottom-up, the same
+// way glReadPixels hands frames over in the GL plugin
+
+void BlitFrameRGB(unsigned char *surf)
+{
+ static unsigned short srcX[FRAME_SINK_WIDTH];
+ int32_t x = PSXDisplay.DisplayPosition.x;
+ int32_t y = PSXDisplay.DisplayPosition.y;
+ int32_t w = PSXDisplay.DisplayMode.x;
+ int32_t h = PSXDisplay.DisplayMode.y;
+ unsigned char *pD, *row;
+ unsigned short s;
+ int column, i;
+
+ if (PSXDisplay.Disabled || w <= 0 || h <= 0)
+  {
+   memset(surf, 0, FRAME_SINK_WIDTH * FRAME_SINK_HEIGHT * 3);
+   return;
+  }
+
+ for (i = 0; i < FRAME_SINK_WIDTH; i++)
+  srcX[i] = (i * w) / FRAME_SINK_WIDTH;
+
+ for (column = 0; column < FRAME_SINK_HEIGHT; column++)
+  {
+   int32_t sy = (y + (column * h) / FRAME_SINK_HEIGHT) & (iGPUHeight - 1);
+   pD = surf + (FRAME_SINK_HEIGHT - 1 - column) * FRAME_SINK_WIDTH * 3;
+
+   if (PSXDisplay.RGB24)
+    {
+     row = (unsigned char *)&psxVuw[sy << 10];
+     for (i = 0; i < FRAME_SINK_WIDTH; i++)
+      {
+       unsigned char *p = row + ((x * 2 + srcX[i] * 3) & 2047);
+       *pD++ = p[0];
+       *pD++ = p[1];
+       *pD++ = p[2];
+      }
+    }
+   else
+    {
+     for (i = 0; i < FRAME_SINK_WIDTH; i++)
+      {
+       s = GETLE16(&psxVuw[(sy << 10) + ((x + srcX[i]) & 1023)]);
+       *pD++ = (s << 3) & 0xf8;
+       *pD++ = (s >> 2) & 0xf8;
+       *pD++ = (s >> 7) & 0xf8;
+      }
+    }
+  }
+}
+
 void BlitToYUV(unsigned char * surf,int32_t x,int32_t y)
 {
  unsigned char * pD;
@@ -1623,6 +1676,9 @@ void DoBufferSwap(void)
 	unsigned int dstx, dsty;
 	unsigned int _d, _w, _h;	//don't care about _d
 
+	if (bHeadless)
+		return;
+
 	finalw = PSXDisplay.DisplayMode.x;
 	finalh = PSXDisplay.DisplayMode.y;
 
@@ -1712,6 +1768,8 @@ void DoClearScreenBuffer(void)                         // CLEAR DX BUFFER
  Window _dw;
  unsigned int _d, _w, _h;	//don't care about _d
 
+ if (bHeadless) return;
+
  XGetGeometry(display, window, &_dw, (int *)&_d, (int *)&_d, &_w, &_h, &_d, &_d);
 
  //XSync(display,False);
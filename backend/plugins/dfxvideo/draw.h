@@ -19,6 +19,7 @@
 #define _GPU_DRAW_H_
 
 void          DoBufferSwap(void);
+void          BlitFrameRGB(unsigned char *surf);
 void          DoClearScreenBuffer(void);
 void          DoClearFrontBuffer(void);
 unsigned long ulInitDisplay(void);
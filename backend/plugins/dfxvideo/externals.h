@@ -327,6 +327,7 @@ extern uint32_t  ulStatusControl[];
 extern uint32_t  vBlank;
 extern int            iRumbleVal;
 extern int            iRumbleTime;
+extern BOOL           bHeadless;
 
 #endif
 
@@ -362,6 +363,7 @@ extern char           szGPUKeys[];
 
 extern int            UseFrameLimit;
 extern int            UseFrameSkip;
+extern BOOL           bTurbo;
 extern float          fFrameRate;
 extern int            iFrameLimit;
 extern float          fFrameRateHz;
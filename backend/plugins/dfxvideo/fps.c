@@ -46,6 +46,35 @@ void CALLBACK GPUsetSpeed(float newSpeed) {
  }
 }
 
+// Turbo: no frame limiting at all, and the emulator tells us before every
+// frame whether anybody will look at it (GPUskipNextFrame). Unlike the GL
+// plugin the frame is still rasterized, only the frame sink copy is skipped.
+
+BOOL           bTurbo=FALSE;
+static int     iTurboFrameLimit=0;
+
+void CALLBACK GPUsetTurbo(long enable)
+{
+ if(enable && !bTurbo)
+  {
+   iTurboFrameLimit=UseFrameLimit;
+   UseFrameLimit=0;
+   bTurbo=TRUE;
+  }
+ else if(!enable && bTurbo)
+  {
+   UseFrameLimit=iTurboFrameLimit;
+   bTurbo=FALSE;
+   bSkipNextFrame=FALSE;
+   bInitCap=TRUE;                                      // restart the limiter from now
+  }
+}
+
+void CALLBACK GPUskipNextFrame(long skip)
+{
+ if(bTurbo) bSkipNextFrame = skip ? TRUE : FALSE;
+}
+
 void CheckFrameRate(void)
 {
  if(UseFrameSkip)                                      // skipping mode?
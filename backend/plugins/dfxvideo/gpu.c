@@ -127,6 +127,11 @@ DATAREGISTERMODES DataReadMode;
 
 BOOL              bSkipNextFrame = FALSE;
 DWORD             dwLaceCnt=0;
+
+// Frame sink of the Python bridge, fed from VRAM at every vsync
+static unsigned char * (*pFrameAcquire)(int, int) = NULL;
+static void (*pFramePublish)(void) = NULL;
+BOOL              bHeadless = FALSE;
 int               iColDepth;
 int               iWindowMode;
 short             sDispWidths[8] = {256,320,512,640,368,384,512,640};
@@ -531,7 +536,7 @@ static void DoTextSnapShot(int iNum)
 
 	#else
 
-	long GPUopen(unsigned long * disp,char * CapText,char * CfgFile)
+	long GPUopen(unsigned long * disp,char * CapText,char * CfgFile, int mode)
 	{
 	unsigned long d;
 
@@ -545,6 +550,14 @@ static void DoTextSnapShot(int iNum)
 	bIsFirstFrame  = TRUE;                                // we have to init later
 	bDoVSyncUpdate = TRUE;
 
+	bHeadless = (mode == DISPLAY_HEADLESS);
+	if(bHeadless)                                         // no x at all, only the frame sink
+	{
+	 printf("Making no display (headless).\n");
+	 if(disp) *disp=0;
+	 return 0;
+	}
+
 	d=ulInitDisplay();                                    // setup x
 
 	if(disp)
@@ -566,6 +579,8 @@ long CALLBACK GPUclose()                               // GPU CLOSE
  if(RECORD_RECORDING==TRUE) {RECORD_Stop();RECORD_RECORDING=FALSE;BuildDispMenu(0);}
 #endif
 
+ if(bHeadless) return 0;                               // nothing was opened
+
  ReleaseKeyHandler();                                  // de-subclass window
 
  CloseDisplay();                                       // shutdown direct draw
@@ -939,6 +954,30 @@ void CALLBACK GPUcursor(int iPlayer,int x,int y)
  ptCursorPoint[iPlayer].y=y;
 }
 
+////////////////////////////////////////////////////////////////////////
+// frame ring: the emu hands us a slot, we convert the display area into it
+////////////////////////////////////////////////////////////////////////
+
+void CALLBACK GPUregisterFrameSink(unsigned char *(*acquire)(int, int), void (*publish)(void))
+{
+ pFrameAcquire = acquire;
+ pFramePublish = publish;
+}
+
+static void FeedFrameSink(void)
+{
+ unsigned char * pDst;
+
+ if(!pFrameAcquire || (bTurbo && bSkipNextFrame)) return;
+
+ pDst = pFrameAcquire(FRAME_SINK_WIDTH, FRAME_SINK_HEIGHT);
+ if(!pDst) return;                                     // nobody is looking
+
+ BlitFrameRGB(pDst);
+
+ pFramePublish();
+}
+
 ////////////////////////////////////////////////////////////////////////
 // update lace is called evry VSync
 ////////////////////////////////////////////////////////////////////////
@@ -980,9 +1019,11 @@ void CALLBACK GPUupdateLace(void)                      // VSYNC
 #endif
 
 #ifndef _MACGL
- if(bChangeWinMode) ChangeWindowMode();                // toggle full - window mode
+ if(bChangeWinMode && !bHeadless) ChangeWindowMode();  // toggle full - window mode
 #endif
 
+ FeedFrameSink();                                      // every vsync, drawn or not
+
  bDoVSyncUpdate=FALSE;                                 // vsync done
 }
 
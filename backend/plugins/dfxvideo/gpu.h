@@ -51,6 +51,12 @@
 
 /////////////////////////////////////////////////////////////////////////////
 
+// GPUopen mode without any X display, frames only go to the frame sink
+#define DISPLAY_HEADLESS 3
+
+#define FRAME_SINK_WIDTH  640
+#define FRAME_SINK_HEIGHT 480
+
 void           updateDisplay(void);
 void           SetAutoFrameCap(void);
 void           SetFixes(void);
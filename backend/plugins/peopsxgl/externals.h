@@ -425,6 +425,7 @@ extern unsigned short usCursorActive;
 
 extern BOOL           bUseFrameLimit;
 extern BOOL           bUseFrameSkip;
+extern BOOL           bTurbo;
 extern float          fFrameRate;
 extern float          fFrameRateHz;
 extern int            iFrameLimit;
@@ -43,6 +43,8 @@ int            iFrameLimit;
 BOOL           bUseFrameLimit=FALSE;
 BOOL           bUseFrameSkip=0;
 DWORD          dwLaceCnt=0;
+BOOL           bTurbo=FALSE;
+static BOOL    bTurboFrameLimit=FALSE;
 
 ////////////////////////////////////////////////////////////////////////
 // FPS skipping / limit
@@ -409,6 +411,31 @@ void CALLBACK GPUsetSpeed(float newSpeed) {
  }
 }
 
+// Turbo: no frame limiting at all, and the emulator tells us before every
+// frame whether anybody will look at it (GPUskipNextFrame)
+
+void CALLBACK GPUsetTurbo(long enable)
+{
+ if(enable && !bTurbo)
+  {
+   bTurboFrameLimit=bUseFrameLimit;
+   bUseFrameLimit=FALSE;
+   bTurbo=TRUE;
+  }
+ else if(!enable && bTurbo)
+  {
+   bUseFrameLimit=bTurboFrameLimit;
+   bTurbo=FALSE;
+   bSkipNextFrame=FALSE;
+   bInitCap=TRUE;                                      // restart the limiter from now
+  }
+}
+
+void CALLBACK GPUskipNextFrame(long skip)
+{
+ if(bTurbo) bSkipNextFrame = skip ? TRUE : FALSE;     // primitives of skipped frames are not rasterized
+}
+
 void CALLBACK GPUsetframelimit(unsigned long option)   // new EPSXE interface func: main emu can enable/disable fps limitation this way
 {
  bInitCap = TRUE;
@@ -197,6 +197,10 @@ BOOL			oddLines;
 int bShotLoc = 0;
 int hasAllocatedSharedMemory = 0;
 int shmid;
+unsigned char * snapshotSharedMemory = NULL;
+unsigned char * (*pFrameAcquire)(int, int) = NULL;
+void (*pFramePublish)(void) = NULL;
+BOOL bFrameSinkFed = FALSE;
 int usingXWindow;
 
 ////////////////////////////////////////////////////////////////////////
@@ -419,57 +423,38 @@ void DoTextSnapShot(int iNum)
 void DoSnapShot(){
   if (DEBUG) printf("SCREENSHOT Int: %i\n", bShotLoc);
 
-  unsigned char * snapshotdumpmem=NULL,* p,c;
-
   int size;
-  unsigned char empty[2]={0,0};
-  int i;
-  unsigned int snapshotnr = 0;
   int SnapWidth;
   int SnapHeight;
 
-
-  // we use the memory id that has been passed by the Python environment
-  key_t key = bShotLoc;
-  char *shared_memory;
-
   SnapWidth  = 640; //iResX
   SnapHeight = 480; //iResY
   size=SnapWidth * SnapHeight;
 
-  //size=SnapWidth * SnapHeight * 3 + 0x38;
-
-  if((snapshotdumpmem=(unsigned char *)
-   malloc(size*3))==NULL)
-  return;
+  bSnapShot=FALSE;
 
+  // The segment uses the memory id that has been passed by the Python
+  // environment, which creates it owner-only. It is attached on the first
+  // request only and then kept until the bridge asks for it to be cleared.
+  if (hasAllocatedSharedMemory == 0){
+    key_t key = bShotLoc;
 
-  // Setup shared memory
-  if ((shmid = shmget(key, size*3, IPC_CREAT | 0666)) < 0)
-  {
-    printf("Error getting shared memory id");
-    exit(1);
-  }
-  //printf("Got shared memory.\n");
-  // Attached shared memory
-  if ((shared_memory = shmat(shmid, NULL, 0)) == (char *) -1)
-  {
-    printf("Error attaching shared memory id");
-    exit(1);
+    if ((shmid = shmget(key, size*3, 0)) < 0)
+    {
+      printf("Error getting shared memory id");
+      exit(1);
+    }
+    if ((snapshotSharedMemory = shmat(shmid, NULL, 0)) == (unsigned char *) -1)
+    {
+      printf("Error attaching shared memory id");
+      exit(1);
+    }
+    hasAllocatedSharedMemory = 1;
   }
 
-
-  bSnapShot=FALSE;
-
-
+  // Read straight into the segment, no scratch buffer needed
   glReadPixels(0,0,SnapWidth,SnapHeight,GL_RGB,
-               GL_UNSIGNED_BYTE,snapshotdumpmem);
-
-
-  memcpy(shared_memory, snapshotdumpmem, size*3);
-  free(snapshotdumpmem);
-
-  hasAllocatedSharedMemory = 1;
+               GL_UNSIGNED_BYTE,snapshotSharedMemory);
 
   #ifdef _WINDOWS
   MessageBeep((UINT)-1);
@@ -485,14 +470,42 @@ void CALLBACK GPUmakeSnapshot(int a)
     bShotLoc = a;
   }else{
     if (hasAllocatedSharedMemory > 0){
-      shmdt(shmid);
+      shmdt(snapshotSharedMemory);
       shmctl(shmid, IPC_RMID, NULL);
+      snapshotSharedMemory = NULL;
       hasAllocatedSharedMemory = 0;
       if (DEBUG) printf("Successfully cleared shared memory\n");
     }
   }
 }
 
+////////////////////////////////////////////////////////////////////////
+// frame ring: the emu hands us a slot, we render the frame into it
+////////////////////////////////////////////////////////////////////////
+
+void CALLBACK GPUregisterFrameSink(unsigned char *(*acquire)(int, int), void (*publish)(void))
+{
+ pFrameAcquire = acquire;
+ pFramePublish = publish;
+}
+
+static void FeedFrameSink(BOOL bAfterSwap)
+{
+ unsigned char * pDst;
+
+ bFrameSinkFed = TRUE;
+ if(!pFrameAcquire) return;
+
+ pDst = pFrameAcquire(640, 480);
+ if(!pDst) return;
+
+ if(bAfterSwap) glReadBuffer(GL_FRONT);                // back buffer content is undefined after a swap
+ glReadPixels(0,0,640,480,GL_RGB,GL_UNSIGNED_BYTE,pDst);
+ if(bAfterSwap) glReadBuffer(GL_BACK);
+
+ pFramePublish();
+}
+
 ////////////////////////////////////////////////////////////////////////
 // GPU INIT... here starts it all (first func called by emu)
 ////////////////////////////////////////////////////////////////////////
@@ -1256,6 +1269,9 @@ void updateDisplay(void)                               // UPDATE DISPLAY
 
  if(bSnapShot) DoSnapShot();                           // snapshot key pressed? cheeeese :)
 
+ if(!(bTurbo && bSkipNextFrame))                       // frame ring wants every new frame
+  FeedFrameSink(FALSE);
+
  if(ulKeybits&KEY_SHOWFPS)                             // wanna see FPS?
   {
    sprintf(szDispBuf,"%06.1f",fps_cur);
@@ -1265,7 +1281,12 @@ void updateDisplay(void)                               // UPDATE DISPLAY
  //----------------------------------------------------//
  // main buffer swapping (well, or skip it)
 
- if(bUseFrameSkip)                                     // frame skipping active ?
+ if(bTurbo)                                            // turbo: the emulator picks the frames to draw
+  {
+   if(iDrawnSomething && !bSkipNextFrame)
+    if (usingXWindow == 1) glXSwapBuffers(display,window);
+  }
+ else if(bUseFrameSkip)                                // frame skipping active ?
   {
    if(!bSkipNextFrame)
     {
@@ -1714,6 +1735,9 @@ void CALLBACK GPUupdateLace(void)
    updateDisplay();
   }
 
+ if(!bFrameSinkFed && !(bTurbo && bSkipNextFrame))     // nothing new drawn this vsync? share the current one
+  FeedFrameSink(usingXWindow == 1);
+ bFrameSinkFed = FALSE;
 }
 
 ////////////////////////////////////////////////////////////////////////
@@ -0,0 +1,43 @@
+# Compares the Xvfb + OpenGL render path (Display.NONE) with the headless
+# software path (Display.HEADLESS): emulated frame rate in turbo mode with
+# every frame captured, and the latency of a single get_screen call
+# Run:
+#   python benchmarks/headless_fps.py <PATH TO ISO> <Optional: seconds per run, default 10> <Optional: captures, default 200>
+
+from __future__ import print_function
+import sys
+import time
+import numpy as np
+from psxle import Console, Display
+
+iso = sys.argv[1]
+seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+captures = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+
+for name, display in [("xvfb+gl", Display.NONE), ("headless", Display.HEADLESS)]:
+    start = time.perf_counter()
+    c = Console(iso, display=display, frame_ring=4)
+    c.run()
+    print("{:<9} started in {:6.3f} s".format(name, time.perf_counter() - start))
+    # Let the game boot before we start measuring
+    time.sleep(5)
+
+    times = []
+    frame = np.empty(Console.SCREEN_SHAPE, dtype=np.uint8)
+    for _ in range(captures):
+        start = time.perf_counter()
+        c.get_screen(out=frame)
+        times.append(time.perf_counter() - start)
+    times = np.array(times) * 1000
+    print("{:<9} get_screen   median {:8.3f} ms   p99 {:8.3f} ms".format(
+        name, np.median(times), np.percentile(times, 99)))
+
+    # render_every=1: every frame is drawn and goes through the frame ring
+    c.turbo(True, render_every=1)
+    start_frames = c.emulation_stats()[0]
+    start = time.perf_counter()
+    time.sleep(seconds)
+    frames = c.emulation_stats()[0] - start_frames
+    elapsed = time.perf_counter() - start
+    print("{:<9} turbo        {:8.1f} emulated fps, every frame captured".format(name, frames / elapsed))
+    c.kill()
@@ -0,0 +1,32 @@
+# Reports the emulated frame rate in turbo mode against the number of memory
+# listeners, spread evenly across main RAM
+# Run:
+#   python benchmarks/hook_fps.py <PATH TO ISO> <Optional: seconds per run, default 10>
+
+from __future__ import print_function
+import sys
+import time
+from psxle import Console, Display
+
+iso = sys.argv[1]
+seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+def ignore(*args):
+    pass
+
+for hooks in [0, 1, 10, 50, 100, 127]:
+    c = Console(iso, display=Display.NONE)
+    for i in range(hooks):
+        # 64 bytes every 16 KiB, starting past the kernel area
+        c.add_memory_listener(0x10000 + i * 0x4000, 64, ignore)
+    c.run()
+    # Let the game boot before we start measuring
+    time.sleep(5)
+    c.turbo(True)
+    start_frames = c.emulation_stats()[0]
+    start = time.perf_counter()
+    time.sleep(seconds)
+    frames = c.emulation_stats()[0] - start_frames
+    elapsed = time.perf_counter() - start
+    print("{:4d} hooks   {:8.1f} emulated fps".format(hooks, frames / elapsed))
+    c.kill()
@@ -0,0 +1,44 @@
+# Reports the round-trip latency of the blocking Console calls
+# Run:
+#   python benchmarks/ipc_latency.py <PATH TO ISO> <Optional: iterations, default 200>
+
+from __future__ import print_function
+import sys
+import time
+import numpy as np
+from psxle import Console, Display
+
+iso = sys.argv[1]
+iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+def measure(name, f):
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    times = np.array(times) * 1000
+    print("{:<14} mean {:8.3f} ms   median {:8.3f} ms   p99 {:8.3f} ms".format(
+        name, times.mean(), np.median(times), np.percentile(times, 99)))
+
+c = Console(iso, display=Display.NONE)
+c.run()
+# Let the game boot before we start timing
+time.sleep(5)
+
+def pause_cycle():
+    c.freeze(block=True)
+    c.unfreeze(block=True)
+
+def set_speed():
+    c.speed = 100
+
+measure("freeze+resume", pause_cycle)
+measure("speed (43)", set_speed)
+# Write back the value that is already there so the game is undisturbed
+address = 0x1ffff0
+value = c.read_bytes(address, 1)[0]
+measure("write_byte (26)", lambda: c.write_byte(address, value, block=True))
+measure("read_bytes (21)", lambda: c.read_bytes(0x10000, 64))
+
+c.kill()
@@ -0,0 +1,43 @@
+# Compares stepping with full 640x480 RGB frames against stepping with an
+# 84x84 grayscale observation reduced inside the emulator, with and without
+# max pooling, for a single console and for a pool
+# Run:
+#   python benchmarks/observation_fps.py <PATH TO ISO> <Optional: steps per run, default 500> <Optional: frame skip, default 4> <Optional: pool size, default 8>
+
+from __future__ import print_function
+import sys
+import time
+from psxle import Console, ConsolePool, Display
+
+iso = sys.argv[1]
+steps = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+skip = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+n = int(sys.argv[4]) if len(sys.argv) > 4 else 8
+
+specs = [("full rgb", dict(size=None)), ("84x84 gray", dict(size=(84, 84))),
+         ("84x84 gray pooled", dict(size=(84, 84), max_pool=True))]
+
+def measure(target, nbytes, name, size):
+    start = time.perf_counter()
+    for _ in range(steps):
+        target.step(skip)
+    elapsed = time.perf_counter() - start
+    print("{:>2} x {:<18} {:9.1f} steps/s   {:8d} bytes per step".format(
+        size, name, size * steps / elapsed, nbytes))
+
+c = Console(iso, display=Display.HEADLESS)
+c.run()
+# Let the game boot before we start measuring
+time.sleep(5)
+for name, spec in specs:
+    c.set_observation(**spec)
+    measure(c, c.step(skip).nbytes, name, 1)
+c.kill()
+
+pool = ConsolePool(iso, n, display=Display.HEADLESS)
+pool.run()
+time.sleep(5)
+for name, spec in specs:
+    pool.set_observation(**spec)
+    measure(pool, pool.observations[0].nbytes, name, n)
+pool.kill()
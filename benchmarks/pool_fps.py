@@ -0,0 +1,27 @@
+# Reports the aggregate stepped frame rate of a ConsolePool against the
+# number of consoles, with and without gathering the observations
+# Run:
+#   python benchmarks/pool_fps.py <PATH TO ISO> <Optional: steps per run, default 200> <Optional: pin CPUs (0/1), default 1>
+
+from __future__ import print_function
+import sys
+import time
+from psxle import ConsolePool
+
+iso = sys.argv[1]
+steps = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+pin = bool(int(sys.argv[3])) if len(sys.argv) > 3 else True
+
+for n in [1, 2, 4, 8, 16, 32]:
+    pool = ConsolePool(iso, n, pin_cpus=pin)
+    pool.run()
+    # Let the games boot before we start measuring
+    time.sleep(5)
+    for observe in [False, True]:
+        start = time.perf_counter()
+        for _ in range(steps):
+            pool.step(1, observe=observe)
+        elapsed = time.perf_counter() - start
+        print("{:3d} consoles   observe={:<5}   {:9.1f} frames/s total   {:8.1f} frames/s each".format(
+            n, str(observe), n * steps / elapsed, steps / elapsed))
+    pool.kill()
@@ -0,0 +1,38 @@
+# Reports how many commands per second the -proc command loop gets through
+# Run:
+#   python benchmarks/proc_throughput.py <PATH TO ISO> <Optional: commands per batch, default 1000> <Optional: batches, default 20>
+
+from __future__ import print_function
+import sys
+import time
+from psxle import Console, Display
+
+iso = sys.argv[1]
+batch = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+batches = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+def measure(name, issue):
+    # Every command is sent before waiting on any reply
+    start = time.perf_counter()
+    for _ in range(batches):
+        with c.pipelined():
+            futures = [issue(i) for i in range(batch)]
+        for f in futures:
+            f.result(Console.reply_timeout)
+    elapsed = time.perf_counter() - start
+    print("{:<22} {:10.0f} commands/s".format(name, batch*batches/elapsed))
+
+c = Console(iso, display=Display.NONE)
+c.run()
+# Let the game boot before we start timing
+time.sleep(5)
+
+start = time.perf_counter()
+for _ in range(batch):
+    c.ping()
+print("{:<22} {:10.0f} commands/s".format("ping (serial)", batch/(time.perf_counter()-start)))
+
+measure("ping (pipelined)", lambda i: c.ping_async())
+measure("read_bytes 4B", lambda i: c.read_bytes_async(0x10000 + 4*(i % 256), 4))
+
+c.kill()
@@ -0,0 +1,40 @@
+# Compares episode reset latency: file save states against in-RAM snapshots
+# Run:
+#   python benchmarks/reset_latency.py <PATH TO ISO> <Optional: iterations, default 50>
+
+from __future__ import print_function
+import sys
+import time
+import numpy as np
+from psxle import Console, Display
+
+iso = sys.argv[1]
+iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+def measure(name, f):
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    times = np.array(times) * 1000
+    print("{:<26} mean {:8.3f} ms   median {:8.3f} ms   p99 {:8.3f} ms".format(
+        name, times.mean(), np.median(times), np.percentile(times, 99)))
+
+c = Console(iso, display=Display.NONE)
+c.run()
+# Let the game boot before we start timing
+time.sleep(5)
+
+c.save_state("benchmark", block=True)
+c.snapshot("raw")
+c.snapshot("fast", compress=True)
+
+measure("load_state (file, gz -9)", lambda: c.load_state("benchmark", block=True))
+measure("restore (RAM, raw)", lambda: c.restore("raw"))
+measure("restore (RAM, gz -1)", lambda: c.restore("fast"))
+measure("save_state (file, gz -9)", lambda: c.save_state("benchmark", block=True))
+measure("snapshot (RAM, raw)", lambda: c.snapshot("raw"))
+measure("snapshot (RAM, gz -1)", lambda: c.snapshot("fast", compress=True))
+
+c.kill()
@@ -0,0 +1,43 @@
+# Compares the size and the save/load time of state files for each codec,
+# and of delta states taken against a full base
+# Run:
+#   python benchmarks/state_codecs.py <PATH TO ISO> <Optional: iterations, default 20>
+
+from __future__ import print_function
+import os
+import sys
+import time
+import numpy as np
+from psxle import Console, Display
+
+iso = sys.argv[1]
+iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+c = Console(iso, display=Display.NONE)
+c.run()
+# Let the game boot before we start timing
+time.sleep(5)
+
+def measure(name, save, load):
+    saves, loads = [], []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        save()
+        saves.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        load()
+        loads.append(time.perf_counter() - start)
+    print("{:<8} size {:9d} B   save {:8.3f} ms   load {:8.3f} ms".format(
+        name, os.path.getsize(c._get_state_path("bench" + name)),
+        np.median(saves) * 1000, np.median(loads) * 1000))
+
+for codec in ["best", "fast", "none"]:
+    measure(codec, lambda: c.save_state("bench" + codec, block=True, codec=codec),
+            lambda: c.load_state("bench" + codec, block=True))
+
+c.save_state("benchbase", block=True, codec="none")
+time.sleep(1)
+measure("delta", lambda: c.save_state("benchdelta", block=True, codec="fast", base="benchbase"),
+        lambda: c.load_state("benchdelta", block=True))
+
+c.kill()
@@ -0,0 +1,34 @@
+# Compares the emulated frame rate with and without turbo
+# Run:
+#   python benchmarks/turbo_fps.py <PATH TO ISO> <Optional: seconds per mode, default 10>
+
+from __future__ import print_function
+import sys
+import time
+from psxle import Console, Display
+
+iso = sys.argv[1]
+seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+def measure(name):
+    start_frames, _ = c.emulation_stats()
+    start = time.perf_counter()
+    time.sleep(seconds)
+    frames, reported = c.emulation_stats()
+    elapsed = time.perf_counter() - start
+    print("{:<26} {:8.1f} frames/s (emulator reports {:.1f})".format(
+        name, (frames - start_frames) / elapsed, reported))
+
+c = Console(iso, display=Display.NONE)
+c.run()
+# Let the game boot before we start timing
+time.sleep(5)
+
+measure("normal")
+c.turbo(True)
+measure("turbo")
+c.turbo(True, render_every=4)
+measure("turbo, render 1 in 4")
+c.turbo(False)
+
+c.kill()
@@ -0,0 +1,46 @@
+# Checks that loading a delta state brings back the BIOS area (psxR, where the
+# HLE BIOS keeps its events, file handles and heap) and main RAM exactly as
+# they were when the delta was saved
+# Run:
+#   python checks/delta_state_roundtrip.py <PATH TO ISO> <Optional: frames between states, default 60>
+
+from __future__ import print_function
+import sys
+import time
+import numpy as np
+from psxle import Console, Display
+
+iso = sys.argv[1]
+frames = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+
+RAM_START, RAM_LENGTH = 0x80000000, 0x200000
+BIOS_START, BIOS_LENGTH = 0xbfc00000, 0x80000
+
+def read(c, start, length):
+    return np.frombuffer(c.read_bytes(start, length), dtype=np.uint8)
+
+c = Console(iso, display=Display.NONE)
+c.run()
+# Let the game boot before we start checking
+time.sleep(5)
+c.freeze()
+
+c.save_state("checkbase", block=True)
+c.step(frames, observe=False)
+c.save_state("checkdelta", block=True, base="checkbase")
+# Saving writes the HLE BIOS state into psxR, so read it back afterwards
+bios, ram = read(c, BIOS_START, BIOS_LENGTH), read(c, RAM_START, RAM_LENGTH)
+
+c.step(frames, observe=False)
+c.load_state("checkdelta", block=True)
+failed = False
+for name, start, length, saved in [("psxR", BIOS_START, BIOS_LENGTH, bios), ("RAM", RAM_START, RAM_LENGTH, ram)]:
+    loaded = read(c, start, length)
+    differ = np.flatnonzero(loaded != saved)
+    if len(differ) > 0:
+        print("{}: {} bytes differ after loading the delta, first at {:#x}".format(name, len(differ), start + differ[0]))
+        failed = True
+
+c.kill()
+print("FAILED" if failed else "OK")
+sys.exit(1 if failed else 0)
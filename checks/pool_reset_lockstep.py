@@ -0,0 +1,53 @@
+# Checks that ConsolePool.reset followed by step(1) leaves every console on
+# the same frame count and RAM as a fresh step(1) from the snapshot did
+# Run:
+#   python checks/pool_reset_lockstep.py <PATH TO ISO> <Optional: consoles, default 4> <Optional: resets, default 20>
+
+from __future__ import print_function
+import sys
+import time
+import numpy as np
+from psxle import ConsolePool
+
+iso = sys.argv[1]
+n = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+resets = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+RAM_START, RAM_LENGTH = 0x80000000, 0x200000
+
+def frame_counts(pool):
+    return [c.emulation_stats()[0] for c in pool.consoles]
+
+def rams(pool):
+    return [np.frombuffer(r, dtype=np.uint8) for r in pool.read_bytes(RAM_START, RAM_LENGTH)]
+
+pool = ConsolePool(iso, n)
+pool.run()
+# Let the games boot before we start checking
+time.sleep(5)
+# Leaves every console frozen on a frame boundary
+pool.step(1, observe=False)
+pool.snapshot("check")
+
+start = frame_counts(pool)
+pool.step(1, observe=False)
+fresh = [f - s for f, s in zip(frame_counts(pool), start)]
+fresh_rams = rams(pool)
+
+failed = False
+for trial in range(resets):
+    start = frame_counts(pool)
+    pool.reset("check", frames=1, observe=False)
+    stepped = [f - s for f, s in zip(frame_counts(pool), start)]
+    if stepped != fresh:
+        print("reset {}: frames stepped {}, a fresh step took {}".format(trial, stepped, fresh))
+        failed = True
+    for i, (after_reset, after_fresh) in enumerate(zip(rams(pool), fresh_rams)):
+        if not np.array_equal(after_reset, after_fresh):
+            print("reset {}: console {} RAM differs in {} bytes".format(
+                trial, i, np.count_nonzero(after_reset != after_fresh)))
+            failed = True
+
+pool.kill()
+print("FAILED" if failed else "OK")
+sys.exit(1 if failed else 0)
@@ -0,0 +1,65 @@
+# Checks that restoring a snapshot on a frozen console and stepping n frames
+# lands exactly where a straight run of n frames from the snapshot does, and
+# that resetting over and over does not grow the emulator's stack
+# Run:
+#   python checks/restore_determinism.py <PATH TO ISO> <Optional: frames, default 5> <Optional: resets, default 2000>
+
+from __future__ import print_function
+import sys
+import time
+import numpy as np
+from psxle import Console, Display
+
+iso = sys.argv[1]
+frames = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+resets = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+
+RAM_START, RAM_LENGTH = 0x80000000, 0x200000
+
+def stack_kb(c):
+    with open("/proc/{}/status".format(c.process.pid)) as f:
+        for line in f:
+            if line.startswith("VmStk:"):
+                return int(line.split()[1])
+
+def run_from_snapshot(c):
+    # Frames actually emulated, main RAM and the screen after the step
+    start = c.emulation_stats()[0]
+    screen = c.step(frames)
+    return c.emulation_stats()[0] - start, np.frombuffer(c.read_bytes(RAM_START, RAM_LENGTH), dtype=np.uint8), screen
+
+# No Xvfb wrapper, so the process is the emulator itself
+c = Console(iso, display=Display.HEADLESS)
+c.run()
+# Let the game boot before we start checking
+time.sleep(5)
+c.freeze()
+c.snapshot("check")
+
+failed = False
+straight = run_from_snapshot(c)
+for trial in range(3):
+    c.restore("check")
+    restored = run_from_snapshot(c)
+    if restored[0] != straight[0] or restored[0] != frames:
+        print("restore {}: stepped {} frames, a straight run stepped {}".format(trial, restored[0], straight[0]))
+        failed = True
+    if not np.array_equal(restored[1], straight[1]):
+        print("restore {}: RAM differs in {} bytes".format(trial, np.count_nonzero(restored[1] != straight[1])))
+        failed = True
+    if not np.array_equal(restored[2], straight[2]):
+        print("restore {}: screen differs".format(trial))
+        failed = True
+
+before = stack_kb(c)
+for _ in range(resets):
+    c.restore("check")
+    c.step(1, observe=False)
+growth = stack_kb(c) - before
+print("stack grew by {} KB over {} resets".format(growth, resets))
+if growth > 64:
+    failed = True
+
+c.kill()
+print("FAILED" if failed else "OK")
+sys.exit(1 if failed else 0)
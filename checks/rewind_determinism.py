@@ -0,0 +1,76 @@
+# Checks that rewinding a frozen console lands exactly on the frame it
+# captured, without emulating anything, that stepping on from there replays
+# the original run, and that rewinding over and over does not grow the
+# emulator's stack
+# Run:
+#   python checks/rewind_determinism.py <PATH TO ISO> <Optional: frames recorded, default 10> <Optional: rewinds, default 2000>
+
+from __future__ import print_function
+import sys
+import time
+import numpy as np
+from psxle import Console, Display
+
+iso = sys.argv[1]
+frames = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+rewinds = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+
+RAM_START, RAM_LENGTH = 0x80000000, 0x200000
+
+def stack_kb(c):
+    with open("/proc/{}/status".format(c.process.pid)) as f:
+        for line in f:
+            if line.startswith("VmStk:"):
+                return int(line.split()[1])
+
+def ram(c):
+    return np.frombuffer(c.read_bytes(RAM_START, RAM_LENGTH), dtype=np.uint8)
+
+def frame_count(c):
+    return c.emulation_stats()[0]
+
+# No Xvfb wrapper, so the process is the emulator itself
+c = Console(iso, display=Display.HEADLESS)
+c.run()
+# Let the game boot before we start checking
+time.sleep(5)
+c.freeze()
+c.enable_rewind(every=1, capacity=2 * frames)
+
+# recorded[j] is main RAM after j + 1 single-frame steps
+recorded = []
+for _ in range(frames):
+    c.step(1, observe=False)
+    recorded.append(ram(c))
+
+failed = False
+for steps in [1, 3, frames // 2]:
+    # The current frame is captured first, so rewind(1) stays where we are
+    start = frame_count(c)
+    c.rewind(steps)
+    if frame_count(c) != start:
+        print("rewind({}) emulated {} frames".format(steps, frame_count(c) - start))
+        failed = True
+    for j in range(frames - steps, frames):
+        if j > frames - steps:
+            c.step(1, observe=False)
+        if not np.array_equal(ram(c), recorded[j]):
+            print("rewind({}): RAM differs from the original run after step {}".format(steps, j + 1))
+            failed = True
+            break
+    if frame_count(c) - start != steps - 1:
+        print("rewind({}): {} frames to replay {} steps".format(steps, frame_count(c) - start, steps - 1))
+        failed = True
+
+before = stack_kb(c)
+for _ in range(rewinds):
+    c.step(1, observe=False)
+    c.rewind(2)
+growth = stack_kb(c) - before
+print("stack grew by {} KB over {} rewinds".format(growth, rewinds))
+if growth > 64:
+    failed = True
+
+c.kill()
+print("FAILED" if failed else "OK")
+sys.exit(1 if failed else 0)
@@ -45,7 +45,7 @@ print("PSXLE will be installed into", install_location)
 
 raw_input("Press enter to continue...")
 
-to_copy = ["peopsxgl/libpeopsxgl.so", "dfsound/libDFSound.so", "dfcdrom/libDFCdrom.so", "bladesio1/libBladeSio1.so", "dfinput/libDFInput.so"]
+to_copy = ["peopsxgl/libpeopsxgl.so", "dfsound/libDFSound.so", "dfcdrom/libDFCdrom.so", "bladesio1/libBladeSio1.so", "dfinput/libDFInput.so", "dfxvideo/libDFXVideo.so"]
 
 try:
     os.mkdir(install_location+"/plugins")
@@ -13,6 +13,14 @@ import sys
 import stat
 import tempfile
 import struct
+import contextlib
+import collections
+import mmap
+import select
+import shutil
+import uuid
+import weakref
+from concurrent.futures import Future
 from PIL import Image
 
 
@@ -28,28 +36,157 @@ class ConfigurationChangeWhileRunningException(Exception):
     def __init__(self,*args,**kwargs):
         Exception.__init__(self,*args,**kwargs)
 
+class CommandFailedException(Exception):
+    def __init__(self,*args,**kwargs):
+        Exception.__init__(self,*args,**kwargs)
+
 class MemoryListener():
-    def __init__(self, key, start, length, callback, start_silent=False, fresh_only=False, use_buffer=False):
+    def __init__(self, key, start, length, callback, start_silent=False, fresh_only=False, use_buffer=False, buffer_frames=1, ordered=True):
         self.start, self.length, self.callback, self.key = start, length, callback, key
         self.start_silent, self.fresh_only, self.use_buffer = start_silent, fresh_only, use_buffer
+        self.buffer_frames, self.ordered = buffer_frames, ordered
         return
 
-class SharedPSXCallbackManager():
-    def __init__(self):
-        self.arrival_times = {}
-
-    def get_last(self, cond):
-        return self.arrival_times.get(cond, 0)
-
-    def unchanged(self, cond, value):
-        return self.get_last(cond) <= value
+class CallbackExecutor():
+    # Runs listener callbacks on worker threads so a slow callback does not
+    # hold up the -mem pipe. Callbacks of an ordered listener run one at a
+    # time in arrival order, the others run as soon as a worker is free.
+    # Once max_pending callbacks are waiting, the policy decides:
+    #   "block"       the pipe reader waits, which in turn slows the emulator.
+    #                 Callbacks must not block on Console replies in this mode.
+    #   "drop_newest" the incoming update is discarded
+    #   "drop_oldest" the oldest waiting update is discarded
+    POLICIES = ("block", "drop_newest", "drop_oldest")
+
+    def __init__(self, workers=4, max_pending=1024, policy="block"):
+        if policy not in CallbackExecutor.POLICIES:
+            raise ValueError("Unknown policy {}".format(policy))
+        self.max_pending, self.policy = max_pending, policy
+        self.condition = threading.Condition()
+        # Updates are [listener, value, queued]. ready holds the ones a worker
+        # may start now; an ordered listener has at most one update there or
+        # running (its key is in busy), the rest wait behind it in waiting.
+        self.ready = collections.deque()
+        self.waiting = {}
+        self.busy = set()
+        # Every queued update oldest first, kept for drop_oldest only.
+        # Dropped updates are marked and skipped where they sit.
+        self.arrivals = collections.deque()
+        self.pending = 0
+        self.running = 0
+        self.dropped = 0
+        self.completed = 0
+        self.max_depth = 0
+        self.stopped = False
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for w in self.workers:
+            w.start()
+
+    def submit(self, listener, value):
+        with self.condition:
+            if self.stopped:
+                return
+            if self.pending >= self.max_pending:
+                if self.policy == "drop_newest":
+                    self.dropped += 1
+                    return
+                elif self.policy == "drop_oldest":
+                    self._drop_oldest()
+                else:
+                    self.condition.wait_for(lambda: self.pending < self.max_pending or self.stopped)
+                    # The workers may be gone already, nobody would run it
+                    if self.stopped:
+                        return
+            update = [listener, value, True]
+            if not listener.ordered:
+                self.ready.append(update)
+            elif listener.key in self.busy:
+                self.waiting.setdefault(listener.key, collections.deque()).append(update)
+            else:
+                self.busy.add(listener.key)
+                self.ready.append(update)
+            if self.policy == "drop_oldest":
+                self.arrivals.append(update)
+            self.pending += 1
+            self.max_depth = max(self.max_depth, self.pending)
+            self.condition.notify_all()
+
+    def _drop_oldest(self):
+        while self.arrivals:
+            update = self.arrivals.popleft()
+            if update[2]:
+                update[2] = False
+                self.pending -= 1
+                self.dropped += 1
+                return
 
-    def update(self, cond):
-        self.arrival_times[cond] = time.time()
+    def _advance(self, key):
+        # Hands the next update of an ordered listener to the workers
+        waiting = self.waiting.get(key)
+        while waiting:
+            update = waiting.popleft()
+            if update[2]:
+                self.ready.append(update)
+                return
+        self.waiting.pop(key, None)
+        self.busy.discard(key)
+
+    def _take(self):
+        while self.ready:
+            update = self.ready.popleft()
+            if update[2]:
+                update[2] = False
+                self.pending -= 1
+                while self.arrivals and not self.arrivals[0][2]:
+                    self.arrivals.popleft()
+                return update
+            # Dropped while it waited, let the listener's next update through
+            if update[0].ordered:
+                self._advance(update[0].key)
+        return None
+
+    def _work(self):
+        while True:
+            with self.condition:
+                update = self._take()
+                while update is None:
+                    if self.stopped and self.pending == 0:
+                        return
+                    self.condition.wait()
+                    update = self._take()
+                listener, value = update[0], update[1]
+                self.running += 1
+            try:
+                listener.callback(value)
+            except Exception as e:
+                print("Memory listener {} raised: {!r}".format(listener.key, e), file=sys.stderr)
+            with self.condition:
+                if listener.ordered:
+                    self._advance(listener.key)
+                self.running -= 1
+                self.completed += 1
+                self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {"pending": self.pending, "running": self.running, "max_pending": self.max_depth,
+                    "completed": self.completed, "dropped": self.dropped}
+
+    def shutdown(self):
+        # Lets the workers finish what is queued
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for w in self.workers:
+            if w is not threading.current_thread():
+                w.join()
 
 class Display:
     NONE = 0
     NORMAL = 1
+    # Software renderer (DFXVideo) with no X display at all, frames are
+    # converted straight from VRAM
+    HEADLESS = 3
 
 class Control:
     START = 3
@@ -62,11 +199,128 @@ class Control:
     CROSS = 14
     SQUARE = 15
 
+class XvfbPool():
+    # Headless consoles share a few long lived Xvfb servers instead of each
+    # starting its own through xvfb-run. A server is started when every
+    # running one already has per_display consoles, and all of them are
+    # stopped at exit. The screen only needs to hold the 640x480 window.
+    start_timeout = 10
+
+    def __init__(self, screen="640x480x24", per_display=16):
+        self.screen = screen
+        self.per_display = per_display
+        self._lock = threading.Lock()
+        # [process, display, consoles using it]
+        self._servers = []
+        weakref.finalize(self, XvfbPool._stop, self._servers)
+
+    def acquire(self):
+        # Returns a DISPLAY value, or None if Xvfb can not be started
+        with self._lock:
+            self._servers[:] = [server for server in self._servers if server[0].poll() is None]
+            available = [server for server in self._servers if server[2] < self.per_display]
+            if available:
+                server = min(available, key=lambda server: server[2])
+            else:
+                server = self._start()
+                if server is None:
+                    return None
+                self._servers.append(server)
+            server[2] += 1
+            return server[1]
+
+    def release(self, display):
+        with self._lock:
+            for server in self._servers:
+                if server[1] == display and server[2] > 0:
+                    server[2] -= 1
+                    break
+
+    def _start(self):
+        if shutil.which("Xvfb") is None:
+            return None
+        # Xvfb picks a free display and writes its number once it accepts
+        # connections, so there is no race for a display and no polling
+        read, write = os.pipe()
+        try:
+            process = subprocess.Popen(["Xvfb", "-displayfd", str(write), "-screen", "0", self.screen, "-nolisten", "tcp"],
+                                       pass_fds=(write,), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        finally:
+            os.close(write)
+        number = b""
+        timelimit = time.time() + XvfbPool.start_timeout
+        try:
+            while not number.endswith(b"\n") and time.time() < timelimit:
+                if not select.select([read], [], [], max(0, timelimit - time.time()))[0]:
+                    break
+                chunk = os.read(read, 16)
+                if not chunk:
+                    break
+                number += chunk
+        finally:
+            os.close(read)
+        if not number.strip().isdigit():
+            process.kill()
+            process.wait()
+            return None
+        return [process, ":" + number.strip().decode("ascii"), 0]
+
+    @staticmethod
+    def _stop(servers):
+        for server in servers:
+            if server[0].poll() is None:
+                server[0].terminate()
+                server[0].wait()
+        servers[:] = []
+
+    def shutdown(self):
+        # Stops every server, consoles still using one lose their display
+        with self._lock:
+            XvfbPool._stop(self._servers)
+
 class Console:
     OPS_COUNT = 16
     CONTROLLERS = 2
-
-    unique_instance_id = itertools.count()
+    SCREEN_SHAPE = (480, 640, 3)
+    SCREEN_BYTES = 480*640*3
+    RAM_BYTES = 0x200000
+    RAM_SHM_BYTES = 0x220000
+
+    FRAME_RING_MAGIC = 0x46585350
+    FRAME_RING_HEADER = np.dtype([("magic", "<u4"), ("version", "<u4"), ("slots", "<u4"),
+                                  ("width", "<u4"), ("height", "<u4"), ("channels", "<u4"),
+                                  ("header_size", "<u4"), ("slot_stride", "<u4"), ("latest", "<u8")])
+    FRAME_SLOT_HEADER = np.dtype([("sequence", "<u8"), ("frame", "<u8")])
+
+    # Audio stream ring, created here and filled by the sound plugin: a
+    # 64 byte header then `capacity` int16 samples, channels interleaved
+    AUDIO_RATE = 44100
+    AUDIO_RING_MAGIC = 0x41585350
+    AUDIO_RING_HEADER_BYTES = 64
+    AUDIO_RING_HEADER = np.dtype([("magic", "<u4"), ("capacity", "<u4"), ("channels", "<u4"),
+                                  ("reserved", "<u4"), ("written", "<u8")])
+
+    # -proc requests: version, opcode, reserved, request id, payload length
+    # -mem replies: REPLY_MARKER, then opcode, status, reserved, request id, payload length
+    PROTOCOL_VERSION = 2
+    REQUEST_HEADER = struct.Struct("<BBHII")
+    REPLY_MARKER = 0xff
+    REPLY_HEADER = struct.Struct("<BBBII")
+    REPLY_ERRORS = {1: "failed", 2: "unknown opcode", 3: "busy", 4: "bad request"}
+    # Listener updates: EVENT_MARKER, then event count, byte length, cycle and
+    # frame, then the events (key byte, byte count, the listener's bytes)
+    EVENT_MARKER = 0xfe
+    EVENT_HEADER = struct.Struct("<3xIIIQ")
+    EVENT_ENTRY = struct.Struct("<BI")
+    reply_timeout = 10
+
+    MAX_STATE_SLOTS = 256
+    # "best" is the default and the only codec that keeps the slot screenshot
+    STATE_CODECS = {"none": 0, "fast": 1, "best": 2}
+
+    HEADLESS_GPU = "libDFXVideo.so"
+    # Displays for Display.NONE consoles, set to None to use xvfb-run instead
+    xvfb_pool = XvfbPool()
     shared_memory_timeout = 3
     cfg_path = os.path.expanduser("~/.psxle")
 
@@ -86,7 +340,7 @@ class Console:
     def error(self, *args):
         print(*args, file=sys.stderr)
 
-    def __init__(self, playing, start=None, gui=False, display=Display.NORMAL, debug=False, custom_log=None):
+    def __init__(self, playing, start=None, gui=False, display=Display.NORMAL, debug=False, custom_log=None, frame_ring=0, shared_ram=False, cpus=None):
         self.debug = debug
         self.custom_log = custom_log
         self.control = False
@@ -99,11 +353,24 @@ class Console:
             # non-existant iso
             raise ISONotFoundException(self._iso)
 
-        self._unique = next(self.unique_instance_id)
+        # Everything the console shares with the emulator is named after this
+        # token or reserved by the kernel (see _reserve_segment), so consoles in
+        # different Python processes never collide. The finalizer removes
+        # whatever kill() did not, even if the object is just dropped.
+        self._ipc_token = "{}-{}".format(os.getpid(), uuid.uuid4().hex)
+        self._ipc = {"dir": None, "segments": [], "files": []}
+        weakref.finalize(self, Console._release_ipc, self._ipc)
 
         self._memory_listener_list = []
         self._memory_listener_coverage = None
         self._memory_listeners = None
+        self._listener_table = [None] * 128
+        self._callback_executor = None
+        self._callback_executor_args = None
+        # Frame and CPU cycle of the listener record being dispatched (the
+        # newest one received when callbacks run on an executor)
+        self.event_frame = None
+        self.event_cycle = None
 
         self.paused = False
         self.display = display
@@ -113,32 +380,102 @@ class Console:
         self.is_recording_audio = False
 
         self.recordingFile = None
+        self._audio_stream_name = None
+        self._audio_stream_map = None
+        self._audio_stream = None
+        self._audio_read = 0
+        self.audio_dropped = 0
         self.game_state = start
-        self.cb_handler = SharedPSXCallbackManager()
         self.statusMethods = {}
-        self.sharedCommMemory = None
+        self._screen_memory = None
+        self._observation_memory = None
+        self.observation_shape = None
+
+        self._proc_lock = threading.Lock()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._request_ids = itertools.count(1)
+        self._pipelining = 0
+
+        self._frame_ring_slots = frame_ring
+        self._frame_ring_memory = None
+        self._frame_ring = None
+
+        self._shared_ram = shared_ram
+        # CPUs the emulator (and its X server) may run on, None for any
+        self._cpus = None if cpus is None else sorted(cpus)
+        self._x_display = None
+        self._x_pool = None
+        self._ram_shm_name = "/psxle-ram-{}".format(self._ipc_token)
+        self._ipc["files"].append("/dev/shm" + self._ram_shm_name)
+        self._ram_map = None
+        self._ram = None
+
+        self._state_slots = {}
+        self._start_path = None
 
         # Callbacks:
         self._on_state_load = None
         self._on_state_save = None
         self._on_audio_finish_record = None
 
-    def _await_cb_notification(self,cond, timeout=10, start=None):
-        start_time = time.time()
-        max_time = start_time + timeout
-        rec = self.cb_handler.get_last(cond) if start is None else start
-        # While we haven't seen changes to the timestamp of the condition
-        while self.cb_handler.unchanged(cond, rec) and time.time() < max_time:
-            # Wait for 0.1 seconds
-            time.sleep(0.1)
-        if self.cb_handler.unchanged(cond, rec):
-            self.error("Failed while waiting for {} (took: {})".format(cond, int(time.time())-start_time))
-        return not self.cb_handler.unchanged(cond, rec)
+    def _send(self, opcode, payload=b"", track=True):
+        # Every request carries its own id, the emulator echoes it in the
+        # reply and the IPC thread resolves the matching future.
+        future = Future()
+        with self._proc_lock:
+            # Id 0 is reserved by the emulator
+            request_id = (next(self._request_ids) - 1) % 0xffffffff + 1
+            if track:
+                with self._pending_lock:
+                    self._pending[request_id] = future
+            self.proc_pipe.write(Console.REQUEST_HEADER.pack(Console.PROTOCOL_VERSION, opcode, 0, request_id, len(payload)))
+            self.proc_pipe.write(payload)
+            if self._pipelining == 0:
+                self.proc_pipe.flush()
+        return future
 
-    def _flush_then_wait(self, cond, pipe):
-        rec = self.cb_handler.get_last(cond)
-        pipe.flush()
-        return self._await_cb_notification(cond, start=rec)
+    def _resolve(self, request_id, opcode, status, data):
+        with self._pending_lock:
+            future = self._pending.pop(request_id, None)
+        if future is None:
+            self.log("Reply to unknown request {} (opcode {})".format(request_id, opcode))
+            return
+        if status == 0:
+            future.set_result(data)
+        else:
+            reason = Console.REPLY_ERRORS.get(status, "status {}".format(status))
+            future.set_exception(CommandFailedException("Opcode {} {}".format(opcode, reason)))
+
+    def _fail_pending(self, reason):
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(CommandFailedException(reason))
+
+    def _wait(self, future, timeout=None):
+        # Returns the reply payload, or None if the request failed
+        if self._pipelining > 0:
+            with self._proc_lock:
+                self.proc_pipe.flush()
+        try:
+            return future.result(Console.reply_timeout if timeout is None else timeout)
+        except Exception as ex:
+            self.error("Request failed: {}".format(ex if str(ex) else type(ex).__name__))
+            return None
+
+    @contextlib.contextmanager
+    def pipelined(self):
+        # Requests issued inside the block are written in one go on exit
+        with self._proc_lock:
+            self._pipelining += 1
+        try:
+            yield self
+        finally:
+            with self._proc_lock:
+                self._pipelining -= 1
+                if self._pipelining == 0:
+                    self.proc_pipe.flush()
 
 
     def _attach_control_pipe(self,pipename):
@@ -169,8 +506,32 @@ class Console:
         return pipe
 
     def _clear_shared_memory(self):
-        self.proc_pipe.write(bytes([12,23]))
-        self.proc_pipe.flush()
+        self._send(12)
+
+    def _reserve_segment(self, size):
+        # The kernel picks an unused key, the emulator then attaches to the
+        # segment under that key instead of creating its own
+        memory = sysv_ipc.SharedMemory(None, sysv_ipc.IPC_CREX, mode=0o600, size=size)
+        self._ipc["segments"].append(memory.id)
+        return memory
+
+    @staticmethod
+    def _release_ipc(ipc):
+        # Must not reference the console, it runs from its finalizer
+        for segment in ipc["segments"]:
+            try:
+                sysv_ipc.remove_shared_memory(segment)
+            except sysv_ipc.Error:
+                pass
+        ipc["segments"] = []
+        for path in ipc["files"]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        if ipc["dir"] is not None:
+            shutil.rmtree(ipc["dir"], ignore_errors=True)
+            ipc["dir"] = None
 
 
     def _get_state_path(self, name):
@@ -210,8 +571,18 @@ class Console:
 
         exc = []
 
+        if self._cpus:
+            exc += ["taskset", "-c", ",".join(str(cpu) for cpu in self._cpus)]
+
+        env = None
         if self.display == Display.NONE:
-            exc += ["xvfb-run", "-a", "-s", "-screen 0 1400x900x24"]
+            if Console.xvfb_pool is not None:
+                self._x_pool = Console.xvfb_pool
+                self._x_display = self._x_pool.acquire()
+            if self._x_display is not None:
+                env = dict(os.environ, DISPLAY=self._x_display)
+            else:
+                exc += ["xvfb-run", "-a", "-s", "-screen 0 1400x900x24"]
 
         exc.append(Console.cfg_path+"/psxle")
         exc.append("-cfg")
@@ -224,15 +595,32 @@ class Console:
         else:
             exc.append("-display")
             exc.append(str(self.display))
+            if self.display == Display.HEADLESS:
+                exc.append("-gpu")
+                exc.append(Console.HEADLESS_GPU)
             exc.append("-controlPipe")
-            pipeName = "{}/ml_psxemu{}".format(os.environ['TMPDIR'] if 'TMPDIR' in os.environ else "/tmp",self._unique)
+            # Private pipe directory, honours TMPDIR
+            self._ipc["dir"] = tempfile.mkdtemp(prefix="psxle-{}-".format(os.getpid()))
+            pipeName = os.path.join(self._ipc["dir"], "ml_psxemu")
             controlPipeName = pipeName+"-joy"
             proceedurePipeName = pipeName+"-proc"
             memPipeName = pipeName+"-mem"
             exc.append(pipeName)
             exc.append("-nMemoryListeners")
             exc.append(str(len(self._memory_listener_list)))
-            if self.game_state:
+            if self._shared_ram:
+                exc.append("-ramShm")
+                exc.append(self._ram_shm_name)
+            if self._frame_ring_slots > 0:
+                exc.append("-frameRing")
+                self._frame_ring_memory = self._reserve_segment(self._frame_ring_bytes())
+                exc.append(str(self._frame_ring_memory.key))
+                exc.append(str(self._frame_ring_slots))
+            if self._start_path:
+                # Clones boot straight into their parent's snapshot
+                exc.append("-loadState")
+                exc.append(self._start_path)
+            elif self.game_state:
                 playstatepath = self._get_state_path(self.game_state)
                 if os.path.exists(playstatepath):
                     exc.append("-loadState")
@@ -245,24 +633,25 @@ class Console:
                 self.log("The game ISO '{}' is not available.".format(self._iso))
 
         self._memory_listeners = tempfile.NamedTemporaryFile()
+        self._listener_table = [None] * 128
+        for interest in self._memory_listener_list:
+            self._listener_table[interest.key] = interest
 
         for interest in self._memory_listener_list:
-            key = (0b10000000 if interest.start_silent else 0) | interest.key
-            self._memory_listeners.write(interest.start.to_bytes(4, "little"))
-            self._memory_listeners.write(interest.length.to_bytes(4, "little"))
-            self._memory_listeners.write(bytes([key,1 if interest.fresh_only else 0,1 if interest.use_buffer else 0,0]))
+            self._memory_listeners.write(self._listener_record(interest))
 
         self._memory_listeners.seek(0)
         if self.debug:
-            sub = subprocess.Popen(exc, stdin=self._memory_listeners)
+            sub = subprocess.Popen(exc, stdin=self._memory_listeners, env=env)
         else:
-            sub = subprocess.Popen(exc, stdin=self._memory_listeners, stdout=subprocess.PIPE)
+            sub = subprocess.Popen(exc, stdin=self._memory_listeners, stdout=subprocess.PIPE, env=env)
 
         self.process = sub
         self.running = True
         self.memory_cb_pipe = self._attach_cb_pipe(memPipeName)
         self.control_emu_pipe = self._attach_control_pipe(controlPipeName)
         self.proc_pipe = self._attach_control_pipe(proceedurePipeName)
+        self._start_callback_executor()
         self.reversePipeThread = IPCThread(self)
         self.reversePipeThread.start()
         self.control = True
@@ -272,17 +661,43 @@ class Console:
             if self.paused:
                 self.unfreeze(block=True)
             self._clear_shared_memory()
-            self.proc_pipe.write(bytes([1]))
-            self.proc_pipe.flush()
+            if self._screen_memory is not None:
+                self._screen_memory.detach()
+                self._screen_memory = None
+            self._drop_observation_memory()
+            self._detach_frame_ring()
+            self._detach_ram()
+            self._close_audio_stream()
+            self._send(1, track=False)
             self.reversePipeThread.stop()
             self.reversePipeThread.join()
+            # Callbacks already queued still run
+            if self._callback_executor is not None:
+                self._callback_executor.shutdown()
+                self._callback_executor = None
+            self._fail_pending("Console was killed")
             self.memory_cb_pipe.close()
             self.proc_pipe.close()
             self.control_emu_pipe.close()
             if self._memory_listeners:
                 self._memory_listeners.close()
+            # The emulator removes its slots on exit
+            self._state_slots = {}
+            Console._release_ipc(self._ipc)
+            if self._x_display is not None:
+                self._x_pool.release(self._x_display)
+                self._x_display = None
             self.running = False
 
+    def ping_async(self):
+        return self._send(50)
+
+    def ping(self):
+        # Round trip through the command loop without touching the emulation
+        if not self.running:
+            return False
+        return self._wait(self.ping_async()) is not None
+
     ################################################################################################################
     ################################################################################################################
     ################################################################################################################
@@ -296,17 +711,16 @@ class Console:
             if self.paused:
                 return True
             self.log("Pausing...")
-            self.proc_pipe.write(bytes([2]))
+            future = self._send(2)
             if block:
-                success = self._flush_then_wait(7, self.proc_pipe)
+                success = self._wait(future) is not None
                 self.paused = success
                 if not success:
                     self.log("Failed to pause!")
                 return success
             else:
                 self.paused = True
-                self.proc_pipe.flush()
-                return True
+                return future
         else:
             print("Cannot pause emulator that is not running.")
 
@@ -315,19 +729,66 @@ class Console:
             return
         if not self.paused:
             return True
-        self.proc_pipe.write(bytes([3]))
+        future = self._send(3)
         self.log("Resuming...")
 
         if block:
-            success = self._flush_then_wait(8, self.proc_pipe)
+            success = self._wait(future) is not None
             self.paused = not success
             if not success:
                 self.log("Failed to resume!")
             return success
         else:
-            self.proc_pipe.flush()
             self.paused = False
+            return future
+
+    # Lockstep:
+
+    def step(self, frames=1, inputs=None, observe=True, copy=True, out=None):
+        # Runs exactly `frames` vsyncs and leaves the console frozen on the last one.
+        # inputs: buttons held for the whole step, a list of Control values for
+        # controller 0 or a dict {controller: [buttons]}; None keeps the current ones.
+        # Returns the last frame, or the observation once set_observation has
+        # been called (True if observe=False), None on failure.
+        if not self.running:
+            print("Cannot step emulator that is not running.")
+            return None
+        future, source = self._step_request(frames, inputs, observe)
+        return self._step_result(future, source, observe, copy, out)
+
+    def _step_request(self, frames, inputs, observe):
+        buttons, flags = [0, 0], 0
+        if inputs is not None:
+            flags = 1
+            if not isinstance(inputs, dict):
+                inputs = {0: inputs}
+            for controller, pressed in inputs.items():
+                for button in pressed:
+                    buttons[controller] |= 1 << button
+        source, key = None, 0
+        if observe:
+            if self._observation_memory is not None:
+                source = "observation"
+                flags |= 2
+            elif self._frame_ring_slots > 0:
+                source = "ring"
+            else:
+                source = "screen"
+                key = self._snapshot_key()
+        future = self._send(29, struct.pack("<IiHHB", frames, key, buttons[0], buttons[1], flags))
+        return future, source
+
+    def _step_result(self, future, source, observe, copy, out):
+        if self._wait(future) is None:
+            return None
+        self.paused = True
+        if not observe:
             return True
+        if source == "observation":
+            return self._read_observation(copy, out)
+        if source == "ring":
+            return self.latest_frame(out)[1]
+        return self._read_screen(copy, out)
 
     ################################################################################################################
     ################################################################################################################
@@ -403,9 +864,7 @@ class Console:
         if not self.running:
             print("Not running - speed can only be set for running consoles.")
             return None
-        self.proc_pipe.write(bytes([43]))
-        self.proc_pipe.write((val).to_bytes(4, byteorder='big'))
-        return self._flush_then_wait(10, self.proc_pipe)
+        return self._wait(self._send(43, struct.pack("<i", val))) is not None
 
     # For legacy code:
 
@@ -413,16 +872,36 @@ class Console:
         if not self.running:
             print("Not running - speed can only be set for running consoles.")
             return None
-        self.proc_pipe.write(bytes([43]))
-        self.proc_pipe.write((val).to_bytes(4, byteorder='big'))
+        future = self._send(43, struct.pack("<i", val))
         if block:
-            return self._flush_then_wait(10, self.proc_pipe)
+            return self._wait(future) is not None
         else:
-            self.proc_pipe.flush()
-            return True
+            return future
 
 
 
+    def turbo(self, enabled=True, render_every=0, block=True):
+        # Turbo runs as fast as the CPU allows. Frames are only rasterized when
+        # they are observed (get_screen, step) or, with render_every=N, one in N
+        # (which is also what feeds the frame ring).
+        if not self.running:
+            print("Not running - turbo can only be set for running consoles.")
+            return None
+        future = self._send(44, struct.pack("<II", 1 if enabled else 0, render_every))
+        if block:
+            return self._wait(future) is not None
+        else:
+            return future
+
+    def emulation_stats(self):
+        # (frames emulated since boot, emulated frames per second)
+        if not self.running:
+            return None
+        data = self._wait(self._send(45))
+        if data is None:
+            return None
+        return struct.unpack("<Qd", data)
+
     ################################################################################################################
     ################################################################################################################
     ################################################################################################################
@@ -431,18 +910,29 @@ class Console:
 
     # State save / load:
 
-    def save_state(self, name, callback=None):
+    def save_state(self, name, callback=None, block=False, codec="best", base=None):
+        # With a base (the name of a full state), only the RAM and BIOS pages
+        # that differ from it are stored; loading the delta also loads the base.
         if not self.running:
             return False
-        if not name.isalnum():
+        if not name.isalnum() or codec not in Console.STATE_CODECS:
+            return False
+        if base is not None and (not base.isalnum() or not os.path.exists(self._get_state_path(base))):
             return False
         if self.paused:
             self.unfreeze(block=True)
         path = self._get_state_path(name)
         self.handle_state_save(callback)
-        self.proc_pipe.write(bytes([41, len(path)]))
-        self.proc_pipe.write(path.encode("ascii"))
-        self.proc_pipe.flush()
+        if codec == "best" and base is None:
+            future = self._send(41, path.encode("ascii"))
+        else:
+            base_path = self._get_state_path(base).encode("ascii") if base is not None else b""
+            future = self._send(49, struct.pack("<II", Console.STATE_CODECS[codec], len(base_path))
+                                + base_path + path.encode("ascii"))
+        if block:
+            return self._wait(future) is not None
+        else:
+            return future
 
     def load_state(self, name, callback=None, block=False):
         if not name.isalnum():
@@ -455,13 +945,125 @@ class Console:
             if not os.path.exists(path):
                 return False
             self.handle_state_load(callback)
-            self.proc_pipe.write(bytes([42, len(path)]))
-            self.proc_pipe.write(path.encode("ascii"))
+            future = self._send(42, path.encode("ascii"))
             if block:
-                return self._flush_then_wait(2, self.proc_pipe)
+                return self._wait(future) is not None
             else:
-                self.proc_pipe.flush()
-                return True
+                return future
+
+    # In-RAM snapshots: no file and no (or the fastest) compression, and they
+    # also work on a frozen console without resuming it.
+
+    def _state_slot(self, name):
+        if name not in self._state_slots:
+            free = set(range(Console.MAX_STATE_SLOTS)) - set(self._state_slots.values())
+            if not free:
+                self.error("No free snapshot slot for {}".format(name))
+                return None
+            self._state_slots[name] = min(free)
+        return self._state_slots[name]
+
+    def snapshot(self, name="default", compress=False, block=True):
+        if not self.running:
+            return False
+        slot = self._state_slot(name)
+        if slot is None:
+            return False
+        # The reply carries the name of the shared memory object holding the state
+        future = self._send(46, struct.pack("<IB", slot, 1 if compress else 0))
+        if block:
+            return self._wait(future) is not None
+        else:
+            return future
+
+    def restore(self, name="default", block=True):
+        if not self.running or name not in self._state_slots:
+            return False
+        future = self._send(47, struct.pack("<IB", self._state_slots[name], 0))
+        if block:
+            return self._wait(future) is not None
+        else:
+            return future
+
+    def drop_snapshot(self, name="default"):
+        if name not in self._state_slots:
+            return False
+        if not self.running:
+            del self._state_slots[name]
+            return True
+        # Busy while a save or restore is still pending, the slot is kept then
+        if self._wait(self._send(48, struct.pack("<I", self._state_slots[name]))) is None:
+            return False
+        self._state_slots.pop(name, None)
+        return True
+
+    def clone(self, count=1):
+        # Starts count new consoles from this console's current state. The
+        # snapshot stays in shared memory, so clones skip the BIOS and the boot
+        # of the game. Each clone has its own pipes and segments and is
+        # returned running.
+        if not self.running:
+            return None
+        slot = self._state_slot("__clone__")
+        if slot is None:
+            return None
+        name = self._wait(self._send(46, struct.pack("<IB", slot, 0)))
+        if not name:
+            return None
+        path = "/dev/shm/" + name.decode("ascii").lstrip("/")
+
+        clones = []
+        for _ in range(count):
+            c = Console(self._iso, display=self.display, debug=self.debug, custom_log=self.custom_log,
+                        frame_ring=self._frame_ring_slots, shared_ram=self._shared_ram)
+            c._memory_listener_list = list(self._memory_listener_list)
+            c._memory_listener_coverage = self._memory_listener_coverage
+            c._start_path = path
+            clones.append(c)
+
+        # run() returns once the emulator opened its pipes, which it only does
+        # after the state is loaded, so the slot can be replaced afterwards
+        threads = [threading.Thread(target=c.run) for c in clones]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for c in clones:
+            if self._speed != 100:
+                c.speed = self._speed
+        return clones
+
+    # Rewind ring: the emulator captures a state every `every` frames and keeps
+    # the newest `capacity`, all but the newest as page deltas.
+
+    def enable_rewind(self, every=1, capacity=600):
+        if not self.running:
+            return False
+        return self._wait(self._send(51, struct.pack("<II", every, capacity))) is not None
+
+    def disable_rewind(self):
+        if not self.running:
+            return False
+        return self._wait(self._send(51, struct.pack("<II", 0, 0))) is not None
+
+    def rewind(self, steps=1, block=True):
+        # steps=1 goes back to the newest capture, captures after the target are dropped
+        if not self.running:
+            return False
+        future = self._send(52, struct.pack("<I", steps))
+        if block:
+            return self._wait(future) is not None
+        else:
+            return future
+
+    def rewind_stats(self):
+        if not self.running:
+            return None
+        data = self._wait(self._send(53))
+        if data is None:
+            return None
+        captures, capacity, used = struct.unpack("<IIQ", data)
+        return {"captures": captures, "capacity": capacity, "bytes": used}
 
     def handle_state_load(self, f):
         self._on_state_load = f
@@ -476,85 +1078,199 @@ class Console:
 
     # Memory/RAM:
 
-    def add_memory_listener(self, start, lgth, onChange, start_silent=False, only_new=True, buffer=True):
+    @staticmethod
+    def _listener_record(interest):
+        # start, length, key (top bit: start silent), newonly, buffer, window
+        key = (0b10000000 if interest.start_silent else 0) | interest.key
+        return struct.pack("<II", interest.start, interest.length) + bytes([
+            key, 1 if interest.fresh_only else 0, 1 if interest.use_buffer else 0,
+            min(max(interest.buffer_frames, 1), 255)])
+
+    def add_memory_listener(self, start, lgth, onChange, start_silent=False, only_new=True, buffer=True, buffer_frames=1, ordered=True):
+        # A buffered listener reports its first change straight away, then
+        # folds further changes into at most one report per buffer_frames frames.
+        # On a running console the listener is added at the next frame boundary.
+        # ordered only matters with a callback executor (see use_callback_executor).
+        used = set(l.key for l in self._memory_listener_list)
+        free = [k for k in range(128) if k not in used]
+        if not free:
+            self.error("No free memory listener key")
+            return None
+        listener = MemoryListener(free[0], start, lgth, onChange, start_silent, only_new, buffer, buffer_frames, ordered)
+        if self.running:
+            # Known to the IPC thread before its first update can arrive
+            self._listener_table[listener.key] = listener
+            if self._wait(self._send(54, self._listener_record(listener))) is None:
+                self._listener_table[listener.key] = None
+                return None
+        self._memory_listener_list.append(listener)
+        return listener.key
+
+    def remove_memory_listener(self, key):
+        listener = next((l for l in self._memory_listener_list if l.key == key), None)
+        if listener is None:
+            return False
         if self.running:
-            raise ConfigurationChangeWhileRunningException("Must register memory listeners before running an instance. Try using sleep/wake for listeners.")
-        key = len(self._memory_listener_list)
-        self._memory_listener_list.append(MemoryListener(key, start, lgth, onChange, start_silent, only_new, buffer))
-        return key
+            if self._wait(self._send(55, bytes([key]))) is None:
+                return False
+            # Updates sent before the reply have been dispatched by now
+            self._listener_table[key] = None
+        self._memory_listener_list.remove(listener)
+        return True
 
-    def clear_memory_listeners(self):
+    def use_callback_executor(self, workers=4, max_pending=1024, policy="block"):
+        # Opt in to running listener callbacks on a thread pool instead of the
+        # pipe reader thread; workers=0 goes back to inline callbacks
+        self._callback_executor_args = (workers, max_pending, policy) if workers > 0 else None
         if self.running:
-            raise ConfigurationChangeWhileRunningException("Cannot remove listeners while running. Try sleep?")
-        self._memory_listener_list = []
+            self._start_callback_executor()
+
+    def _start_callback_executor(self):
+        previous = self._callback_executor
+        args = self._callback_executor_args
+        self._callback_executor = CallbackExecutor(*args) if args is not None else None
+        if previous is not None:
+            previous.shutdown()
+
+    def callback_stats(self):
+        # Queue depth, running callbacks, peak depth, completed and dropped updates
+        if self._callback_executor is None:
+            return None
+        return self._callback_executor.stats()
+
+    def clear_memory_listeners(self):
+        for listener in list(self._memory_listener_list):
+            self.remove_memory_listener(listener.key)
 
     def wake_memory_listener(self, key):
         if self.running:
-            self.proc_pipe.write(bytes([25]))
-            self.proc_pipe.write(bytes([key]))
-            self.proc_pipe.flush()
+            self._send(25, bytes([key]))
         for i in range(len(self._memory_listener_list)):
             if self._memory_listener_list[i][0] == key:
                 self._memory_listener_list[i][4] == False
 
     def sleep_memory_listener(self, key):
         if self.running:
-            self.proc_pipe.write(bytes([24]))
-            self.proc_pipe.write(bytes([key]))
-            self.proc_pipe.flush()
+            self._send(24, bytes([key]))
         for i in range(len(self._memory_listener_list)):
             if self._memory_listener_list[i][0] == key:
                 self._memory_listener_list[i][4] == True
 
+    # The *_async variants return a concurrent.futures.Future straight away, so
+    # many requests can be in flight at once (see pipelined()).
+
+    def read_bytes_async(self, start, length):
+        return self._send(21, struct.pack("<II", start, length))
+
     def read_bytes(self, start, length):
         if not self.running:
             print("Not running - memory can only be accessed from running consoles.")
             return None
-        self.proc_pipe.write(bytes([21]))
-        self.proc_pipe.write((start).to_bytes(4, byteorder='big'))
-        self.proc_pipe.write((length).to_bytes(4, byteorder='big'))
-        self.proc_pipe.write(bytes([(self._unique+5)*2+1]))
-
-        if not self._flush_then_wait(11, self.proc_pipe):
-            print("Shared memory timeout..")
+        return self._wait(self.read_bytes_async(start, length))
+
+    def read_regions_async(self, regions):
+        # regions is a list of (start, length), the future resolves to a list of bytes
+        regions = list(regions)
+        payload = struct.pack("<I", len(regions)) + b"".join(struct.pack("<II", a, l) for a, l in regions)
+        gathered = self._send(23, payload)
+        future = Future()
+        def split(done):
+            if done.exception() is not None:
+                future.set_exception(done.exception())
+                return
+            data, out, offset = done.result(), [], 0
+            for _, length in regions:
+                out.append(data[offset:offset+length])
+                offset += length
+            future.set_result(out)
+        gathered.add_done_callback(split)
+        return future
+
+    def read_regions(self, regions):
+        # All regions are read in a single round trip, at the same instant
+        if not self.running:
+            print("Not running - memory can only be accessed from running consoles.")
             return None
+        return self._wait(self.read_regions_async(regions))
 
-        if self.sharedCommMemory is None:
-            startTime = time.time()
-            while True:
+    def _attach_ram(self, timeout=None):
+        if self._ram is not None:
+            return self._ram
+        if not self._shared_ram or not self.running:
+            return None
+        path = "/dev/shm/" + self._ram_shm_name.lstrip("/")
+        timelimit = time.time() + (Console.shared_memory_timeout if timeout is None else timeout)
+        while True:
+            try:
+                fd = os.open(path, os.O_RDONLY)
                 try:
-                    self.sharedCommMemory = sysv_ipc.SharedMemory((self._unique+5)*2+1)
-                except sysv_ipc.ExistentialError:
-                    if time.time()-startTime < Console.shared_memory_timeout:
-                        continue
-                    else:
-                        print("Shared memory timeout")
-                        return None
-                except Exception as ex:
-                    print("Shared memory error ",type(ex))
-                    return
-                break
+                    # The emulator sizes the object right after creating it
+                    if os.fstat(fd).st_size >= Console.RAM_SHM_BYTES:
+                        self._ram_map = mmap.mmap(fd, Console.RAM_BYTES, mmap.MAP_SHARED, mmap.PROT_READ)
+                        break
+                finally:
+                    os.close(fd)
+            except FileNotFoundError:
+                pass
+            if time.time() > timelimit:
+                self.log("Shared RAM timeout!")
+                return None
+            time.sleep(0.01)
+        self._ram = np.frombuffer(self._ram_map, dtype=np.uint8)
+        return self._ram
+
+    def _detach_ram(self):
+        self._ram = None
+        if self._ram_map is not None:
+            try:
+                self._ram_map.close()
+            except BufferError:
+                # Views handed out through .ram keep the mapping alive
+                pass
+            self._ram_map = None
 
-        startTime = time.time()
-        try:
-            output = self.sharedCommMemory.read(length)
-        except:
-            output = None
-            print("Shared memory failed.")
-        return output
+    @property
+    def ram(self):
+        # Read-only uint8 view of main RAM (Console(..., shared_ram=True)),
+        # indexed by physical address: c.ram[addr & 0x1fffff]
+        return self._attach_ram()
+
+    def write_byte_async(self, start, val):
+        return self._send(26, struct.pack("<IB", start, val))
 
     def write_byte(self, start, val, block=True):
         if not self.running:
             print("Not running - memory can only be written from running consoles.")
             return None
-        self.proc_pipe.write(bytes([26]))
-        self.proc_pipe.write((start).to_bytes(4, byteorder='big'))
-        self.proc_pipe.write(bytes([val]))
+        future = self.write_byte_async(start, val)
         if block:
-            return self._flush_then_wait(5, self.proc_pipe)
+            return self._wait(future) is not None
         else:
-            self.proc_pipe.flush()
-            return True
+            return future
+
+    def write_regions_async(self, regions):
+        # regions is a list of (start, data); all of them land between the same two frames
+        regions = [(start, bytes(data)) for start, data in regions]
+        payload = [struct.pack("<I", len(regions))]
+        payload += [struct.pack("<II", start, len(data)) for start, data in regions]
+        payload += [data for _, data in regions]
+        return self._send(28, b"".join(payload))
+
+    def write_regions(self, regions, block=True):
+        if not self.running:
+            print("Not running - memory can only be written from running consoles.")
+            return None
+        future = self.write_regions_async(regions)
+        if block:
+            return self._wait(future) is not None
+        else:
+            return future
+
+    def write_bytes_async(self, start, data):
+        return self.write_regions_async([(start, data)])
+
+    def write_bytes(self, start, data, block=True):
+        return self.write_regions([(start, data)], block)
 
     ################################################################################################################
     ################################################################################################################
@@ -571,9 +1287,9 @@ class Console:
         self.log("Recoding audio...")
         self.recordingFile = tempfile.NamedTemporaryFile()
         path = self.recordingFile.name
-        self.proc_pipe.write(bytes([31, len(path)]))
-        self.proc_pipe.write(path.encode("ascii"))
-        self.proc_pipe.flush()
+        if self._wait(self._send(31, path.encode("ascii"))) is None:
+            self.recordingFile.close()
+            return False
         self.is_recording_audio = True
         return True
 
@@ -581,28 +1297,120 @@ class Console:
         if not self.is_recording_audio:
             print("No audio recording.")
             return None
-        self.proc_pipe.write(bytes([32]))
-        self.proc_pipe.flush()
-        out_ints = []
+        # Only read the file once the emulator has stopped writing to it
+        self._wait(self._send(32))
+        samples = None
         if not discard:
             print("Audio conversion taking place...")
             outcome = self.recordingFile.read()
             if len(outcome)%2 != 0:
                 print("There was a _fatal_ audio error")
-            else:
-                for i in range(0, len(outcome), 2):
-                    val = struct.unpack( "h", outcome[i:i+2])
-                    out_ints.append(val)
+            elif len(outcome) > 0:
+                samples = np.frombuffer(outcome, dtype="<i2")
         self.recordingFile.close()
         print("Audio conversion done.")
         self.is_recording_audio = False
-        if len(out_ints) > 0:
-            i = len(out_ints)-1
-            while out_ints[i][0] == 0 and i > 0:
-                i -= 1
-            return np.array(out_ints[:i+1])
-        else:
+        if samples is None:
+            return None
+        # Drop the trailing silence, keeping at least one sample
+        nonzero = np.flatnonzero(samples)
+        end = nonzero[-1]+1 if len(nonzero) > 0 else 1
+        # Same (n, 1) int64 array the sample by sample conversion gave
+        return samples[:end].astype(np.int64).reshape(-1, 1)
+
+    def start_audio_stream(self, seconds=2.0):
+        # Streams the sound output into a shared ring holding `seconds` of
+        # audio, read it back with read_audio while the game runs
+        if not self.running or self.is_recording_audio or self._audio_stream_name is not None:
+            self.error("Unable to stream audio now.")
+            return False
+        capacity = max(1, int(seconds*Console.AUDIO_RATE))*2
+        name = "/psxle-audio-{}".format(self._ipc_token)
+        path = "/dev/shm" + name
+        if path not in self._ipc["files"]:
+            self._ipc["files"].append(path)
+        size = Console.AUDIO_RING_HEADER_BYTES + capacity*2
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            self._audio_stream_map = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+        self._audio_stream_name = name
+        header = np.frombuffer(self._audio_stream_map, dtype=Console.AUDIO_RING_HEADER, count=1)
+        header["capacity"] = capacity
+        self._audio_stream = (header, np.frombuffer(self._audio_stream_map, dtype="<i2",
+                                                    offset=Console.AUDIO_RING_HEADER_BYTES))
+        self._audio_read = 0
+        self.audio_dropped = 0
+        if self._wait(self._send(33, name.encode("ascii"))) is None:
+            self._close_audio_stream()
+            return False
+        return True
+
+    def read_audio(self, frames, block=True, timeout=None):
+        # The next `frames` sample frames of the stream as an int16 array of
+        # shape (frames, channels). Without block, returns whatever is there.
+        # Samples the ring overwrote before they were read are skipped and
+        # counted in audio_dropped.
+        if self._audio_stream is None:
             return None
+        header, ring = self._audio_stream
+        timelimit = None if timeout is None else time.time() + timeout
+        while header["magic"][0] != Console.AUDIO_RING_MAGIC:
+            if not block or (timelimit is not None and time.time() > timelimit):
+                return None
+            time.sleep(0.005)
+        channels = int(header["channels"][0])
+        capacity = int(header["capacity"][0])
+        wanted = frames*channels
+        while True:
+            written = int(header["written"][0])
+            if written - self._audio_read > capacity:
+                # Skip whole frames so the channels stay in place
+                skip = -(-(written - capacity - self._audio_read)//channels)*channels
+                self.audio_dropped += skip
+                self._audio_read += skip
+            available = written - self._audio_read
+            if available >= wanted or not block or (timelimit is not None and time.time() > timelimit):
+                break
+            time.sleep(0.005)
+        count = min(available, wanted)
+        count -= count % channels
+        start = self._audio_read % capacity
+        first = min(count, capacity-start)
+        out = np.concatenate((ring[start:start+first], ring[:count-first]))
+        # The plugin may have lapped us while we copied
+        overrun = int(header["written"][0]) - capacity - self._audio_read
+        if overrun > 0:
+            out = out[min(count, -(-overrun//channels)*channels):]
+            self.audio_dropped += count - len(out)
+        self._audio_read += count
+        return out.reshape(-1, channels)
+
+    def stop_audio_stream(self):
+        if self._audio_stream_name is None:
+            return False
+        if self.running:
+            self._wait(self._send(32))
+        self._close_audio_stream()
+        return True
+
+    def _close_audio_stream(self):
+        # The plugin keeps its own mapping, unlinking only drops the name
+        self._audio_stream = None
+        if self._audio_stream_map is not None:
+            try:
+                self._audio_stream_map.close()
+            except BufferError:
+                pass
+            self._audio_stream_map = None
+        if self._audio_stream_name is not None:
+            try:
+                os.unlink("/dev/shm" + self._audio_stream_name)
+            except FileNotFoundError:
+                pass
+            self._audio_stream_name = None
 
     def handle_audio_recording_stopped(self, f):
         self._on_audio_finish_record = f
@@ -615,35 +1423,203 @@ class Console:
 
     # Screen/GPU:
 
-    def get_screen(self):
-        self.proc_pipe.write(bytes([11]))
-        self.proc_pipe.write(bytes([(self._unique+5)*2]))
-        self.proc_pipe.flush()
-
-        startTime = time.time()
-        while True:
+    def _snapshot_key(self):
+        # The snapshot segment is reserved on the first request and reused,
+        # the GPU plugin attaches to it under its key
+        if self._screen_memory is None:
             try:
-                memory = sysv_ipc.SharedMemory((self._unique+5)*2)
-            except sysv_ipc.ExistentialError:
-                if time.time()-startTime < Console.shared_memory_timeout:
-                    continue
-                else:
-                    self.log("Shared memory timeout!")
-                    return self.get_screen()
-            except Exception as ex:
-                self.log("Shared memory error ",type(ex))
-                return
-            break
+                self._screen_memory = self._reserve_segment(Console.SCREEN_BYTES)
+            except sysv_ipc.Error as ex:
+                self.log("Shared memory error ", type(ex))
+                return 0
+        return self._screen_memory.key
+
+    def get_screen(self, copy=True, out=None):
+        # The reply only arrives once a frame newer than the request is in place
+        key = self._snapshot_key()
+        if key == 0 or self._wait(self._send(11, struct.pack("<i", key))) is None:
+            return None
+        return self._read_screen(copy, out)
 
-        screen_data = np.empty((480,640,3), dtype=np.uint8)
+    def _read_screen(self, copy, out):
+        memory = self._screen_memory
+        if memory is None:
+            return None
 
-        for i in range(640*480):
-            rgb = memory.read(3, i*3)
-            if len(rgb) == 3:
-                screen_data[479-int(i/640), i%640, 0] = rgb[0]
-                screen_data[479-int(i/640), i%640, 1] = rgb[1]
-                screen_data[479-int(i/640), i%640, 2] = rgb[2]
-        return screen_data
+        # OpenGL hands rows over bottom-up, flipping the view costs nothing
+        frame = np.frombuffer(memory, dtype=np.uint8, count=Console.SCREEN_BYTES)
+        frame = frame.reshape(Console.SCREEN_SHAPE)[::-1]
+
+        if out is not None:
+            np.copyto(out, frame)
+            return out
+        if copy:
+            return np.ascontiguousarray(frame)
+        return frame
+
+    def set_observation(self, size=(84, 84), grayscale=True, crop=None, max_pool=False):
+        # Has the emulator reduce frames before they reach shared memory:
+        # crop=(x, y, width, height) in screen pixels from the top left (None
+        # for the whole screen) is area-averaged down to size=(width, height),
+        # in grayscale or RGB. max_pool returns the per-pixel max of the last
+        # two frames of a step, Atari wrapper style; the frame skip is step's
+        # frames argument. step() and get_observation() then return arrays of
+        # observation_shape; size=None goes back to full frames.
+        if not self.running:
+            print("Cannot set the observation of an emulator that is not running.")
+            return False
+        if size is None:
+            if self._wait(self._send(56, struct.pack("<iIIIIIIII", 0, 0, 0, 0, 0, 0, 0, 0, 0))) is None:
+                return False
+            self._drop_observation_memory()
+            return True
+
+        width, height = size
+        channels = 1 if grayscale else 3
+        x, y, crop_width, crop_height = crop if crop is not None else (0, 0, 0, 0)
+        try:
+            memory = self._reserve_segment(width*height*channels)
+        except sysv_ipc.Error as ex:
+            self.log("Shared memory error ", type(ex))
+            return False
+        spec = struct.pack("<iIIIIIIII", memory.key, width, height, channels,
+                           x, y, crop_width, crop_height, 1 if max_pool else 0)
+        if self._wait(self._send(56, spec)) is None:
+            memory.detach()
+            try:
+                memory.remove()
+            except sysv_ipc.Error:
+                pass
+            return False
+        # The emulator has let go of the previous segment by now
+        self._drop_observation_memory()
+        self._observation_memory = memory
+        self.observation_shape = (height, width) if grayscale else (height, width, 3)
+        return True
+
+    def _drop_observation_memory(self):
+        if self._observation_memory is None:
+            return
+        self._observation_memory.detach()
+        try:
+            self._observation_memory.remove()
+        except sysv_ipc.Error:
+            pass
+        self._observation_memory = None
+        self.observation_shape = None
+
+    def get_observation(self, copy=True, out=None):
+        # Like get_screen, but returns the reduced frame set up by set_observation
+        if self._observation_memory is None:
+            print("No observation set, see set_observation.")
+            return None
+        if self._wait(self._send(57)) is None:
+            return None
+        return self._read_observation(copy, out)
+
+    def _read_observation(self, copy, out):
+        # Already top-down, the emulator flips rows while reducing
+        shape = self.observation_shape
+        observation = np.frombuffer(self._observation_memory, dtype=np.uint8, count=int(np.prod(shape)))
+        observation = observation.reshape(shape)
+
+        if out is not None:
+            np.copyto(out, observation)
+            return out
+        if copy:
+            return observation.copy()
+        return observation
+
+    def _attach_frame_ring(self, timeout=None):
+        if self._frame_ring is not None:
+            return self._frame_ring
+        memory = self._frame_ring_memory
+        if memory is None or not self.running:
+            return None
+        timelimit = time.time() + (Console.shared_memory_timeout if timeout is None else timeout)
+        header = np.frombuffer(memory, dtype=Console.FRAME_RING_HEADER, count=1)[0]
+        while True:
+            # The emulator writes the magic number last
+            if header["magic"] == Console.FRAME_RING_MAGIC:
+                break
+            if time.time() > timelimit:
+                self.log("Frame ring timeout!")
+                return None
+            time.sleep(0.01)
+
+        slots, stride, start = int(header["slots"]), int(header["slot_stride"]), int(header["header_size"])
+        height, width, channels = int(header["height"]), int(header["width"]), int(header["channels"])
+        raw = np.frombuffer(memory, dtype=np.uint8, count=start+slots*stride)[start:].reshape(slots, stride)
+        slot_headers = raw[:, :Console.FRAME_SLOT_HEADER.itemsize].view(Console.FRAME_SLOT_HEADER)[:, 0]
+        pixel_start = (Console.FRAME_SLOT_HEADER.itemsize + 63) // 64 * 64
+        pixels = raw[:, pixel_start:pixel_start+height*width*channels].reshape(slots, height, width, channels)
+
+        self._frame_ring = (header, slot_headers, pixels[:, ::-1])
+        return self._frame_ring
+
+    def _frame_ring_bytes(self):
+        # Same layout as FrameRingInit, every part 64 byte aligned
+        align = lambda n: (n + 63) // 64 * 64
+        stride = align(Console.FRAME_SLOT_HEADER.itemsize) + align(Console.SCREEN_BYTES)
+        return align(Console.FRAME_RING_HEADER.itemsize) + self._frame_ring_slots*stride
+
+    def _detach_frame_ring(self):
+        if self._frame_ring_memory is not None:
+            self._frame_ring = None
+            self._frame_ring_memory.detach()
+            self._frame_ring_memory = None
+
+    def _read_frame_slot(self, sequence, out):
+        header, slot_headers, frames = self._frame_ring
+        slot = sequence % len(slot_headers)
+        if slot_headers[slot]["sequence"] != sequence:
+            return False
+        np.copyto(out, frames[slot])
+        # Seqlock: if the slot was reused while we copied, the copy is torn
+        return slot_headers[slot]["sequence"] == sequence
+
+    # Frame ring (Console(frame_ring=N)): frames are read straight from shared
+    # memory, no request is sent to the emulator.
+
+    def latest_frame(self, out=None):
+        ring = self._attach_frame_ring()
+        if ring is None:
+            return (0, None)
+        if out is None:
+            out = np.empty(Console.SCREEN_SHAPE, dtype=np.uint8)
+        header = ring[0]
+        while True:
+            sequence = int(header["latest"])
+            if sequence == 0:
+                return (0, None)
+            if self._read_frame_slot(sequence, out):
+                return (sequence, out)
+
+    def iter_frames(self, poll=0.002, timeout=None, reuse=False):
+        # Frames overwritten before we get to them are skipped. With reuse=True
+        # the same array is refilled on every iteration.
+        ring = self._attach_frame_ring()
+        if ring is None:
+            return
+        header, slot_headers, _ = ring
+        slots = len(slot_headers)
+        last = int(header["latest"])
+        out = np.empty(Console.SCREEN_SHAPE, dtype=np.uint8)
+        waited_since = time.time()
+        while self.running:
+            latest = int(header["latest"])
+            if latest == last:
+                if timeout is not None and time.time()-waited_since > timeout:
+                    return
+                time.sleep(poll)
+                continue
+            waited_since = time.time()
+            for sequence in range(max(last+1, latest-slots+1), latest+1):
+                if not reuse:
+                    out = np.empty(Console.SCREEN_SHAPE, dtype=np.uint8)
+                if self._read_frame_slot(sequence, out):
+                    yield (sequence, out)
+            last = latest
 
     ################################################################################################################
     ################################################################################################################
@@ -669,18 +1645,136 @@ class Console:
         if not self.running:
             print("Not running - memory can only be accessed from running consoles.")
             return None
-        self.proc_pipe.write(bytes([22]))
-        self.proc_pipe.write((start).to_bytes(4, byteorder='big'))
-        self.proc_pipe.write((length).to_bytes(4, byteorder='big'))
-        self.proc_pipe.write(bytes([len(path)]))
-        self.proc_pipe.write(path.encode("ascii"))
+        future = self._send(22, struct.pack("<II", start, length) + path.encode("ascii"))
         if block:
-            return self._flush_then_wait(4, self.proc_pipe)
+            return self._wait(future) is not None
         else:
-            self.proc_pipe.flush()
-            return True
+            return future
+
+
+
+################################################################################################################
+################################################################################################################
+#############################################  CONSOLE POOL  ###################################################
+################################################################################################################
+################################################################################################################
+
+class ConsolePool():
+    # Drives n consoles of the same game as one. Every batched call sends its
+    # request to all of them before waiting for any reply, so a batch costs
+    # about one round trip instead of n. Frames are gathered into one
+    # (n, 480, 640, 3) array that lives in shared memory under
+    # observations_path, so other processes can map it too.
+    def __init__(self, playing, n, start=None, display=Display.NONE, debug=False, frame_ring=0, shared_ram=False, pin_cpus=False):
+        cpus = sorted(os.sched_getaffinity(0)) if pin_cpus else None
+        self.consoles = [Console(playing, start=start, display=display, debug=debug, frame_ring=frame_ring,
+                                 shared_ram=shared_ram, cpus=None if cpus is None else [cpus[i % len(cpus)]])
+                         for i in range(n)]
+
+        self.observations_path = "/dev/shm/psxle-pool-{}-{}".format(os.getpid(), uuid.uuid4().hex)
+        self._observations_map = None
+        self._map_observations(Console.SCREEN_SHAPE)
+        weakref.finalize(self, ConsolePool._unlink, self.observations_path)
+
+    def _map_observations(self, shape):
+        # (Re)sizes the shared file to hold one observation of shape per console.
+        # Arrays handed out earlier keep the old mapping alive until dropped.
+        size = len(self.consoles)*int(np.prod(shape))
+        flags = os.O_RDWR | os.O_CREAT | (os.O_EXCL if self._observations_map is None else 0)
+        fd = os.open(self.observations_path, flags, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            self._observations_map = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+        self.observations = np.frombuffer(self._observations_map, dtype=np.uint8).reshape((len(self.consoles),) + tuple(shape))
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        return len(self.consoles)
+
+    def __getitem__(self, i):
+        return self.consoles[i]
+
+    def _all(self, f):
+        # Starts f on every console in its own thread and returns the results
+        results = [None] * len(self.consoles)
+        def call(i, c):
+            results[i] = f(c)
+        threads = [threading.Thread(target=call, args=(i, c)) for i, c in enumerate(self.consoles)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def _gather(self, futures):
+        # Waits on one future per console, None where a console failed or
+        # refused the request outright
+        return [c._wait(f) if isinstance(f, Future) else None for c, f in zip(self.consoles, futures)]
+
+    def _all_ok(self, futures):
+        return all(r is not None for r in self._gather(futures))
+
+    def run(self):
+        # Boots every console in parallel
+        self._all(lambda c: c.run())
+
+    def kill(self):
+        self._all(lambda c: c.kill())
+        self.observations = None
+        self._observations_map.close()
+        ConsolePool._unlink(self.observations_path)
+
+    def step(self, frames=1, inputs=None, observe=True):
+        # Steps every console by `frames` vsyncs. inputs is None or holds one
+        # entry per console, in the format Console.step takes. Returns the
+        # observations array (overwritten by the next call), or True when
+        # observe=False; None if any console failed.
+        if inputs is None:
+            inputs = [None] * len(self.consoles)
+        requests = [c._step_request(frames, i, observe) for c, i in zip(self.consoles, inputs)]
+        ok = True
+        for n, (c, (future, source)) in enumerate(zip(self.consoles, requests)):
+            out = self.observations[n] if observe else None
+            if c._step_result(future, source, observe, False, out) is None:
+                ok = False
+        if not ok:
+            return None
+        return self.observations if observe else True
+
+    def set_observation(self, size=(84, 84), grayscale=True, crop=None, max_pool=False):
+        # Sets the same observation spec on every console (see
+        # Console.set_observation) and reshapes observations to match
+        if not all(self._all(lambda c: c.set_observation(size, grayscale, crop, max_pool))):
+            return False
+        self._map_observations(Console.SCREEN_SHAPE if size is None else self.consoles[0].observation_shape)
+        return True
 
+    def snapshot(self, name="default", compress=False):
+        return self._all_ok([c.snapshot(name, compress, block=False) for c in self.consoles])
 
+    def reset(self, name="default", frames=1, observe=True):
+        # Restores snapshot `name` everywhere, then steps `frames` vsyncs so
+        # the observations show the restored state
+        if not self._all_ok([c.restore(name, block=False) for c in self.consoles]):
+            return None
+        return self.step(frames, observe=observe)
+
+    def read_bytes(self, start, length):
+        return self._gather([c.read_bytes_async(start, length) for c in self.consoles])
+
+    def read_regions(self, regions):
+        return self._gather([c.read_regions_async(regions) for c in self.consoles])
+
+    def turbo(self, enabled=True, render_every=0):
+        return self._all_ok([c.turbo(enabled, render_every, block=False) for c in self.consoles])
 
 ################################################################################################################
 ################################################################################################################
@@ -705,9 +1799,19 @@ class IPCThread (threading.Thread):
                     raise
             if len(next) == 0:
                 continue
+            if next[0] == Console.REPLY_MARKER:
+                opcode, status, _, request_id, length = Console.REPLY_HEADER.unpack(
+                    self.owner.memory_cb_pipe.read(Console.REPLY_HEADER.size))
+                data = self.owner.memory_cb_pipe.read(length) if length > 0 else b""
+                self.owner._resolve(request_id, opcode, status, data)
+                continue
+            if next[0] == Console.EVENT_MARKER:
+                count, length, cycle, frame = Console.EVENT_HEADER.unpack(
+                    self.owner.memory_cb_pipe.read(Console.EVENT_HEADER.size))
+                self.dispatch(self.owner.memory_cb_pipe.read(length), frame, cycle)
+                continue
             if next[0] != 0:
                 self.owner.log("Received notification with id: {}".format(next[0]))
-                self.owner.cb_handler.update(next[0])
                 if next[0] == 2:
                     if self.owner._on_state_load:
                         self.owner._on_state_load()
@@ -720,21 +1824,33 @@ class IPCThread (threading.Thread):
                         self.owner._on_audio_finish_record()
                 continue
 
-            key = self.owner.memory_cb_pipe.read(1)[0]
-            profile = None
-            memoryvalue = None
-            for g in self.owner._memory_listener_list:
-                if g.key == key:
-                    profile = g
-                    break
-            if profile is None:
-                continue
-            bytecount = profile.length
-            memoryvalue = self.owner.memory_cb_pipe.read(bytecount)
-            profile.callback(memoryvalue)
-
         self.owner.log("Stopped memory speaker.")
 
+    def dispatch(self, events, frame, cycle):
+        # One read per record, the events are sliced out of it in order
+        table = self.owner._listener_table
+        executor = self.owner._callback_executor
+        self.owner.event_frame, self.owner.event_cycle = frame, cycle
+        offset = 0
+        while offset + Console.EVENT_ENTRY.size <= len(events):
+            key, length = Console.EVENT_ENTRY.unpack_from(events, offset)
+            start = offset + Console.EVENT_ENTRY.size
+            end = start + length
+            offset = end
+            if end > len(events):
+                self.owner.error("Listener event for key {} overruns its record".format(key))
+                return
+            # Each event carries its length, so one we cannot use is skipped
+            # without losing the rest of the frame
+            profile = table[key] if key < len(table) else None
+            if profile is None or profile.length != length:
+                self.owner.error("Listener event with unknown key {} ({} bytes)".format(key, length))
+                continue
+            if executor is not None:
+                executor.submit(profile, events[start:end])
+            else:
+                profile.callback(events[start:end])
+
     def stop(self):
         self.owner.log("Stopping memory speaker...")
         self.killed = True